@@ -26,6 +26,15 @@ def read_data(args,T,K):
     U_kn = numpy.empty([K,args.N_max/args.skip], numpy.float64)
     Q_kn = numpy.empty([K,args.N_max/args.skip], numpy.float64)
     print "Reading data..."
+    if os.path.exists('%s/runstore' % args.direc):
+    	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+    	import runstore
+    	store = runstore.load('%s/runstore' % args.direc)
+    	for i, t in enumerate(T):
+    		k = store.index(T=t)[0]
+    		U_kn[i,:] = store['energy'][k,-args.N_max::][::args.skip]
+    		Q_kn[i,:] = store['Q'][k,-args.N_max::][::args.skip]
+    	return U_kn,Q_kn,args.N_max/args.skip
     for i, t in enumerate(T):
     	ufile = '%s/energy%i.npy' %(args.direc, t)
     	data = numpy.load(ufile)[-args.N_max::]
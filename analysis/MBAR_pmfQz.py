@@ -6,6 +6,7 @@ import pymbar
 import timeseries
 import commands
 import os
+import sys
 import pdb
 #import matplotlib.pyplot as plt
 import optparse
@@ -108,6 +109,20 @@ def read_data(args,K,Z,T,spring_constant):
     Q_kn = numpy.empty([K,args.N_max/args.skip], numpy.float64)
     z_kn = numpy.empty([K,args.N_max/args.skip], numpy.float64)	
     print "Reading data..."
+    if os.path.exists('%s/runstore' % args.direc): # merged with runstore.py -o direc/runstore direc/*/runstore
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+        import runstore
+        store = runstore.load('%s/runstore' % args.direc)
+        i = 0
+        for z in Z:
+            for t in T:
+                k = store.index(T=t, zpin=z)[0]
+                U_kn[i,:] = store['energy'][k,-args.N_max::][::args.skip]
+                Q_kn[i,:] = store['Q'][k,-args.N_max::][::args.skip]
+                z_kn[i,:] = store['z'][k,-args.N_max::][::args.skip]
+                U_kn[i,:] -= spring_constant*(z_kn[i,:] - z)**2
+                i += 1
+        return U_kn, Q_kn, z_kn, args.N_max/args.skip
     i = 0
     for z in Z: 
         for t in T:
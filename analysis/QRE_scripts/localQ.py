@@ -2,7 +2,11 @@
 # ellen.zhong@virginia.edu
 # 10/10/2013
 
+import os
+import sys
 import numpy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'package'))
+import trajectory
 from optparse import OptionParser
 import pdb
 import matplotlib.pyplot as plt
@@ -53,14 +57,9 @@ def get_localQ(coord,contacts,sig_cutoff):
 def get_traj_localQ(file,numbeads,N,contacts,sig_cutoff):
     localQ_kn = numpy.empty([numbeads,N])
     print 'Reading traj data for %s...' % file
-    file = open(file,'r')
-#    for i in range(N_max - N): # skip through beginning
-#        _ = numpy.load(file)
-#    assert(numbeads==len(_))
+    traj = trajectory.load(file, 0, N)
     for i in range(N):
-        coord = numpy.load(file)
-        localQ_kn[:,i] = get_localQ(coord,contacts,sig_cutoff)
-    file.close()
+        localQ_kn[:,i] = get_localQ(traj[i],contacts,sig_cutoff)
     return localQ_kn
 
 
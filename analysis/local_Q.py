@@ -4,7 +4,11 @@
 # ellen.zhong@virginia.edu
 # 10/10/2013
 
+import os
+import sys
 import numpy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+import trajectory
 from optparse import OptionParser
 import pdb
 import matplotlib.pyplot as plt
@@ -43,14 +47,10 @@ def get_Rg(direc,K,N,N_max,T):
     print "Reading traj data..."
     for i,t in enumerate(T):
         print 'Reading traj at %i' % t
-        file = open('%s/trajectory%i' %(direc,t),'r')
-        for j in range(N_max - N): # skip through beginning
-            _ = numpy.load(file)
-        nbeads = len(_) # get numbeads
+        traj = trajectory.load('%s/trajectory%i' %(direc,t), N_max - N, N_max)
+        nbeads = traj.shape[1] # get numbeads
         for j in range(N):
-            coord = numpy.load(file)
-            Rg_kn[i,j] = Rg(coord,nbeads)
-        file.close()
+            Rg_kn[i,j] = Rg(traj[j],nbeads)
     return Rg_kn
 
 
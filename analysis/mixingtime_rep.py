@@ -7,6 +7,8 @@ import pdb
 import matplotlib.pyplot as plt
 import matplotlib
 import cPickle
+import os
+import sys
 
 font = {'family' : 'normal',
         'weight' : 'bold',
@@ -25,7 +27,14 @@ parser.add_option("--show", default=False, action="store_true", dest="show", hel
 file = options.datafile+'/Qtraj_singleprot.npy'
 n = options.average
 
-Q = numpy.load(file)
+if os.path.exists(options.datafile+'/runstore'):
+	sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package'))
+	import runstore
+	store = runstore.load(options.datafile+'/runstore')
+	Q = store['Qtraj_singleprot']
+else:
+	store = None
+	Q = numpy.load(file)
 numrep = options.replicas
 save = options.save
 #swap = options.swap
@@ -46,8 +55,11 @@ fig.text(.5,.04, 'move/%i' % (n*save), ha='center',va='center', fontdict=font)
 fig.text(.5,.96, 'Q trajectories for single proteins', ha='center',va='center',fontdict=font)
 fig.text(.06,.5,'Q fraction native',ha='center',va='center',rotation='vertical',fontdict=font)
 
-pt = cPickle.load(open(options.datafile+'protein_location.pkl','rb'))
-pt = numpy.array(pt)
+if store:
+	pt = store['protein_location']
+else:
+	pt = cPickle.load(open(options.datafile+'protein_location.pkl','rb'))
+	pt = numpy.array(pt)
 mixing_time = [[] for x in range(numrep)]
 for rep in range(numrep):
 	highQ_index = 0
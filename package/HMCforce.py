@@ -1,7 +1,7 @@
 import numpy
 import energyfunc
 import pdb
-from scipy import weave
+import kernels
 #==========================================
 # FORCE CALCULATION METHODS
 #==========================================
@@ -41,7 +41,7 @@ def cdihedforces(torsparam, bonds, dsq, d, numbeads):
         FORCES2(i+3,0) += Flx; FORCES2(i+3,1) += Fly; FORCES2(i+3,2) += Flz;
     }
     """
-    info = weave.inline(code, ['forces', 'torsparam', 'numbeads', 'bonds', 'dsq', 'd'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['forces', 'torsparam', 'numbeads', 'bonds', 'dsq', 'd'], headers=['<math.h>', '<stdlib.h>'])
     return forces*4.184
 
 def cangleforces(mpos, angleparam, bonds, d, numbeads):
@@ -74,7 +74,7 @@ def cangleforces(mpos, angleparam, bonds, d, numbeads):
         FORCES2(i+2,0) += Fkx; FORCES2(i+2,1) += Fky; FORCES2(i+2,2) += Fkz;
     }
     """
-    info = weave.inline(code, ['forces', 'angleparam', 'numbeads', 'bonds', 'rki', 'd'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['forces', 'angleparam', 'numbeads', 'bonds', 'rki', 'd'], headers=['<math.h>', '<stdlib.h>'])
     return forces*4.184
                 
 def bondedforces(mpos, torsparam, angleparam, bonds, d2, d, numbeads):
@@ -206,16 +206,17 @@ def nonbondedforces(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
             }
         }
         """
-        info = weave.inline(code, ['forces', 'F', 'numbeads'], headers=['<math.h>', '<stdlib.h>'])
+        info = kernels.inline(code, ['forces', 'F', 'numbeads'], headers=['<math.h>', '<stdlib.h>'])
 	return forces * 4.184 # converts force to kJ/mol/K
 
-def cnonbondedforces(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
+def cnonbondedforces(mpos, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil):
 	"""Returns the nonbonded forces of a given configuration"""
 	forces = numpy.zeros((numbeads,3))
+	nnat = len(natpairs)
 	# get distances, square distances, and magnitude distances for all interactions 
 	#rvec = energyfunc.cgetforcer(mpos, numint, numbeads) # excludes 12 and 13 neightbors
 	code = """
-        int k = 0;
+        int p = 0;
         double r2, r, ndV, ndV6, F,x,y,z;
         for ( int i = 0; i < numbeads; i++){
             for ( int j = i+3; j < numbeads; j++){
@@ -224,13 +225,14 @@ def cnonbondedforces(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
                 z = MPOS2(i,2) - MPOS2(j,2);
                 r2 = x*x + y*y + z*z;
                 r = sqrt(r2);
-                if (NATPARAM2(k,0) == 1){
-                    ndV = NATPARAM2(k,2)*NATPARAM2(k,2)/r2;
+                if (p < nnat && NATPAIRS2(p,0) == i && NATPAIRS2(p,1) == j){
+                    ndV = NATPARAM2(p,1)*NATPARAM2(p,1)/r2;
                     ndV6 = ndV*ndV*ndV;
-                    ndV = NATPARAM2(k,1)*(-156*ndV6*ndV6/r + 180*ndV6*ndV*ndV/r - 24*ndV6/r);
+                    ndV = NATPARAM2(p,0)*(-156*ndV6*ndV6/r + 180*ndV6*ndV*ndV/r - 24*ndV6/r);
+                    p++;
                 }
                 else{
-                    ndV = NONNATPARAM2(k,1)*NONNATPARAM2(k,1)/r2;
+                    ndV = (NONNATPARAM1(i)+NONNATPARAM1(j))*(NONNATPARAM1(i)+NONNATPARAM1(j))/r2;
                     ndV = ndV*ndV*ndV;
                     ndV = -12*nnepsil*ndV*ndV/r;
                 }
@@ -241,14 +243,235 @@ def cnonbondedforces(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
                 FORCES2(j,0) += -F*x;
                 FORCES2(j,1) += -F*y;
                 FORCES2(j,2) += -F*z;
-                k++;
             }
         }
         """
-        info = weave.inline(code, ['forces', 'mpos', 'numbeads', 'natparam', 'nonnatparam', 'nnepsil'], headers=['<math.h>', '<stdlib.h>'])
+        info = kernels.inline(code, ['forces', 'mpos', 'numbeads', 'nnat', 'natpairs', 'natparam', 'nonnatparam', 'nnepsil'], headers=['<math.h>', '<stdlib.h>'])
 
 	return forces * 4.184 # converts force to kJ/mol/K
 
+def cnonbondedforces_list(mpos, nlist, natparam, nonnatparam, nnepsil, cutoff):
+    """Returns the nonbonded forces of the interactions in the neighbor list that are within the cutoff"""
+    numbeads = len(mpos)
+    n = len(nlist)
+    forces = numpy.zeros((numbeads,3))
+    code = """
+    int i, j, p;
+    double r2, r, ndV, ndV6, F, x, y, z;
+    double cut2 = cutoff*cutoff;
+    for ( int l = 0; l < n; l++){
+        i = NLIST2(l,0); j = NLIST2(l,1); p = NLIST2(l,2);
+        x = MPOS2(i,0) - MPOS2(j,0);
+        y = MPOS2(i,1) - MPOS2(j,1);
+        z = MPOS2(i,2) - MPOS2(j,2);
+        r2 = x*x + y*y + z*z;
+        if (r2 < cut2){
+            r = sqrt(r2);
+            if (p >= 0){
+                ndV = NATPARAM2(p,1)*NATPARAM2(p,1)/r2;
+                ndV6 = ndV*ndV*ndV;
+                ndV = NATPARAM2(p,0)*(-156*ndV6*ndV6/r + 180*ndV6*ndV*ndV/r - 24*ndV6/r);
+            }
+            else{
+                ndV = (NONNATPARAM1(i)+NONNATPARAM1(j))*(NONNATPARAM1(i)+NONNATPARAM1(j))/r2;
+                ndV = ndV*ndV*ndV;
+                ndV = -12*nnepsil*ndV*ndV/r;
+            }
+            F = -ndV/r;
+            FORCES2(i,0) += F*x;
+            FORCES2(i,1) += F*y;
+            FORCES2(i,2) += F*z;
+            FORCES2(j,0) += -F*x;
+            FORCES2(j,1) += -F*y;
+            FORCES2(j,2) += -F*z;
+        }
+    }
+    """
+    info = kernels.inline(code, ['forces', 'mpos', 'n', 'nlist', 'natparam', 'nonnatparam', 'nnepsil', 'cutoff'], headers=['<math.h>', '<stdlib.h>'])
+    return forces * 4.184 # converts force to kJ/mol/K
+
+# angle and dihedral forces of cangleforces and cdihedforces, and if energies the energies
+# of cangleenergy and ctorsionenergy, shared by the fused kernels below
+bondedcode = """
+    double xba, yba, zba, xbc, ybc, zbc, angle, dV;
+    double fpx, fpy, fpz, ba2, xy, xz, yz;
+    double Fix, Fiy, Fiz, Fjx, Fjy, Fjz, Fkx, Fky, Fkz, Flx, Fly, Flz;
+    double x1, x2, x3, y1, y2, y3, z1, z2, z3;
+    double mx, my, mz, m2, nx, ny, nz, n2;
+    double magBC, a, b, dihed;
+    for ( int i = 0; i < numbeads - 2; i++){
+        xba = BONDS2(i,0); yba = BONDS2(i,1); zba = BONDS2(i,2);
+        xbc = -BONDS2(i+1,0); ybc = -BONDS2(i+1,1); zbc = -BONDS2(i+1,2);
+        if (energies){
+            angle = acos((xba*xbc + yba*ybc + zba*zbc) / sqrt((xba*xba + yba*yba + zba*zba)*(xbc*xbc + ybc*ybc + zbc*zbc)));
+            ANGE1(i) = ANGLEPARAM2(i,0)*(angle-ANGLEPARAM2(i,1))*(angle-ANGLEPARAM2(i,1));
+        }
+        angle = acos((xba*xbc + yba*ybc + zba*zbc) / (D1(i)*D1(i+1)));
+        dV = 2*ANGLEPARAM2(i,0)*(angle-ANGLEPARAM2(i,1))/-sin(angle);
+        fpx = dV / (D1(i)*D1(i+1)) * (MPOS2(i,0) - MPOS2(i+2,0));
+        fpy = dV / (D1(i)*D1(i+1)) * (MPOS2(i,1) - MPOS2(i+2,1));
+        fpz = dV / (D1(i)*D1(i+1)) * (MPOS2(i,2) - MPOS2(i+2,2));
+        ba2 = xba*xba + yba*yba + zba*zba;
+        xy = xba*yba/ba2; xz = xba*zba/ba2; yz = yba*zba/ba2;
+        Fix = fpx*(1 - xba*xba/ba2) - fpy*xy - fpz*xz;
+        Fiy = -fpx*xy + fpy*(1 - yba*yba/ba2) - fpz*yz;
+        Fiz = -fpx*xz - fpy*yz + fpz*(1 - zba*zba/ba2);
+        ba2 = xbc*xbc + ybc*ybc + zbc*zbc;
+        xy = xbc*ybc/ba2; xz = xbc*zbc/ba2; yz = ybc*zbc/ba2;
+        Fkx = -fpx*(1 - xbc*xbc/ba2) + fpy*xy + fpz*xz;
+        Fky = fpx*xy - fpy*(1 - ybc*ybc/ba2) + fpz*yz;
+        Fkz = fpx*xz + fpy*yz - fpz*(1 - zbc*zbc/ba2);
+        FORCES2(i,0) += Fix; FORCES2(i,1) += Fiy; FORCES2(i,2) += Fiz;
+        FORCES2(i+1,0) += -Fix-Fkx; FORCES2(i+1,1) += -Fiy-Fky; FORCES2(i+1,2) += -Fiz-Fkz;
+        FORCES2(i+2,0) += Fkx; FORCES2(i+2,1) += Fky; FORCES2(i+2,2) += Fkz;
+    }
+    for (int i = 0; i < numbeads-3; i++){
+        x1 = BONDS2(i,0); y1 = BONDS2(i,1); z1 = BONDS2(i,2);
+        x2 = -BONDS2(i+1,0); y2 = -BONDS2(i+1,1); z2 = -BONDS2(i+1,2);
+        x3 = BONDS2(i+2,0); y3 = BONDS2(i+2,1); z3 = BONDS2(i+2,2);
+        mx = y1*z2 - z1*y2; my = z1*x2 - x1*z2; mz = x1*y2 - y1*x2;
+        nx = y2*z3 - z2*y3; ny = z2*x3 - x2*z3; nz = x2*y3 - y2*x3;
+        m2 = mx*mx + my*my + mz*mz;
+        n2 = nx*nx + ny*ny + nz*nz;
+        magBC = sqrt(x2*x2 + y2*y2 + z2*z2);
+        a = magBC*(x1*nx + y1*ny + z1*nz);
+        b = mx*nx + my*ny + mz*nz;
+        dihed = atan2(a,b);
+        if ( dihed < 0){
+            dihed += 2*M_PI;
+        }
+        dV = 0;
+        TORSE1(i) = 0;
+        for ( int k = 4*i; k < 4*i+4; k++){
+            dV -= TORSPARAM2(k,0)*TORSPARAM2(k,1)*sin(TORSPARAM2(k,1)*dihed-TORSPARAM2(k,2));
+            if (energies) TORSE1(i) += TORSPARAM2(k,0)*(1+cos(TORSPARAM2(k,1)*dihed-TORSPARAM2(k,2)));
+        }
+        Fix = -dV * D1(i+1) * mx / m2; Fiy = -dV * D1(i+1) * my / m2; Fiz = -dV * D1(i+1) * mz / m2;
+        Flx = dV * D1(i+1) * nx / n2; Fly = dV * D1(i+1) * ny / n2; Flz = dV * D1(i+1) * nz / n2;
+        a = (x1*x2 + y1*y2 + z1*z2) / DSQ1(i+1);
+        b = (x2*x3 + y2*y3 + z2*z3) / DSQ1(i+1);
+        Fjx = (a-1)*Fix - b*Flx; Fjy = (a-1)*Fiy - b*Fly; Fjz = (a-1)*Fiz - b*Flz;
+        Fkx = -a*Fix + (b-1)*Flx; Fky = -a*Fiy + (b-1)*Fly; Fkz = -a*Fiz + (b-1)*Flz;
+        FORCES2(i,0) += Fix; FORCES2(i,1) += Fiy; FORCES2(i,2) += Fiz;
+        FORCES2(i+1,0) += Fjx; FORCES2(i+1,1) += Fjy; FORCES2(i+1,2) += Fjz;
+        FORCES2(i+2,0) += Fkx; FORCES2(i+2,1) += Fky; FORCES2(i+2,2) += Fkz;
+        FORCES2(i+3,0) += Flx; FORCES2(i+3,1) += Fly; FORCES2(i+3,2) += Flz;
+    }
+"""
+
+def cgetforces(mpos, bonds, dsq, d, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, energies=False):
+    """
+    Fused cangleforces + cdihedforces + cnonbondedforces, if energies also returns the energies
+    of mpos as energyfunc.cgetLJenergy_withE, cangleenergy and ctorsionenergy would
+
+    Returns:
+        forces, r2 and energy of every interaction, total LJ energy, angle energies, torsion energies
+    """
+    forces = numpy.zeros((numbeads,3))
+    r2_array = numpy.empty(numint)
+    E_array = numpy.empty(numint)
+    angE = numpy.empty(numbeads-2)
+    torsE = numpy.empty(numbeads-3)
+    energy = numpy.array([0.0])
+    nnat = len(natpairs)
+    code = bondedcode + """
+    int k = 0, p = 0;
+    double r2, r, nE, nE6, ndV, F, x, y, z;
+    for ( int i = 0; i < numbeads; i++){
+        for ( int j = i+3; j < numbeads; j++){
+            x = MPOS2(i,0) - MPOS2(j,0);
+            y = MPOS2(i,1) - MPOS2(j,1);
+            z = MPOS2(i,2) - MPOS2(j,2);
+            r2 = x*x + y*y + z*z;
+            r = sqrt(r2);
+            if (energies) R2_ARRAY1(k) = r2;
+            if (p < nnat && NATPAIRS2(p,0) == i && NATPAIRS2(p,1) == j){
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/r2;
+                nE6 = nE*nE*nE;
+                if (energies) E_ARRAY1(k) = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                ndV = NATPARAM2(p,0)*(-156*nE6*nE6/r + 180*nE6*nE*nE/r - 24*nE6/r);
+                p++;
+            }
+            else{
+                nE = (NONNATPARAM1(i)+NONNATPARAM1(j))*(NONNATPARAM1(i)+NONNATPARAM1(j))/r2;
+                nE = nE*nE*nE;
+                if (energies) E_ARRAY1(k) = nnepsil*nE*nE;
+                ndV = -12*nnepsil*nE*nE/r;
+            }
+            if (energies) ENERGY1(0) += E_ARRAY1(k);
+            F = -ndV/r;
+            FORCES2(i,0) += F*x;
+            FORCES2(i,1) += F*y;
+            FORCES2(i,2) += F*z;
+            FORCES2(j,0) += -F*x;
+            FORCES2(j,1) += -F*y;
+            FORCES2(j,2) += -F*z;
+            k++;
+        }
+    }
+    """
+    energies = int(energies)
+    info = kernels.inline(code, ['forces', 'mpos', 'bonds', 'dsq', 'd', 'numbeads', 'nnat', 'natpairs', 'natparam', 'nonnatparam', 'nnepsil', 'angleparam', 'torsparam', 'energies', 'r2_array', 'E_array', 'energy', 'angE', 'torsE'], headers=['<math.h>', '<stdlib.h>'])
+    return forces * 4.184, r2_array, E_array, energy[0], angE, torsE
+
+def cgetforces_list(mpos, bonds, dsq, d, nlist, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, energies=False):
+    """Same as cgetforces for the interactions in the neighbor list, energies as energyfunc.cgetLJenergy_list"""
+    numbeads = len(mpos)
+    n = len(nlist)
+    forces = numpy.zeros((numbeads,3))
+    r2_array = numpy.empty(n)
+    E_array = numpy.zeros(n)
+    angE = numpy.empty(numbeads-2)
+    torsE = numpy.empty(numbeads-3)
+    energy = numpy.array([0.0])
+    code = bondedcode + """
+    int i, j, p;
+    double r2, r, nE, nE6, nnE, ndV, F, x, y, z;
+    double cut2 = cutoff*cutoff;
+    for ( int l = 0; l < n; l++){
+        i = NLIST2(l,0); j = NLIST2(l,1); p = NLIST2(l,2);
+        x = MPOS2(i,0) - MPOS2(j,0);
+        y = MPOS2(i,1) - MPOS2(j,1);
+        z = MPOS2(i,2) - MPOS2(j,2);
+        r2 = x*x + y*y + z*z;
+        if (energies) R2_ARRAY1(l) = r2;
+        if (r2 < cut2){
+            r = sqrt(r2);
+            if (p >= 0){
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/r2;
+                nE6 = nE*nE*nE;
+                ndV = NATPARAM2(p,0)*(-156*nE6*nE6/r + 180*nE6*nE*nE/r - 24*nE6/r);
+                if (energies){
+                    E_ARRAY1(l) = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                    nE = NATPARAM2(p,1)*NATPARAM2(p,1)/cut2;
+                    nE6 = nE*nE*nE;
+                    E_ARRAY1(l) -= NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                }
+            }
+            else{
+                nnE = (NONNATPARAM1(i)+NONNATPARAM1(j))*(NONNATPARAM1(i)+NONNATPARAM1(j));
+                nE = nnE/r2;
+                nE = nE*nE*nE;
+                nnE = nnE/cut2;
+                nnE = nnE*nnE*nnE;
+                if (energies) E_ARRAY1(l) = nnepsil*(nE*nE - nnE*nnE);
+                ndV = -12*nnepsil*nE*nE/r;
+            }
+            if (energies) ENERGY1(0) += E_ARRAY1(l);
+            F = -ndV/r;
+            FORCES2(i,0) += F*x;
+            FORCES2(i,1) += F*y;
+            FORCES2(i,2) += F*z;
+            FORCES2(j,0) += -F*x;
+            FORCES2(j,1) += -F*y;
+            FORCES2(j,2) += -F*z;
+        }
+    }
+    """
+    energies = int(energies)
+    info = kernels.inline(code, ['forces', 'mpos', 'bonds', 'dsq', 'd', 'numbeads', 'n', 'nlist', 'natparam', 'nonnatparam', 'nnepsil', 'angleparam', 'torsparam', 'cutoff', 'energies', 'r2_array', 'E_array', 'energy', 'angE', 'torsE'], headers=['<math.h>', '<stdlib.h>'])
+    return forces * 4.184, r2_array, E_array, energy[0], angE, torsE
+
 def getsurfforce(prot_coord, surf_coord, numint, numbeads, param):
     ep = param[0]
     sig = param[1]
@@ -297,7 +520,55 @@ def cgetsurfforce(prot_coord, surf_coord, numint, numbeads, param, _):
 	}
     }
     """
-    info = weave.inline(code, ['forces', 'prot_coord', 'surf_coord', 'numbeads', 'numint', 'ep_in', 'sig_in', 'scale'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['forces', 'prot_coord', 'surf_coord', 'numbeads', 'numint', 'ep_in', 'sig_in', 'scale'], headers=['<math.h>', '<stdlib.h>'])
+    return forces*4.184
+
+def cgetsurfforce_grid(prot_coord, numbeads, grid, gridparam, scale):
+    """Returns the surface forces from the tabulated potential, see energyfunc.csurfenergy_grid"""
+    forces = numpy.zeros((numbeads,3))
+    code = """
+    int nx = Ngrid[0], ny = Ngrid[1], nz = Ngrid[2];
+    double x0 = GRIDPARAM1(0), y0 = GRIDPARAM1(1), zmin = GRIDPARAM1(2);
+    double dx = GRIDPARAM1(3), dy = GRIDPARAM1(4), dz = GRIDPARAM1(5);
+    double zmax = zmin + (nz-1)*dz;
+    int ix, iy, iz, ix1, iy1;
+    double u, v, w, t, h00, h10, h01, h11, g00, g10, g01, g11, s;
+    double f[2][2], fz[2][2];
+    for ( int i = 0; i < numbeads; i++){
+        if (PROT_COORD2(i,2) < zmin || PROT_COORD2(i,2) >= zmax) continue;
+        u = (PROT_COORD2(i,0) - x0)/dx;
+        u -= nx*floor(u/nx);
+        ix = (int)u; u -= ix; ix %= nx; ix1 = (ix+1) % nx;
+        v = (PROT_COORD2(i,1) - y0)/dy;
+        v -= ny*floor(v/ny);
+        iy = (int)v; v -= iy; iy %= ny; iy1 = (iy+1) % ny;
+        w = (PROT_COORD2(i,2) - zmin)/dz;
+        iz = (int)w; t = w - iz;
+        h00 = (1+2*t)*(1-t)*(1-t); h10 = t*(1-t)*(1-t)*dz;
+        h01 = t*t*(3-2*t); h11 = t*t*(t-1)*dz;
+        g00 = 6*t*(t-1)/dz; g10 = (1-t)*(1-3*t);
+        g01 = -g00; g11 = t*(3*t-2);
+        for ( int l = 0; l < 2; l++){
+            s = (l == 0) ? 1. : SCALE1(i);
+            f[0][0] = h00*GRID4(ix,iy,iz,l) + h10*GRID4(ix,iy,iz,l+2) + h01*GRID4(ix,iy,iz+1,l) + h11*GRID4(ix,iy,iz+1,l+2);
+            f[1][0] = h00*GRID4(ix1,iy,iz,l) + h10*GRID4(ix1,iy,iz,l+2) + h01*GRID4(ix1,iy,iz+1,l) + h11*GRID4(ix1,iy,iz+1,l+2);
+            f[0][1] = h00*GRID4(ix,iy1,iz,l) + h10*GRID4(ix,iy1,iz,l+2) + h01*GRID4(ix,iy1,iz+1,l) + h11*GRID4(ix,iy1,iz+1,l+2);
+            f[1][1] = h00*GRID4(ix1,iy1,iz,l) + h10*GRID4(ix1,iy1,iz,l+2) + h01*GRID4(ix1,iy1,iz+1,l) + h11*GRID4(ix1,iy1,iz+1,l+2);
+            fz[0][0] = g00*GRID4(ix,iy,iz,l) + g10*GRID4(ix,iy,iz,l+2) + g01*GRID4(ix,iy,iz+1,l) + g11*GRID4(ix,iy,iz+1,l+2);
+            fz[1][0] = g00*GRID4(ix1,iy,iz,l) + g10*GRID4(ix1,iy,iz,l+2) + g01*GRID4(ix1,iy,iz+1,l) + g11*GRID4(ix1,iy,iz+1,l+2);
+            fz[0][1] = g00*GRID4(ix,iy1,iz,l) + g10*GRID4(ix,iy1,iz,l+2) + g01*GRID4(ix,iy1,iz+1,l) + g11*GRID4(ix,iy1,iz+1,l+2);
+            fz[1][1] = g00*GRID4(ix1,iy1,iz,l) + g10*GRID4(ix1,iy1,iz,l+2) + g01*GRID4(ix1,iy1,iz+1,l) + g11*GRID4(ix1,iy1,iz+1,l+2);
+            FORCES2(i,0) -= s*((1-v)*(f[1][0]-f[0][0]) + v*(f[1][1]-f[0][1]))/dx;
+            FORCES2(i,1) -= s*((1-u)*(f[0][1]-f[0][0]) + u*(f[1][1]-f[1][0]))/dy;
+            FORCES2(i,2) -= s*((1-u)*(1-v)*fz[0][0] + u*(1-v)*fz[1][0] + (1-u)*v*fz[0][1] + u*v*fz[1][1]);
+        }
+    }
+    """
+    info = kernels.inline(code, ['forces', 'prot_coord', 'numbeads', 'grid', 'gridparam', 'scale'], headers=['<math.h>', '<stdlib.h>'])
+    low = prot_coord[:,2] < gridparam[2]
+    if numpy.any(low):
+        param = energyfunc.csurfperiodic(prot_coord[low] - numpy.array([gridparam[0], gridparam[1], 0.]), gridparam[6], gridparam[7], gridparam[8])
+        forces[low,:] -= param[:,2:5] + scale[low][:,numpy.newaxis]*param[:,5:8]
     return forces*4.184
 
 def getsurfforce_old(prot_coord, surf_coord, numint, numbeads, param):
@@ -340,7 +611,7 @@ def cgetsurfforce_old(prot_coord, surf_coord, numint, numbeads, param, scale):
 	}
     }
     """
-    info = weave.inline(code, ['forces', 'prot_coord', 'surf_coord', 'numbeads', 'numint', 'param','scale'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['forces', 'prot_coord', 'surf_coord', 'numbeads', 'numint', 'param','scale'], headers=['<math.h>', '<stdlib.h>'])
     return forces*4.184
 
 #==========================================
@@ -419,7 +690,7 @@ def cshake(bonds, v_half, h, m, dsq, maxloop, numbeads, tol):
         LOOPS1(0) += 1;
     }
     """
-    info = weave.inline(code, ['bonds', 'v_half', 'h', 'm', 'dsq', 'maxloop', 'numbeads', 'tol','loops'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['bonds', 'v_half', 'h', 'm', 'dsq', 'maxloop', 'numbeads', 'tol','loops'], headers=['<math.h>', '<stdlib.h>'])
     #print "cshake iterations " + str(loops[0])
     conv = True
     if loops[0] == maxloop:
@@ -455,11 +726,99 @@ def crattle(bonds, vel, m, dsq, maxloop, numbeads, tol):
         LOOPS1(0)++;
     }
     """
-    info = weave.inline(code, ['bonds', 'vel', 'm', 'dsq', 'maxloop', 'numbeads', 'tol', 'loops'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['bonds', 'vel', 'm', 'dsq', 'maxloop', 'numbeads', 'tol', 'loops'], headers=['<math.h>', '<stdlib.h>'])
     conv = True
     if loops[0] == maxloop:
         conv = False
     return vel, conv
+
+# Direct solvers for the bond constraints of the linear chain. Constraint i only couples to
+# constraints i-1 and i+1 through the shared beads, so the linearized constraint equations are
+# tridiagonal and solved in O(N) with the Thomas algorithm. The correction of constraint i moves
+# bead i by -lam[i]*bonds[i]/m[i] and bead i+1 by +lam[i]*bonds[i]/m[i+1] as in cshake and crattle.
+tridcode = """
+    // solves sub[i]*x[i-1] + diag[i]*x[i] + sup[i]*x[i+1] = rhs[i] for x in LAM, n equations
+    CP1(0) = sup / diag;
+    LAM1(0) = rhs / diag;
+    for ( int i = 1; i < n; i++){
+        MAKEROW(i)
+        den = diag - sub*CP1(i-1);
+        CP1(i) = sup / den;
+        LAM1(i) = (rhs - sub*LAM1(i-1)) / den;
+    }
+    for ( int i = n-2; i >= 0; i--){
+        LAM1(i) -= CP1(i)*LAM1(i+1);
+    }
+"""
+
+def ctridshake(bonds, v_half, h, m, dsq, maxloop, numbeads, tol):
+    """SHAKE with Newton iterations on the tridiagonal constraint equations, same interface as cshake"""
+    loops = numpy.array([0])
+    n = numbeads - 1
+    lam = numpy.empty(n)
+    cp = numpy.empty(n)
+    code = """
+    #define S(i,k) (BONDS2(i,k) + h * (V_HALF2(i,k)-V_HALF2(i+1,k)))
+    #define SB(i,j) (S(i,0)*BONDS2(j,0) + S(i,1)*BONDS2(j,1) + S(i,2)*BONDS2(j,2))
+    // d|s_i|^2 / dlam = -2h (s_i.b_i (1/m_i + 1/m_i+1) lam_i - s_i.b_i-1 /m_i lam_i-1 - s_i.b_i+1 /m_i+1 lam_i+1)
+    #define MAKEROW(i) \
+        sub = -2.0*h*SB(i,i-1)/M1(i); \
+        diag = 2.0*h*SB(i,i)*(1.0/M1(i)+1.0/M1(i+1)); \
+        sup = (i < n-1) ? -2.0*h*SB(i,i+1)/M1(i+1) : 0.0; \
+        rhs = S(i,0)*S(i,0) + S(i,1)*S(i,1) + S(i,2)*S(i,2) - DSQ1(i);
+    double sub, diag, sup, rhs, den, err;
+    while (LOOPS1(0) < maxloop){
+        err = 0;
+        for ( int i = 0; i < n; i++){
+            rhs = S(i,0)*S(i,0) + S(i,1)*S(i,1) + S(i,2)*S(i,2) - DSQ1(i);
+            if (fabs(rhs) > err) err = fabs(rhs);
+        }
+        if (err < tol) break;
+        sup = (n > 1) ? -2.0*h*SB(0,1)/M1(1) : 0.0;
+        diag = 2.0*h*SB(0,0)*(1.0/M1(0)+1.0/M1(1));
+        rhs = S(0,0)*S(0,0) + S(0,1)*S(0,1) + S(0,2)*S(0,2) - DSQ1(0);
+        %s
+        for ( int i = 0; i < n; i++){
+            for ( int k = 0; k < 3; k++){
+                V_HALF2(i,k) -= LAM1(i)/M1(i)*BONDS2(i,k);
+                V_HALF2(i+1,k) += LAM1(i)/M1(i+1)*BONDS2(i,k);
+            }
+        }
+        LOOPS1(0)++;
+    }
+    """ % tridcode
+    info = kernels.inline(code, ['bonds', 'v_half', 'h', 'm', 'dsq', 'maxloop', 'n', 'tol', 'loops', 'lam', 'cp'], headers=['<math.h>', '<stdlib.h>'])
+    conv = True
+    if loops[0] == maxloop:
+        conv = False
+    return v_half, conv
+
+def ctridrattle(bonds, vel, m, dsq, maxloop, numbeads, tol):
+    """RATTLE as one exact solve of the tridiagonal constraint equations, same interface as crattle"""
+    n = numbeads - 1
+    lam = numpy.empty(n)
+    cp = numpy.empty(n)
+    code = """
+    #define BB(i,j) (BONDS2(i,0)*BONDS2(j,0) + BONDS2(i,1)*BONDS2(j,1) + BONDS2(i,2)*BONDS2(j,2))
+    #define MAKEROW(i) \
+        sub = -BB(i,i-1)/M1(i); \
+        diag = BB(i,i)*(1.0/M1(i)+1.0/M1(i+1)); \
+        sup = (i < n-1) ? -BB(i,i+1)/M1(i+1) : 0.0; \
+        rhs = BONDS2(i,0)*(VEL2(i,0)-VEL2(i+1,0)) + BONDS2(i,1)*(VEL2(i,1)-VEL2(i+1,1)) + BONDS2(i,2)*(VEL2(i,2)-VEL2(i+1,2));
+    double sub, diag, sup, rhs, den;
+    sup = (n > 1) ? -BB(0,1)/M1(1) : 0.0;
+    diag = BB(0,0)*(1.0/M1(0)+1.0/M1(1));
+    rhs = BONDS2(0,0)*(VEL2(0,0)-VEL2(1,0)) + BONDS2(0,1)*(VEL2(0,1)-VEL2(1,1)) + BONDS2(0,2)*(VEL2(0,2)-VEL2(1,2));
+    %s
+    for ( int i = 0; i < n; i++){
+        for ( int k = 0; k < 3; k++){
+            VEL2(i,k) -= LAM1(i)/M1(i)*BONDS2(i,k);
+            VEL2(i+1,k) += LAM1(i)/M1(i+1)*BONDS2(i,k);
+        }
+    }
+    """ % tridcode
+    info = kernels.inline(code, ['bonds', 'vel', 'm', 'dsq', 'n', 'lam', 'cp'], headers=['<math.h>', '<stdlib.h>'])
+    return vel, bool(numpy.all(numpy.isfinite(lam)))
     
     
     
@@ -16,19 +16,26 @@ class QSurfaceSimulation(SurfaceSimulation, QSimulation): # left to right, depth
     def __init__(self, name, outputdirectory, coord, temp, surf_coord, Qpin):
         self.Qpin = Qpin
         SurfaceSimulation.__init__(self, name, outputdirectory, coord, temp, surf_coord)
-        self.suffix = '%i_%2.2f' % (int(temp), Qpin)
+
+    def settemperature(self, temp):
+        SurfaceSimulation.settemperature(self, temp)
+        self.suffix = '%i_%2.2f' % (int(temp), self.Qpin)
 
     def setenergy(self):
         SurfaceSimulation.setenergy(self)
-        self.Q = energyfunc.nativecontact(self.r2, Simulation.nativeparam, Simulation.nsigma2) / Simulation.totnc
+        self.Q = self.ncount / float(Simulation.totnc)
         self.u0 += QSimulation.k_Qpin*(self.Q - self.Qpin)**2
 
-    def update_energy(self, torschange, angchange, dict):
+    def setterms(self):
+        SurfaceSimulation.setterms(self)
+        self.terms['umbrella'] = QSimulation.k_Qpin*(self.Q - self.Qpin)**2
+
+    def update_energy(self, torschange, angchange, dict, beadchange=None):
         QSimulation.k_Qpin = dict['k_Qpin']
         Simulation.nsigma2 = dict['nsigma2']
         Simulation.totnc = dict['totnc']
-        SurfaceSimulation.update_energy(self, torschange, angchange, dict)
-        self.newQ = energyfunc.nativecontact(self.r2new, Simulation.nativeparam, Simulation.nsigma2) / Simulation.totnc
+        SurfaceSimulation.update_energy(self, torschange, angchange, dict, beadchange)
+        self.newQ = self.newncount / float(Simulation.totnc)
         self.u1 += QSimulation.k_Qpin*(self.newQ - self.Qpin)**2
 
     def accept_state(self):
@@ -11,8 +11,8 @@ import cPickle
 def update_energy(self, torschange, angchange):
     self.newtorsE = energyfunc.ctorsionenergy(self.newcoord, self.torsE, Simulation.torsparam, torschange)
     self.newangE = energyfunc.cangleenergy(self.newcoord, self.angE, Simulation.angleparam, angchange)
-    self.newsurfE = energyfunc.csurfenergy(self.newcoord, SurfaceSimulation.surface, Simulation.numbeads, SurfaceSimulation.nspint, SurfaceSimulation.surfparam,SurfaceSimulation.scale)
-    self.r2new, self.u1 = energyfunc.cgetLJenergy(self.newcoord, Simulation.numint, Simulation.numbeads, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
+    self.newsurfE = numpy.sum(self.surfenergy(self.newcoord, numpy.arange(Simulation.numbeads)), axis=0)
+    self.r2new, self.u1 = energyfunc.cgetLJenergy(self.newcoord, Simulation.numint, Simulation.numbeads, Simulation.natpairs, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
     self.u1 += numpy.sum(self.newtorsE)+numpy.sum(self.newangE)+numpy.sum(self.newsurfE)
     self.u1 += energyfunc.umbrellaenergy(self.newcoord, self.z_pin, self.mass, self.totmass)
     return self
@@ -21,7 +21,7 @@ def save(self):
     index = self.move/Simulation.save
     self.energyarray[index] = self.u0
     self.surfE_array[index,:] = self.surfE
-    self.nc[index] = energyfunc.nativecontact(self.r2, Simulation.nativeparam, Simulation.nsigma2)
+    self.nc[index] = energyfunc.cnativecontact(self.coord, Simulation.natpairs, Simulation.nsigma2)
     self.z_array[index] = numpy.sum(self.mass*self.coord[:,2])/self.totmass
     if (Simulation.writetraj):
         f = open('%s/trajectory%i' %(self.out, int(self.T)), 'ab')
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+'''
+Compiles the C kernels ahead of time into the _gokernels extension module next to this file,
+so that simulations start without runtime weave compilation (see kernels.py)
+
+    buildkernels.py          builds _gokernels, needs scipy.weave and a C++ compiler
+    buildkernels.py --check  compares the NumPy kernels against the C kernels instead
+    buildkernels.py --time   times the incremental LJ update against the full recompute
+
+Every kernel is called through its python function on a random chain, with the argument types
+of simulateGO runs; kernels called with other types fall back to weave or NumPy at run time.
+'''
+import argparse
+import time
+import numpy
+from scipy.misc import comb
+import kernels
+import energyfunc
+import HMCforce
+import moveset
+import ensemble
+import surfacesimulation
+
+def chain(numbeads):
+    """Noisy helix with 3.8 A bonds"""
+    k = numpy.arange(numbeads)
+    coord = numpy.column_stack((2.3*numpy.cos(100*numpy.pi/180*k), 2.3*numpy.sin(100*numpy.pi/180*k), 1.5*k))
+    coord += numpy.random.normal(0, .3, coord.shape)
+    for i in range(1, numbeads):
+        bond = coord[i] - coord[i-1]
+        coord[i:] += bond*(3.8/numpy.sum(bond**2)**.5 - 1)
+    return coord
+
+def exercise(numbeads=20, seed=10):
+    """Calls every kernel once, returns [(call, outputs)]"""
+    numpy.random.seed(seed)
+    coord = chain(numbeads)
+    numint = int(numpy.around(comb(numbeads, 2)) - 2*(numbeads-2) - 1)
+    i, j = numpy.triu_indices(numbeads, 3)
+    native = numpy.sort(numpy.random.permutation(numint)[0:numint/4])
+    natpairs = numpy.column_stack((i[native], j[native]))
+    natparam = numpy.column_stack((numpy.random.uniform(.2, 1., len(native)), numpy.random.uniform(5., 7., len(native))))
+    nsigma2 = 1.2**2*natparam[:,1]**2
+    nonnatparam = numpy.random.uniform(1.5, 2.5, numbeads)
+    nnepsil = .0019872041*300
+    angleparam = numpy.column_stack((numpy.random.uniform(10, 40, numbeads-2), numpy.random.uniform(1.5, 2.2, numbeads-2)))
+    torsparam = numpy.column_stack((numpy.random.uniform(0, 1, 4*(numbeads-3)), numpy.tile([1., 2., 3., 4.], numbeads-3), numpy.random.uniform(0, 2*numpy.pi, 4*(numbeads-3))))
+    mass = numpy.random.uniform(80, 160, numbeads)
+    cutoff = 12.
+    m = int(numpy.random.randint(2, numbeads-3))
+    rand = float(numpy.random.random())
+    theta = float(numpy.random.normal(0, .3))
+    change = moveset.movedbeads(numbeads, m, rand)
+    nlist = energyfunc.getneighborlist(coord, numint, numbeads, natpairs, cutoff + 3.)
+    newcoord = moveset.caxistorsion(coord, m, rand, theta)
+    bonds = coord[0:numbeads-1,:] - coord[1:numbeads,:]
+    d2 = numpy.sum(bonds**2, axis=1)
+    d = d2**.5
+    vel = numpy.random.normal(0, .5, (numbeads,3))
+
+    surface = surfacesimulation.getsurf(60, 60, 4)
+    nsurf = len(surface)
+    ep, sig = .765, 6.9
+    scale = numpy.random.uniform(.2, 1., numbeads)
+    param = numpy.empty((nsurf*numbeads,2))
+    param[:,0] = numpy.tile(scale, nsurf)
+    param[:,1] = ep*(sig/20.)**12 + param[:,0]*ep*(12*(sig/20.)**12 - 18*(sig/20.)**10 + 4*(sig/20.)**6)
+    surfparam = (ep, sig, param)
+    oldparam = numpy.column_stack((numpy.random.uniform(.2, 1., nsurf*numbeads), numpy.random.uniform(5., 7., nsurf*numbeads), numpy.random.uniform(0, .1, nsurf*numbeads)))
+    prot = coord - numpy.mean(coord, axis=0) + numpy.array([0, 0, 12.])
+    grid, gridparam = surfacesimulation.getsurfgrid(surface, 4, ep, sig, dxy=1., dz=1.)
+
+    r2, E, _ = energyfunc.cgetLJenergy_withE(coord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)
+    r2l, El, _ = energyfunc.cgetLJenergy_list(coord, nlist, natparam, nonnatparam, nnepsil, cutoff)
+    r2u, Eu, r2lu, Elu = r2.copy(), E.copy(), r2l.copy(), El.copy() # updated in place by the incremental updaters
+    r2s, Es = energyfunc.csurfenergy_withr2(prot, surface, numbeads, nsurf*numbeads, oldparam)
+    densenat = numpy.zeros((numint,3)) # dense [native, epsilon, sigma] and [nonnative, sigma] of cLJenergy
+    densenat[native] = numpy.column_stack((numpy.ones(len(native)), natparam))
+    densenonnat = numpy.column_stack((densenat[:,0] == 0, nonnatparam[i] + nonnatparam[j]))
+    coords = numpy.array([coord, newcoord, coord[::-1].copy()])
+    R = len(coords)
+    calls = [
+        ('cgetLJr2', lambda: energyfunc.cgetLJr2(coord, numint, numbeads)),
+        ('cgetforcer', lambda: energyfunc.cgetforcer(coord, numint, numbeads)),
+        ('cLJenergy', lambda: energyfunc.cLJenergy(r2, densenat, densenonnat, nnepsil)),
+        ('cgetLJenergy', lambda: energyfunc.cgetLJenergy(coord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)),
+        ('cgetLJenergy_withE', lambda: energyfunc.cgetLJenergy_withE(coord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)),
+        ('cgetLJenergy_updater', lambda: energyfunc.cgetLJenergy_updater(newcoord, numbeads, energyfunc.nativelabels(natpairs, numint, numbeads), natparam, nonnatparam, nnepsil, nsigma2, r2u, Eu, change)[0:2] + (r2u, Eu)),
+        ('cgetLJenergy_list', lambda: energyfunc.cgetLJenergy_list(coord, nlist, natparam, nonnatparam, nnepsil, cutoff)),
+        ('cgetLJenergy_listupdater', lambda: energyfunc.cgetLJenergy_listupdater(newcoord, nlist, natparam, nonnatparam, nnepsil, cutoff, nsigma2, r2lu, Elu, change)[0:2] + (r2lu, Elu)),
+        ('cangleenergy', lambda: energyfunc.cangleenergy(newcoord, numpy.zeros(numbeads-2), angleparam, numpy.arange(numbeads-2))),
+        ('cangleenergy empty', lambda: energyfunc.cangleenergy(newcoord, numpy.zeros(numbeads-2), angleparam, numpy.array([]))),
+        ('ctorsionenergy', lambda: energyfunc.ctorsionenergy(newcoord, numpy.zeros(numbeads-3), torsparam, numpy.arange(numbeads-3))),
+        ('ctorsionenergy empty', lambda: energyfunc.ctorsionenergy(newcoord, numpy.zeros(numbeads-3), torsparam, numpy.array([]))),
+        ('cnativecontact', lambda: energyfunc.cnativecontact(coord, natpairs, nsigma2)),
+        ('cdihedral', lambda: energyfunc.cdihedral(coord)),
+        ('cgetr2surf', lambda: energyfunc.cgetr2surf(prot, surface, numbeads, nsurf*numbeads)),
+        ('csurfenergy', lambda: energyfunc.csurfenergy(prot, surface, numbeads, nsurf*numbeads, surfparam, None)),
+        ('csurfenergy_old', lambda: energyfunc.csurfenergy_old(prot, surface, numbeads, nsurf*numbeads, oldparam, .8)),
+        ('csurfenergy_withr2', lambda: energyfunc.csurfenergy_withr2(prot, surface, numbeads, nsurf*numbeads, oldparam)),
+        ('csurfenergy_updater2', lambda: energyfunc.csurfenergy_updater2(prot + numpy.array([0, 0, 1.]), surface, numbeads, nsurf*numbeads, oldparam, r2s, Es.copy(), numpy.arange(0, nsurf*numbeads, 7))),
+        ('csurfperiodic', lambda: energyfunc.csurfperiodic(prot[0:4] - numpy.array([gridparam[0], gridparam[1], 0.]), 4, ep, sig)),
+        ('csurfenergy_beads', lambda: energyfunc.csurfenergy_beads(prot, surface, numbeads, surfparam, numpy.arange(numbeads))),
+        ('csurfenergy_gridbeads', lambda: energyfunc.csurfenergy_gridbeads(prot, numpy.arange(numbeads), grid, gridparam, scale)),
+        ('cdihedforces', lambda: HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads)),
+        ('cangleforces', lambda: HMCforce.cangleforces(coord, angleparam, bonds, d, numbeads)),
+        ('cnonbondedforces', lambda: HMCforce.cnonbondedforces(coord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)),
+        ('cnonbondedforces_list', lambda: HMCforce.cnonbondedforces_list(coord, nlist, natparam, nonnatparam, nnepsil, cutoff)),
+        ('cgetforces', lambda: HMCforce.cgetforces(coord, bonds, d2, d, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam)[0]),
+        ('cgetforces energies', lambda: HMCforce.cgetforces(coord, bonds, d2, d, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, True)),
+        ('cgetforces_list', lambda: HMCforce.cgetforces_list(coord, bonds, d2, d, nlist, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff)[0]),
+        ('cgetforces_list energies', lambda: HMCforce.cgetforces_list(coord, bonds, d2, d, nlist, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, True)),
+        ('cgetsurfforce', lambda: HMCforce.cgetsurfforce(prot, surface, nsurf*numbeads, numbeads, surfparam, None)),
+        ('cgetsurfforce_old', lambda: HMCforce.cgetsurfforce_old(prot, surface, nsurf*numbeads, numbeads, oldparam, .8)),
+        ('cgetsurfforce_grid', lambda: HMCforce.cgetsurfforce_grid(prot, numbeads, grid, gridparam, scale)),
+        ('cshake', lambda: HMCforce.cshake(bonds, vel.copy(), .01, mass, d2, 1000, numbeads, 1e-8)),
+        ('crattle', lambda: HMCforce.crattle(bonds, vel.copy(), mass, d2, 1000, numbeads, 1e-8)),
+        ('ctridshake', lambda: HMCforce.ctridshake(bonds, vel.copy(), .01, mass, d2, 1000, numbeads, 1e-8)),
+        ('ctridrattle', lambda: HMCforce.ctridrattle(bonds, vel.copy(), mass, d2, 1000, numbeads, 1e-8)),
+        ('cglobalcrank', lambda: moveset.cglobalcrank(coord, numpy.random.normal(0, .1, numbeads-2))),
+        ('caxistorsion', lambda: moveset.caxistorsion(coord, m, rand, theta)),
+        ('caxistorsion int', lambda: moveset.caxistorsion(coord, m, 1, theta)),
+        ('canglebend', lambda: moveset.canglebend(coord, m, rand, theta)),
+        ('cparrot', lambda: moveset.cparrot(coord, m, rand, theta)[0:2]),
+        ('cframeenergy', lambda: energyfunc.cframeenergy(coords, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, 0., nsigma2)),
+        ('cframeenergy cutoff', lambda: energyfunc.cframeenergy(coords, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, nsigma2)),
+        ('cmove', lambda: ensemble.cmove(coords, numpy.arange(R), numpy.array([m]*R), numpy.random.random(R), numpy.random.normal(0, .3, (R, numbeads-2)))),
+        ]
+    results = []
+    for k, (call, f) in enumerate(calls):
+        numpy.random.seed(seed + k) # same draws inside the kernels on every backend
+        results.append((call, f()))
+    return results
+
+def flatten(out):
+    if isinstance(out, (tuple, list)):
+        return numpy.concatenate([flatten(o) for o in out])
+    return numpy.ravel(numpy.asarray(out, dtype=float))
+
+def check():
+    """Largest relative difference between the NumPy and C kernels"""
+    kernels.backend = 'weave'
+    c = exercise()
+    kernels.backend = 'numpy'
+    py = exercise()
+    worst = 0.
+    for (call, a), (_, b) in zip(c, py):
+        a, b = flatten(a), flatten(b)
+        err = numpy.max(numpy.abs(a - b)/(numpy.abs(a) + 1e-8)) if len(a) else 0.
+        worst = max(worst, err)
+        print '%-28s %.2e' % (call, err)
+    return worst
+
+def timeupdate(numbeads=369, nmoves=200, seed=10):
+    """Milliseconds per axis torsion of the incremental LJ update (half of the moves rejected and
+    undone) and of the full recompute with the native contact count, for moves about random beads
+    and about beads near the ends of the chain"""
+    numpy.random.seed(seed)
+    coord = chain(numbeads)
+    numint = int(numpy.around(comb(numbeads, 2)) - 2*(numbeads-2) - 1)
+    i, j = numpy.triu_indices(numbeads, 3)
+    native = numpy.sort(numpy.random.permutation(numint)[0:numint/20])
+    natpairs = numpy.column_stack((i[native], j[native]))
+    natparam = numpy.column_stack((numpy.random.uniform(.2, 1., len(native)), numpy.random.uniform(5., 7., len(native))))
+    nsigma2 = 1.2**2*natparam[:,1]**2
+    nonnatparam = numpy.random.uniform(1.5, 2.5, numbeads)
+    nnepsil = .0019872041*300
+    natlabels = energyfunc.nativelabels(natpairs, numint, numbeads)
+    r2, E, _ = energyfunc.cgetLJenergy_withE(coord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)
+    for name, beads in [('random bead', numpy.arange(2, numbeads-3)), ('10 end beads', numpy.r_[2:12, numbeads-13:numbeads-3])]:
+        m = numpy.random.choice(beads, nmoves)
+        rand = numpy.random.random(nmoves)
+        moves = [(moveset.caxistorsion(coord, m[k], rand[k], .1), moveset.movedbeads(numbeads, m[k], rand[k])) for k in range(nmoves)]
+        t = time.time()
+        for k, (newcoord, change) in enumerate(moves):
+            undo = energyfunc.cgetLJenergy_updater(newcoord, numbeads, natlabels, natparam, nonnatparam, nnepsil, nsigma2, r2, E, change)[2]
+            if k % 2:
+                energyfunc.undoLJ(r2, E, undo)
+        update = (time.time() - t)/nmoves*1e3
+        t = time.time()
+        for newcoord, change in moves:
+            energyfunc.cgetLJenergy_withE(newcoord, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil)
+            energyfunc.cnativecontact(newcoord, natpairs, nsigma2)
+        full = (time.time() - t)/nmoves*1e3
+        print '%-14s update %.4f ms  full %.4f ms  speedup %.1fx' % (name, update, full, full/update)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the kernels ahead of time')
+    parser.add_argument('--check', action='store_true', default=False, help='compare the NumPy kernels against the C kernels (default: False)')
+    parser.add_argument('--time', type=int, nargs='?', const=369, default=None, metavar='NUMBEADS', help='time the incremental LJ update against the full recompute on a chain of NUMBEADS beads (default: 369)')
+    args = parser.parse_args()
+    if args.time:
+        timeupdate(args.time)
+        return
+    if args.check:
+        print 'largest relative difference %.2e' % check()
+        return
+    kernels.backend = 'weave'
+    exercise()
+    kernels.build()
+    print 'compiled %i kernels' % len(kernels.catalog)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
-from scipy import weave
+import os
+import kernels
 import numpy
 import pdb
 #==========================================
 # PARAMETER READ IN METHODS
 #==========================================
 
+hydropathyfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inputs', 'hydropathy.txt')
+
 def getangleparam(paramfile, numbeads):
     f = open(paramfile, 'r')
     param = numpy.empty((numbeads-2, 2))
@@ -110,10 +113,65 @@ def getnativefix_n(paramfile, numint, numbeads):
             break
         if "G" in line:
             [i, j, ep, sig] = [int(line[1:4]), int(line[9:12]), float(line[19:28]), float(line[32:-1])]
-            intindex = numpy.sum(numbeads-numpy.arange(1,i)) + (j-i) - 1 - 2 * i
+            intindex = (i-1)*numbeads - (i-1)*i/2 + (j-i) - 1 - 2 * i
             param[intindex,:] = numpy.array([1,-ep,sig])
     return param
 
+def getLJparam(paramfile, numbeads):
+    """Returns the nonnative sigma of every bead, sigma_ij = sigma_i + sigma_j, and the nonnative epsilon"""
+    f = open(paramfile, 'r')
+    param = numpy.empty(numbeads)
+    while 1:
+        line = f.readline()
+        if "NONBONDED" in line:
+            f.readline() # two lines between header and parameters
+            f.readline()
+            break
+    for i in xrange(numbeads):
+        line = f.readline()
+        epsil = -float(line[14:23]) #somewhat hardcoded
+        param[i] = float(line[25:33])
+    f.close()
+    return [param, epsil]
+
+def getnativelist(paramfile):
+    """
+    Returns the native pairs as a nnat x 2 array of bead indices (i < j, sorted)
+    and their LJ parameters as a nnat x 2 array: [native epsilon, native sigma]
+    """
+    pairs = []
+    param = []
+    f = open(paramfile, 'r')
+    while 1:
+        line = f.readline()
+        if "NBFIX" in line:
+            break
+    while 1:
+        line = f.readline()
+        if not line:
+            break
+        if "G" in line:
+            [i, j, ep, sig] = [int(line[1:4]), int(line[9:12]), float(line[19:28]), float(line[32:-1])]
+            pairs.append([min(i,j)-1, max(i,j)-1])
+            param.append([-ep, sig])
+    f.close()
+    pairs = numpy.array(pairs, dtype=int).reshape(-1,2)
+    param = numpy.array(param).reshape(-1,2)
+    order = numpy.lexsort((pairs[:,1], pairs[:,0]))
+    return pairs[order], param[order]
+
+def nativeindex(natpairs, numbeads):
+    """Returns the interaction index (into numint-long arrays) of every native pair"""
+    i = natpairs[:,0]
+    j = natpairs[:,1]
+    return i*(numbeads-3) - i*(i-1)/2 + j - i - 3
+
+def nativelabels(natpairs, numint, numbeads):
+    """Returns the native index (into natpairs/nativeparam) of every interaction, -1 for nonnative ones"""
+    labels = -numpy.ones(numint, dtype=int)
+    labels[nativeindex(natpairs, numbeads)] = numpy.arange(len(natpairs))
+    return labels
+
 #def getsurfparam(numint):
 #    ep = numpy.random.random(numint)
 #    sig = numpy.random.normal(9.,1.,numint)
@@ -168,10 +226,11 @@ def getindex(res):
 	else:
 		print res
 
-def getsurfparam(file, spfile, numbeads, nsurf, numint, lam):
+def getsurfparam(file, spfile, numbeads, nsurf, numint, lam, hydrofile=None):
     """
 	Gets all surface-protein interaction parameters
 		Needs original .pdb file of protein to get sequence of residues
+		and the hydropathy index of every residue type (default: inputs/hydropathy.txt)
     
     Current 12-6, V = e((s/r)^12 - 2*lam*Xi*(s/r)^6) + V(cutoff)
         e:   average well depth for all native contacts processed
@@ -185,6 +244,11 @@ def getsurfparam(file, spfile, numbeads, nsurf, numint, lam):
         surfparam, nint x 2 array: (attractive term scaling, cutoff value)
     """ 
     assert((numint == nsurf * numbeads))
+    (ep, sig) = getsurfepsig(spfile)
+    return makesurfparam(ep, sig, gethydropathy(file, numbeads, hydrofile), nsurf, lam)
+
+def getsurfepsig(spfile):
+    """Average well depth and distance of the native contacts in spfile, used for the surface"""
     try:
         (ep_all,sig_all) = numpy.load(spfile)
         ep = -numpy.mean(ep_all[~numpy.isnan(ep_all[0:20,0:20])])
@@ -193,8 +257,10 @@ def getsurfparam(file, spfile, numbeads, nsurf, numint, lam):
         print "Could not find surface force field files"
         ep = .76506313905088763
         sig = 6.8997611300445971
+    return (ep, sig)
 
-	# get sequence of residues
+def gethydropathy(file, numbeads, hydrofile=None):
+    """Hydropathy index of every bead from the SEQRES records of the original .pdb file"""
     f = open(file, 'r')
     missingres = [] # residues in SEQRES but not resolved
     res = []
@@ -210,16 +276,17 @@ def getsurfparam(file, spfile, numbeads, nsurf, numint, lam):
 			words = line.split(' ')
 			words = [x for x in words if x]
 			res.extend(words[4:-1])
+    f.close()
     res = [res[i] for i in range(len(res)) if i not in missingres]
     assert(len(res)==numbeads)
-    param = numpy.empty((numint,2))
     index = [getindex(residue) for residue in res]
-    scale = []
-    hydropathy = numpy.loadtxt('/home/edz3fz/proteinmontecarlo/hydropathy.txt')
-    for i in index:
-        scale.append(lam*(hydropathy[i]-.4)+.4)
-    scale = scale * nsurf
-    param[:,0] = scale
+    hydropathy = numpy.loadtxt(hydrofile or hydropathyfile)
+    return hydropathy[index]
+
+def makesurfparam(ep, sig, hydropathy, nsurf, lam):
+    """Surface parameters (see getsurfparam) from the hydropathy index of every bead"""
+    param = numpy.empty((nsurf*len(hydropathy),2))
+    param[:,0] = numpy.tile(lam*(hydropathy-.4)+.4, nsurf)
     param[:,1] = ep*(sig/20.)**12 + param[:,0]*ep*(12*(sig/20.)**12 - 18*(sig/20.)**10 + 4*(sig/20.)**6)
     return (ep,sig,param)
 
@@ -300,7 +367,7 @@ def cgetr2surf(prot_coord, surf_coord, numbeads, numint):
         r2_array[i] = x*x + y*y + z*z;
     }
     """
-    info = weave.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
     return r2_array
 
 def surfenergy(prot, surf, numbeads, numint, param):
@@ -341,7 +408,150 @@ def csurfenergy(prot_coord, surf_coord, numbeads, numint, param,shit):
 	}
     }
     """
-    info = weave.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'energy','ep_in','sig_in','scale'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'energy','ep_in','sig_in','scale'], headers=['<math.h>', '<stdlib.h>'])
+    return energy
+
+def csurfperiodic(points, spacing, ep, sig):
+    """
+    Direct sum of the surface potential of the periodic hexagonal lattice of surfacesimulation.getsurf
+    Sites are at (i*a, j*b, 0) and (i*a + a/2, j*b + b/2, 0), a = spacing, b = spacing*3**.5,
+    points are given relative to the lattice origin
+
+    The surface energy of a bead is V = A + scale*B, with the cutoff shift of getsurfparam folded in:
+        A = ep((s/r)^12 - (s/rc)^12)
+        B = ep(12(s/r)^12 - 18(s/r)^10 + 4(s/r)^6) - ep(12(s/rc)^12 - 18(s/rc)^10 + 4(s/rc)^6)
+
+    Returns:
+        npoints x 8 array: [A, B, dA/dx, dA/dy, dA/dz, dB/dx, dB/dy, dB/dz]
+    """
+    n = len(points)
+    param = numpy.zeros((n,8))
+    code = """
+    double a = spacing, b = spacing*sqrt(3.);
+    double c = sig*sig/400., c6 = c*c*c, c12 = c6*c6;
+    double gc = 12*c12 - 18*c6*c*c + 4*c6;
+    int nx = (int)(20/a) + 2, ny = (int)(20/b) + 2;
+    double x0, y0, z, x, y, r2, e, e6, e12, dA, dB;
+    for ( int p = 0; p < n; p++){
+        x0 = POINTS2(p,0) - a*floor(POINTS2(p,0)/a);
+        y0 = POINTS2(p,1) - b*floor(POINTS2(p,1)/b);
+        z = POINTS2(p,2);
+        for ( int i = -nx; i <= nx; i++){
+            for ( int j = -ny; j <= ny; j++){
+                for ( int s = 0; s < 2; s++){
+                    x = x0 - i*a - s*a/2;
+                    y = y0 - j*b - s*b/2;
+                    r2 = x*x + y*y + z*z;
+                    if (r2 < 400){
+                        e = sig*sig/r2;
+                        e6 = e*e*e;
+                        e12 = e6*e6;
+                        PARAM2(p,0) += ep*(e12 - c12);
+                        PARAM2(p,1) += ep*(12*e12 - 18*e6*e*e + 4*e6 - gc);
+                        dA = -12*ep*e12/r2;
+                        dB = ep*(-144*e12 + 180*e6*e*e - 24*e6)/r2;
+                        PARAM2(p,2) += dA*x; PARAM2(p,3) += dA*y; PARAM2(p,4) += dA*z;
+                        PARAM2(p,5) += dB*x; PARAM2(p,6) += dB*y; PARAM2(p,7) += dB*z;
+                    }
+                }
+            }
+        }
+    }
+    """
+    info = kernels.inline(code, ['points', 'n', 'spacing', 'ep', 'sig', 'param'], headers=['<math.h>', '<stdlib.h>'])
+    return param
+
+def csurfenergy_beads(prot_coord, surf_coord, numbeads, param, beads):
+    """
+    Same as csurfenergy, but only for the given beads and keeping the energy of every bead
+
+    Returns:
+        len(beads) x 2 array: [shifted repulsive term, attractive term] of every bead
+    """
+    ep_in = param[0]
+    sig_in = param[1]
+    scale = param[2]
+    nsurf = len(surf_coord)
+    n = len(beads)
+    energy = numpy.zeros((n,2))
+    code = """
+    double ep = ep_in;
+    double sig = sig_in;
+    double x, y, z, r2, e, e6, e12;
+    int i, k;
+    for (int l = 0; l < n; l++){
+        i = BEADS1(l);
+        for (int s = 0; s < nsurf; s++){
+            x = SURF_COORD2(s,0) - PROT_COORD2(i,0);
+            y = SURF_COORD2(s,1) - PROT_COORD2(i,1);
+            z = SURF_COORD2(s,2) - PROT_COORD2(i,2);
+            r2 = x*x + y*y + z*z;
+	    if (r2<400){
+                k = s*numbeads + i;
+                e = sig*sig/r2;
+                e6 = e*e*e;
+                e12 = e6*e6;
+                ENERGY2(l,0) += ep*e12-SCALE2(k,1);
+                ENERGY2(l,1) += SCALE2(k,0)*ep*(12*e12-18*e6*e*e+4*e6);
+	    }
+        }
+    }
+    """
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'nsurf', 'numbeads', 'n', 'beads', 'energy', 'ep_in', 'sig_in', 'scale'], headers=['<math.h>', '<stdlib.h>'])
+    return energy
+
+def csurfenergy_grid(prot_coord, numbeads, grid, gridparam, scale):
+    """
+    Same as csurfenergy, but interpolates the tabulated potential of surfacesimulation.getsurfgrid
+    (bilinear in x and y, cubic Hermite in z); beads below the grid are summed directly
+
+        scale: attractive term scaling of every bead
+
+    Returns:
+        energy[0]: shifted repulsive term, energy[1]: shifted attractive term
+    """
+    return numpy.sum(csurfenergy_gridbeads(prot_coord, numpy.arange(numbeads), grid, gridparam, scale), axis=0)
+
+def csurfenergy_gridbeads(prot_coord, beads, grid, gridparam, scale):
+    """Same as csurfenergy_grid, but only for the given beads and keeping the energy of every bead"""
+    n = len(beads)
+    energy = numpy.zeros((n,2))
+    code = """
+    int nx = Ngrid[0], ny = Ngrid[1], nz = Ngrid[2];
+    double x0 = GRIDPARAM1(0), y0 = GRIDPARAM1(1), zmin = GRIDPARAM1(2);
+    double dx = GRIDPARAM1(3), dy = GRIDPARAM1(4), dz = GRIDPARAM1(5);
+    double zmax = zmin + (nz-1)*dz;
+    int i, ix, iy, iz, ix1, iy1;
+    double u, v, w, t, h00, h10, h01, h11, f[2][2][2];
+    for ( int l = 0; l < n; l++){
+        i = BEADS1(l);
+        if (PROT_COORD2(i,2) < zmin || PROT_COORD2(i,2) >= zmax) continue;
+        u = (PROT_COORD2(i,0) - x0)/dx;
+        u -= nx*floor(u/nx);
+        ix = (int)u; u -= ix; ix %= nx; ix1 = (ix+1) % nx;
+        v = (PROT_COORD2(i,1) - y0)/dy;
+        v -= ny*floor(v/ny);
+        iy = (int)v; v -= iy; iy %= ny; iy1 = (iy+1) % ny;
+        w = (PROT_COORD2(i,2) - zmin)/dz;
+        iz = (int)w; t = w - iz;
+        h00 = (1+2*t)*(1-t)*(1-t); h10 = t*(1-t)*(1-t)*dz;
+        h01 = t*t*(3-2*t); h11 = t*t*(t-1)*dz;
+        for ( int m = 0; m < 2; m++){
+            f[m][0][0] = h00*GRID4(ix,iy,iz,m) + h10*GRID4(ix,iy,iz,m+2) + h01*GRID4(ix,iy,iz+1,m) + h11*GRID4(ix,iy,iz+1,m+2);
+            f[m][1][0] = h00*GRID4(ix1,iy,iz,m) + h10*GRID4(ix1,iy,iz,m+2) + h01*GRID4(ix1,iy,iz+1,m) + h11*GRID4(ix1,iy,iz+1,m+2);
+            f[m][0][1] = h00*GRID4(ix,iy1,iz,m) + h10*GRID4(ix,iy1,iz,m+2) + h01*GRID4(ix,iy1,iz+1,m) + h11*GRID4(ix,iy1,iz+1,m+2);
+            f[m][1][1] = h00*GRID4(ix1,iy1,iz,m) + h10*GRID4(ix1,iy1,iz,m+2) + h01*GRID4(ix1,iy1,iz+1,m) + h11*GRID4(ix1,iy1,iz+1,m+2);
+        }
+        ENERGY2(l,0) = (1-u)*(1-v)*f[0][0][0] + u*(1-v)*f[0][1][0] + (1-u)*v*f[0][0][1] + u*v*f[0][1][1];
+        ENERGY2(l,1) = SCALE1(i)*((1-u)*(1-v)*f[1][0][0] + u*(1-v)*f[1][1][0] + (1-u)*v*f[1][0][1] + u*v*f[1][1][1]);
+    }
+    """
+    info = kernels.inline(code, ['prot_coord', 'n', 'beads', 'grid', 'gridparam', 'scale', 'energy'], headers=['<math.h>', '<stdlib.h>'])
+    low = prot_coord[beads,2] < gridparam[2]
+    if numpy.any(low):
+        param = csurfperiodic(prot_coord[beads[low]] - numpy.array([gridparam[0], gridparam[1], 0.]), gridparam[6], gridparam[7], gridparam[8])
+        energy[low,0] = param[:,0]
+        energy[low,1] = scale[beads[low]]*param[:,1]
     return energy
 
 def surfenergy_old(r2, param):
@@ -370,7 +580,7 @@ def csurfenergy_old(prot_coord, surf_coord, numbeads, numint, param, scale):
 	}
     }
     """
-    info = weave.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'energy','scale'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'energy','scale'], headers=['<math.h>', '<stdlib.h>'])
     return energy
  
 def csurfenergy_withr2(prot_coord, surf_coord, numbeads, numint, param):
@@ -390,7 +600,7 @@ def csurfenergy_withr2(prot_coord, surf_coord, numbeads, numint, param):
         ENERGY1(i % numbeads) += e;
     }
     """
-    info = weave.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'energy', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'energy', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
     return r2_array, energy
     
 def csurfenergy_updater2(prot_coord, surf_coord, numbeads, numint, param, r2old, surfEnew, change):
@@ -412,7 +622,7 @@ def csurfenergy_updater2(prot_coord, surf_coord, numbeads, numint, param, r2old,
         SURFENEW1(i % numbeads) += e;
     }
     """
-    info = weave.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'change', 'surfEnew', 'r2new', 'n'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['prot_coord', 'surf_coord', 'numint', 'numbeads', 'param', 'change', 'surfEnew', 'r2new', 'n'], headers=['<math.h>', '<stdlib.h>'])
     return r2new, surfEnew
 
 def getforcer(mpos, numint, numbeads):
@@ -450,7 +660,7 @@ def cgetLJr2(mpos, numint, numbeads):
 	}
     }
     """
-    info = weave.inline(code, ['mpos','numint','numbeads','r2array'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['mpos','numint','numbeads','r2array'], headers=['<math.h>', '<stdlib.h>'])
     return r2array
 
 def cgetforcer(mpos, numint, numbeads):
@@ -467,7 +677,7 @@ def cgetforcer(mpos, numint, numbeads):
 	}
     }
     """
-    info = weave.inline(code, ['mpos','numint','numbeads','r2array'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['mpos','numint','numbeads','r2array'], headers=['<math.h>', '<stdlib.h>'])
     return r2array
 
 #speed up version
@@ -510,14 +720,15 @@ def cLJenergy(r2, natparam, nonnatparam, nnepsil):
         ENERGY1(0) += (nE + nnE);
     }
     """
-    info = weave.inline(code, ['r2','natparam','numint','energy','nonnatparam','nnepsil'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['r2','natparam','numint','energy','nonnatparam','nnepsil'], headers=['<math.h>', '<stdlib.h>'])
     return energy[0]
 
-def cgetLJenergy(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
+def cgetLJenergy(mpos, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil):
     energy = numpy.array([0.0])
     r2_array = numpy.empty(numint)
+    nnat = len(natpairs)
     code = """
-    int k = 0;
+    int k = 0, p = 0;
     double x, y, z, nE, nE6, nnE;
     for ( int i = 0; i < numbeads; i++){
         for ( int j = i+3; j < numbeads; j++){
@@ -525,20 +736,278 @@ def cgetLJenergy(mpos, numint, numbeads, natparam, nonnatparam, nnepsil):
 	    y = MPOS2(i,1) - MPOS2(j,1);
 	    z = MPOS2(i,2) - MPOS2(j,2);
 	    R2_ARRAY1(k) = x*x + y*y + z*z;
-            nE = NATPARAM2(k,0)*NATPARAM2(k,2)*NATPARAM2(k,2)/R2_ARRAY1(k);
-            nE6 = nE*nE*nE;
-            nE = NATPARAM2(k,1)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
-            nnE = NONNATPARAM2(k,0)*NONNATPARAM2(k,1)*NONNATPARAM2(k,1)/R2_ARRAY1(k);
-            nnE = nnE*nnE;
-            nnE = nnepsil*nnE*nnE*nnE;
-            ENERGY1(0) += (nE + nnE);
+            if (p < nnat && NATPAIRS2(p,0) == i && NATPAIRS2(p,1) == j){
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/R2_ARRAY1(k);
+                nE6 = nE*nE*nE;
+                ENERGY1(0) += NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                p++;
+            }
+            else{
+                nnE = NONNATPARAM1(i) + NONNATPARAM1(j);
+                nnE = nnE*nnE/R2_ARRAY1(k);
+                nnE = nnE*nnE;
+                ENERGY1(0) += nnepsil*nnE*nnE*nnE;
+            }
             k++;
 	}
     }
     """
-    info = weave.inline(code, ['mpos', 'numint', 'numbeads', 'natparam', 'energy', 'nonnatparam', 'nnepsil', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['mpos', 'numbeads', 'nnat', 'natpairs', 'natparam', 'energy', 'nonnatparam', 'nnepsil', 'r2_array'], headers=['<math.h>', '<stdlib.h>'])
     return r2_array, energy[0]
 
+def cgetLJenergy_withE(mpos, numint, numbeads, natpairs, natparam, nonnatparam, nnepsil):
+    """Same as cgetLJenergy, but also keeps track of the energy of every interaction"""
+    energy = numpy.array([0.0])
+    r2_array = numpy.empty(numint)
+    E_array = numpy.empty(numint)
+    nnat = len(natpairs)
+    code = """
+    int k = 0, p = 0;
+    double x, y, z, nE, nE6, nnE;
+    for ( int i = 0; i < numbeads; i++){
+        for ( int j = i+3; j < numbeads; j++){
+	    x = MPOS2(i,0) - MPOS2(j,0);
+	    y = MPOS2(i,1) - MPOS2(j,1);
+	    z = MPOS2(i,2) - MPOS2(j,2);
+	    R2_ARRAY1(k) = x*x + y*y + z*z;
+            if (p < nnat && NATPAIRS2(p,0) == i && NATPAIRS2(p,1) == j){
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/R2_ARRAY1(k);
+                nE6 = nE*nE*nE;
+                E_ARRAY1(k) = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                p++;
+            }
+            else{
+                nnE = NONNATPARAM1(i) + NONNATPARAM1(j);
+                nnE = nnE*nnE/R2_ARRAY1(k);
+                nnE = nnE*nnE;
+                E_ARRAY1(k) = nnepsil*nnE*nnE*nnE;
+            }
+            ENERGY1(0) += E_ARRAY1(k);
+            k++;
+	}
+    }
+    """
+    info = kernels.inline(code, ['mpos', 'numbeads', 'nnat', 'natpairs', 'natparam', 'energy', 'nonnatparam', 'nnepsil', 'r2_array', 'E_array'], headers=['<math.h>', '<stdlib.h>'])
+    return r2_array, E_array, energy[0]
+
+def cgetLJenergy_updater(mpos, numbeads, natlabels, natparam, nonnatparam, nnepsil, nsigma2, r2, E, change):
+    """
+    Incremental version of cgetLJenergy_withE for moves that displace rigid groups of beads,
+    r2 and E are updated in place
+
+        natlabels: native index of every interaction, -1 for nonnative ones (see nativelabels)
+        change: label of the rigid group each bead belongs to; only interactions between
+                beads with different labels are recomputed
+
+    The largest group is taken as fixed, so only the pairs of the other beads are visited.
+
+    Returns:
+        the change in the total LJ energy, the change in the number of native contacts
+        (see cnativecontact) and the undo list of undoLJ for a rejected move
+    """
+    undok, undor2, undoE = undobuffer(len(r2))
+    dE = numpy.array([0.0])
+    dnc = numpy.array([0, 0]) # change in native contacts, length of the undo list
+    code = """
+    int a, b, k, p, q, nb, moveda, row, fixed = 0, nmoved = 0, n = 0, dn = 0;
+    double x, y, z, nE, nE6, nnE, e, r2new, de = 0;
+    // group labels are below numbeads; the array counts the beads of every group, then lists the moved beads
+    int *moved = (int*) calloc(numbeads, sizeof(int));
+    for ( a = 0; a < numbeads; a++)
+        moved[CHANGE1(a)]++;
+    for ( a = 1; a < numbeads; a++)
+        if (moved[a] > moved[fixed]) fixed = a;
+    for ( a = 0; a < numbeads; a++)
+        if (CHANGE1(a) != fixed) moved[nmoved++] = a;
+    // row by row in the order of the interaction arrays: all later beads of a moved bead,
+    // the later moved beads of a fixed one; pairs within a group keep their distance
+    for ( a = 0; a < numbeads-3; a++){
+        moveda = (CHANGE1(a) != fixed);
+        nb = moveda ? numbeads : nmoved;
+        row = a*(numbeads-3) - a*(a-1)/2 - a - 3; // interaction index of pair a, b is row + b
+        for ( q = moveda ? a+3 : 0; q < nb; q++){
+            b = moveda ? q : moved[q];
+            if (b < a+3 || CHANGE1(b) == CHANGE1(a)) continue;
+            k = row + b;
+            p = NATLABELS1(k);
+	    x = MPOS2(a,0) - MPOS2(b,0);
+	    y = MPOS2(a,1) - MPOS2(b,1);
+	    z = MPOS2(a,2) - MPOS2(b,2);
+            r2new = x*x + y*y + z*z;
+            if (p >= 0){
+                dn += (r2new < NSIGMA21(p)) - (R21(k) < NSIGMA21(p));
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/r2new;
+                nE6 = nE*nE*nE;
+                e = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+            }
+            else{
+                nnE = NONNATPARAM1(a) + NONNATPARAM1(b);
+                nnE = nnE*nnE/r2new;
+                nnE = nnE*nnE;
+                e = nnepsil*nnE*nnE*nnE;
+            }
+            UNDOK1(n) = k;
+            UNDOR21(n) = R21(k);
+            UNDOE1(n) = E1(k);
+            n++;
+            de += e - E1(k);
+            R21(k) = r2new;
+            E1(k) = e;
+	}
+    }
+    free(moved);
+    DE1(0) = de;
+    DNC1(0) = dn;
+    DNC1(1) = n;
+    """
+    info = kernels.inline(code, ['mpos', 'numbeads', 'natlabels', 'natparam', 'nonnatparam', 'nnepsil', 'nsigma2', 'r2', 'E', 'dE', 'dnc', 'change', 'undok', 'undor2', 'undoE'], headers=['<math.h>', '<stdlib.h>'])
+    return dE[0], dnc[0], (undok, undor2, undoE, dnc[1])
+
+undobuffers = {} # size: undo arrays, reused so that an update does not allocate (and page in) new arrays
+
+def undobuffer(n):
+    """Undo arrays for n interactions, shared by the incremental updates of this process, so an
+    undo list is only valid until the next update"""
+    if n not in undobuffers:
+        undobuffers.clear()
+        undobuffers[n] = (numpy.empty(n, dtype=int), numpy.empty(n), numpy.empty(n))
+    return undobuffers[n]
+
+def undoLJ(r2, E, undo):
+    """Restores the interactions an incremental LJ update changed in place"""
+    k, r2old, Eold, n = undo
+    r2[k[:n]] = r2old[:n]
+    E[k[:n]] = Eold[:n]
+
+#==========================================
+# NEIGHBOR LIST METHODS
+#==========================================
+
+def getneighborlist(mpos, numint, numbeads, natpairs, rlist):
+    """
+    Returns every interaction within rlist as a nlist x 3 array: (bead i, bead j, native index)
+    The native index points into natpairs/natparam, -1 for nonnative interactions
+    """
+    r2 = cgetLJr2(mpos, numint, numbeads)
+    k = numpy.flatnonzero(r2 < rlist*rlist)
+    index = numpy.arange(numbeads-2)
+    start = index*(numbeads-3) - index*(index-1)/2 # interaction index of the first pair of each bead
+    i = numpy.searchsorted(start, k, side='right') - 1
+    j = k - start[i] + i + 3
+    natk = nativeindex(natpairs, numbeads)
+    n = numpy.searchsorted(natk, k)
+    n[n == len(natk)] = 0
+    n[natk[n] != k] = -1
+    return numpy.column_stack((i, j, n))
+
+def checkneighborlist(mpos, ref, skin):
+    """Returns True if any bead moved more than half the skin since the neighbor list was built"""
+    disp = mpos - ref
+    return numpy.max(disp[:,0]*disp[:,0] + disp[:,1]*disp[:,1] + disp[:,2]*disp[:,2]) > .25*skin*skin
+
+def cgetLJenergy_list(mpos, nlist, natparam, nonnatparam, nnepsil, cutoff):
+    """
+    Same as cgetLJenergy_withE, but only for the interactions in the neighbor list
+    Interactions are truncated at the cutoff and shifted so the energy is continuous
+
+    Returns:
+        r2 and energy of every interaction in nlist, total energy
+    """
+    n = len(nlist)
+    energy = numpy.array([0.0])
+    r2_array = numpy.empty(n)
+    E_array = numpy.zeros(n)
+    code = """
+    int i, j, p;
+    double x, y, z, nE, nE6, nnE, cut2;
+    cut2 = cutoff*cutoff;
+    for ( int l = 0; l < n; l++){
+        i = NLIST2(l,0); j = NLIST2(l,1); p = NLIST2(l,2);
+	x = MPOS2(i,0) - MPOS2(j,0);
+	y = MPOS2(i,1) - MPOS2(j,1);
+	z = MPOS2(i,2) - MPOS2(j,2);
+	R2_ARRAY1(l) = x*x + y*y + z*z;
+        if (R2_ARRAY1(l) < cut2){
+            if (p >= 0){
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/R2_ARRAY1(l);
+                nE6 = nE*nE*nE;
+                E_ARRAY1(l) = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                nE = NATPARAM2(p,1)*NATPARAM2(p,1)/cut2;
+                nE6 = nE*nE*nE;
+                E_ARRAY1(l) -= NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+            }
+            else{
+                nnE = NONNATPARAM1(i) + NONNATPARAM1(j);
+                nnE = nnE*nnE;
+                nE = nnE/R2_ARRAY1(l);
+                nE = nE*nE;
+                nnE = nnE/cut2;
+                nnE = nnE*nnE;
+                E_ARRAY1(l) = nnepsil*(nE*nE*nE - nnE*nnE*nnE);
+            }
+            ENERGY1(0) += E_ARRAY1(l);
+        }
+    }
+    """
+    info = kernels.inline(code, ['mpos', 'n', 'nlist', 'natparam', 'energy', 'nonnatparam', 'nnepsil', 'cutoff', 'r2_array', 'E_array'], headers=['<math.h>', '<stdlib.h>'])
+    return r2_array, E_array, energy[0]
+
+def cgetLJenergy_listupdater(mpos, nlist, natparam, nonnatparam, nnepsil, cutoff, nsigma2, r2, E, change):
+    """
+    Incremental version of cgetLJenergy_list, see cgetLJenergy_updater, r2 and E are updated in place
+    Native contacts are only counted in the neighbor list, i.e. exactly if cutoff > 1.2 sigma
+    """
+    n = len(nlist)
+    undok, undor2, undoE = undobuffer(n)
+    dE = numpy.array([0.0])
+    dnc = numpy.array([0, 0]) # change in native contacts, length of the undo list
+    code = """
+    int i, j, p, m = 0;
+    double x, y, z, nE, nE6, nnE, cut2, e;
+    cut2 = cutoff*cutoff;
+    for ( int l = 0; l < n; l++){
+        i = NLIST2(l,0); j = NLIST2(l,1);
+        if (CHANGE1(i) != CHANGE1(j)){
+            p = NLIST2(l,2);
+	    x = MPOS2(i,0) - MPOS2(j,0);
+	    y = MPOS2(i,1) - MPOS2(j,1);
+	    z = MPOS2(i,2) - MPOS2(j,2);
+            UNDOK1(m) = l;
+            UNDOR21(m) = R21(l);
+            UNDOE1(m) = E1(l);
+            m++;
+            if (p >= 0) DNC1(0) -= (R21(l) < NSIGMA21(p));
+	    R21(l) = x*x + y*y + z*z;
+            if (p >= 0) DNC1(0) += (R21(l) < NSIGMA21(p));
+            e = 0;
+            if (R21(l) < cut2){
+                if (p >= 0){
+                    nE = NATPARAM2(p,1)*NATPARAM2(p,1)/R21(l);
+                    nE6 = nE*nE*nE;
+                    e = NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                    nE = NATPARAM2(p,1)*NATPARAM2(p,1)/cut2;
+                    nE6 = nE*nE*nE;
+                    e -= NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                }
+                else{
+                    nnE = NONNATPARAM1(i) + NONNATPARAM1(j);
+                    nnE = nnE*nnE;
+                    nE = nnE/R21(l);
+                    nE = nE*nE;
+                    nnE = nnE/cut2;
+                    nnE = nnE*nnE;
+                    e = nnepsil*(nE*nE*nE - nnE*nnE*nnE);
+                }
+            }
+            DE1(0) += e - E1(l);
+            E1(l) = e;
+        }
+    }
+    DNC1(1) = m;
+    """
+    info = kernels.inline(code, ['mpos', 'n', 'nlist', 'natparam', 'nonnatparam', 'nnepsil', 'cutoff', 'nsigma2', 'r2', 'E', 'dE', 'dnc', 'change', 'undok', 'undor2', 'undoE'], headers=['<math.h>', '<stdlib.h>'])
+    return dE[0], dnc[0], (undok, undor2, undoE, dnc[1])
+
 
 def LJenergy_CHARMM(r2, natparam, nonnatparam, nnepsil):
     #native calculation
@@ -585,7 +1054,7 @@ def cangleenergy(mpos, oldE, param, change):
 		NEWE1(i) = PARAM2(i,0)*(angle-PARAM2(i,1))*(angle-PARAM2(i,1));
 	}
 	"""
-    	info = weave.inline(code, ['param', 'newE', 'mpos', 'change','n'], headers=['<math.h>', '<stdlib.h>'])
+    	info = kernels.inline(code, ['param', 'newE', 'mpos', 'change','n'], headers=['<math.h>', '<stdlib.h>'])
     	return newE
 
 def torsionenergy_nn(mpos, oldE, param, change):
@@ -631,7 +1100,7 @@ def ctorsionenergy(mpos, oldE, param, change):
         NEWE1(i) = PARAM2(4*i,0)*(1+cos(PARAM2(4*i,1)*dihed-PARAM2(4*i,2))) + PARAM2(4*i+1,0)*(1+cos(PARAM2(4*i+1,1)*dihed-PARAM2(4*i+1,2))) + PARAM2(4*i+2,0)*(1+cos(PARAM2(4*i+2,1)*dihed-PARAM2(4*i+2,2))) + PARAM2(4*i+3,0)*(1+cos(PARAM2(4*i+3,1)*dihed-PARAM2(4*i+3,2)));
     }
     """
-    info = weave.inline(code, ['param', 'newE', 'mpos', 'change','n'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['param', 'newE', 'mpos', 'change','n'], headers=['<math.h>', '<stdlib.h>'])
     return newE
 
 #used in simulatepolymer
@@ -669,6 +1138,137 @@ def polymerenergy(mpos):
         energy = energy + A + B * numpy.cos(dihedral) + C * numpy.cos(3*dihedral)
     return energy
 
+#==========================================
+# BATCH ENERGY METHODS
+#==========================================
+# energies of a stack of saved frames, e.g. to reweight a trajectory to other parameters
+
+energyterms = ['nativeLJ', 'nonnativeLJ', 'angle', 'torsion', 'surfrep', 'surfatt', 'umbrella']
+framedtype = numpy.dtype([(term, float) for term in energyterms] + [('Q', float), ('z', float)])
+
+def totalenergy(E):
+    """Potential energy of a framedtype array, the sum of its energyterms"""
+    return sum(E[term] for term in energyterms)
+
+def cframeenergy(frames, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, nsigma2):
+    """
+    Internal energy terms and number of native contacts of every frame, frames is F x numbeads x 3
+    Same formulas as cgetLJenergy (cgetLJenergy_list with a cutoff), cangleenergy, ctorsionenergy
+    and cnativecontact
+
+    Returns:
+        F x 4 array: [native LJ, nonnative LJ, angle, torsion]
+        native contacts of every frame
+    """
+    F, numbeads = frames.shape[0:2]
+    nnat = len(natpairs)
+    energy = numpy.zeros((F,4))
+    nc = numpy.zeros(F, dtype=int)
+    code = """
+    int p;
+    double x, y, z, r2, nE, nE6, nnE, cut2;
+    double x1, x2, x3, y1, y2, y3, z1, z2, z3;
+    double mx, my, mz, nx, ny, nz, a, b, angle, dihed;
+    cut2 = cutoff*cutoff;
+    for ( int f = 0; f < F; f++){
+        p = 0;
+        for ( int i = 0; i < numbeads; i++){
+            for ( int j = i+3; j < numbeads; j++){
+                x = FRAMES3(f,i,0) - FRAMES3(f,j,0);
+                y = FRAMES3(f,i,1) - FRAMES3(f,j,1);
+                z = FRAMES3(f,i,2) - FRAMES3(f,j,2);
+                r2 = x*x + y*y + z*z;
+                if (p < nnat && NATPAIRS2(p,0) == i && NATPAIRS2(p,1) == j){
+                    if (r2 < NSIGMA21(p)) NC1(f)++;
+                    if (cutoff == 0 || r2 < cut2){
+                        nE = NATPARAM2(p,1)*NATPARAM2(p,1)/r2;
+                        nE6 = nE*nE*nE;
+                        ENERGY2(f,0) += NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                        if (cutoff){
+                            nE = NATPARAM2(p,1)*NATPARAM2(p,1)/cut2;
+                            nE6 = nE*nE*nE;
+                            ENERGY2(f,0) -= NATPARAM2(p,0)*(13*nE6*nE6-18*nE6*nE*nE+4*nE6);
+                        }
+                    }
+                    p++;
+                }
+                else if (cutoff == 0 || r2 < cut2){
+                    nnE = NONNATPARAM1(i) + NONNATPARAM1(j);
+                    nnE = nnE*nnE;
+                    nE = nnE/r2;
+                    nE = nE*nE;
+                    ENERGY2(f,1) += nnepsil*nE*nE*nE;
+                    if (cutoff){
+                        nE = nnE/cut2;
+                        nE = nE*nE;
+                        ENERGY2(f,1) -= nnepsil*nE*nE*nE;
+                    }
+                }
+            }
+        }
+        for ( int i = 0; i < numbeads-2; i++){
+            x1 = FRAMES3(f,i,0) - FRAMES3(f,i+1,0); y1 = FRAMES3(f,i,1) - FRAMES3(f,i+1,1); z1 = FRAMES3(f,i,2) - FRAMES3(f,i+1,2);
+            x2 = FRAMES3(f,i+2,0) - FRAMES3(f,i+1,0); y2 = FRAMES3(f,i+2,1) - FRAMES3(f,i+1,1); z2 = FRAMES3(f,i+2,2) - FRAMES3(f,i+1,2);
+            angle = acos((x1*x2 + y1*y2 + z1*z2)/sqrt((x1*x1 + y1*y1 + z1*z1)*(x2*x2 + y2*y2 + z2*z2)));
+            ENERGY2(f,2) += ANGLEPARAM2(i,0)*(angle-ANGLEPARAM2(i,1))*(angle-ANGLEPARAM2(i,1));
+        }
+        for ( int i = 0; i < numbeads-3; i++){
+            x1 = FRAMES3(f,i,0) - FRAMES3(f,i+1,0); y1 = FRAMES3(f,i,1) - FRAMES3(f,i+1,1); z1 = FRAMES3(f,i,2) - FRAMES3(f,i+1,2);
+            x2 = FRAMES3(f,i+2,0) - FRAMES3(f,i+1,0); y2 = FRAMES3(f,i+2,1) - FRAMES3(f,i+1,1); z2 = FRAMES3(f,i+2,2) - FRAMES3(f,i+1,2);
+            x3 = FRAMES3(f,i+2,0) - FRAMES3(f,i+3,0); y3 = FRAMES3(f,i+2,1) - FRAMES3(f,i+3,1); z3 = FRAMES3(f,i+2,2) - FRAMES3(f,i+3,2);
+            mx = y1*z2 - z1*y2; my = z1*x2 - x1*z2; mz = x1*y2 - y1*x2;
+            nx = y2*z3 - z2*y3; ny = z2*x3 - x2*z3; nz = x2*y3 - y2*x3;
+            a = sqrt(x2*x2 + y2*y2 + z2*z2)*(x1*nx + y1*ny + z1*nz);
+            b = mx*nx + my*ny + mz*nz;
+            dihed = atan2(a,b);
+            if ( dihed < 0){
+                dihed += 2*M_PI;
+            }
+            for ( int k = 4*i; k < 4*i+4; k++){
+                ENERGY2(f,3) += TORSPARAM2(k,0)*(1+cos(TORSPARAM2(k,1)*dihed-TORSPARAM2(k,2)));
+            }
+        }
+    }
+    """
+    info = kernels.inline(code, ['frames', 'F', 'numbeads', 'nnat', 'natpairs', 'natparam', 'nonnatparam', 'nnepsil', 'angleparam', 'torsparam', 'cutoff', 'nsigma2', 'energy', 'nc'], headers=['<math.h>', '<stdlib.h>'])
+    return energy, nc
+
+def frameenergy(frames, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, nsigma2, cutoff=0., surface=None, surfparam=None, grid=None, gridparam=None, mass=None, z_pin=None, k_Zpin=1., Qpin=None, k_Qpin=0.):
+    """
+    Energy terms of a stack of frames (F x numbeads x 3) under the given parameters, which need not
+    be the ones the frames were sampled with, e.g. surfparam of getsurfparam with another scale
+
+        surface, surfparam: surface terms as csurfenergy_beads, or grid, gridparam as csurfenergy_gridbeads
+        mass: center of mass z of every frame, z_pin: Z umbrella k_Zpin*(z - z_pin)**2 as umbrellaenergy
+        Qpin: Q umbrella k_Qpin*(Q - Qpin)**2
+
+    Returns:
+        F array of framedtype, totalenergy gives the potential energy of every frame
+    """
+    F, numbeads = frames.shape[0:2]
+    frames = numpy.ascontiguousarray(frames, dtype=float)
+    E = numpy.zeros(F, dtype=framedtype)
+    internal, nc = cframeenergy(frames, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, nsigma2)
+    for k, term in enumerate(energyterms[0:4]):
+        E[term] = internal[:,k]
+    E['Q'] = nc / float(len(natpairs))
+    if surfparam is not None:
+        scale = surfparam[2][:numbeads,0]
+        if grid is not None:
+            surfE = csurfenergy_gridbeads(frames.reshape(F*numbeads,3), numpy.arange(F*numbeads), grid, gridparam, numpy.tile(scale, F))
+            surfE = numpy.sum(surfE.reshape(F,numbeads,2), axis=1)
+        else:
+            surfE = numpy.array([numpy.sum(csurfenergy_beads(frame, surface, numbeads, surfparam, numpy.arange(numbeads)), axis=0) for frame in frames])
+        E['surfrep'] = surfE[:,0]
+        E['surfatt'] = surfE[:,1]
+    if mass is not None:
+        E['z'] = numpy.dot(frames[:,:,2], mass)/numpy.sum(mass)
+        if z_pin is not None:
+            E['umbrella'] += k_Zpin*(E['z'] - z_pin)**2
+    if Qpin is not None:
+        E['umbrella'] += k_Qpin*(E['Q'] - Qpin)**2
+    return E
+
 #==========================================
 # CONFIGURATION ANALYSIS METHODS
 #==========================================
@@ -701,6 +1301,24 @@ def nativecontact(r2,nativeparam,nsigma2):
 	nc = nc[nc>0]
 	return len(nc)
 
+def cnativecontact(mpos, natpairs, nsigma2):
+	# native contact if rij < 1.2 sigmaij, only native pairs are visited
+	nnat = len(natpairs)
+	nc = numpy.array([0])
+	code = """
+	int i, j;
+	double x, y, z;
+	for ( int p = 0; p < nnat; p++){
+	    i = NATPAIRS2(p,0); j = NATPAIRS2(p,1);
+	    x = MPOS2(i,0) - MPOS2(j,0);
+	    y = MPOS2(i,1) - MPOS2(j,1);
+	    z = MPOS2(i,2) - MPOS2(j,2);
+	    if (x*x + y*y + z*z < NSIGMA21(p)) NC1(0)++;
+	}
+	"""
+	info = kernels.inline(code, ['mpos', 'nnat', 'natpairs', 'nsigma2', 'nc'], headers=['<math.h>', '<stdlib.h>'])
+	return nc[0]
+
 def bond(mpos):
     bonds = mpos[0:len(mpos)-1,:] - mpos[1:len(mpos),:] #bond=rij=ri-rj
     return bonds		
@@ -774,6 +1392,6 @@ def cdihedral(mpos, rnge=None):
         }
     }
     """
-    info = weave.inline(code, ['mpos', 'n', 'rnge','newdihed'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['mpos', 'n', 'rnge','newdihed'], headers=['<math.h>', '<stdlib.h>'])
     return newdihed
 
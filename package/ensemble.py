@@ -0,0 +1,160 @@
+'''
+Runs all replicas of a (non-surface) simulation together in one process.
+The coordinates of R replicas are held in one R x numbeads x 3 array, every step proposes
+an angle bend, axis torsion or global crankshaft move for each replica, and the LJ, angle
+and torsion energies of all proposals are evaluated with one compiled call over all
+replicas (energyfunc.cframeenergy). ParRot and MD moves are not batched.
+'''
+import numpy
+import kernels
+import energyfunc
+from simulationobject import Simulation, saveslot
+
+def cmove(coords, movetype, beads, rand, theta):
+    """
+    Proposes a move for every replica, movetype 0 is moveset.canglebend, 1 moveset.caxistorsion
+    and 2 moveset.cglobalcrank, theta is R x numbeads-2 (only theta[r,0] for angle bend and
+    axis torsion), beads are the pivot beads m, returns the new coordinates and jacobians
+    """
+    R, numbeads = coords.shape[0:2]
+    newcoords = coords.copy()
+    jac = numpy.ones(R)
+    code = """
+    int n, end, m;
+    double c, s, dotAB, dotABBC, mag;
+    double xAB, yAB, zAB, xBC, yBC, zBC;
+    double xx, xy, xz, yx, yy, yz, zx, zy, zz;
+    double bx, by, bz, btx, bty, btz;
+    double brx, bry, brz;
+    for ( int r = 0; r < R; r++){
+        if (MOVETYPE1(r) == 2){
+            for ( m = 1; m < numbeads-1; m++){
+                xAB = NEWCOORDS3(r,m,0) - NEWCOORDS3(r,m-1,0); yAB = NEWCOORDS3(r,m,1) - NEWCOORDS3(r,m-1,1); zAB = NEWCOORDS3(r,m,2) - NEWCOORDS3(r,m-1,2);
+                xBC = NEWCOORDS3(r,m+1,0) - NEWCOORDS3(r,m-1,0); yBC = NEWCOORDS3(r,m+1,1) - NEWCOORDS3(r,m-1,1); zBC = NEWCOORDS3(r,m+1,2) - NEWCOORDS3(r,m-1,2);
+                dotAB = xBC*xBC + yBC*yBC + zBC*zBC;
+                dotABBC = xAB*xBC + yAB*yBC + zAB*zBC;
+                mag = sqrt(dotAB);
+                xx = xBC/mag; xy = yBC/mag; xz = zBC/mag;
+                mag = dotABBC/dotAB;
+                yx = xAB - mag*xBC; yy = yAB - mag*yBC; yz = zAB - mag*zBC;
+                mag = sqrt(yx*yx+yy*yy+yz*yz);
+                yx = yx/mag; yy = yy/mag; yz = yz/mag;
+                zx = xy*yz - xz*yy; zy = xz*yx - xx*yz; zz = xx*yy - xy*yx;
+                c = cos(THETA2(r,m-1));
+                s = sin(THETA2(r,m-1));
+                btx = xx*xAB + xy*yAB + xz*zAB; bty = yx*xAB + yy*yAB + yz*zAB; btz = zx*xAB + zy*yAB + zz*zAB;
+                brx = btx; bry = c*bty + s*btz; brz = -s*bty + c*btz;
+                NEWCOORDS3(r,m,0) = NEWCOORDS3(r,m-1,0) + xx*brx + yx*bry + zx*brz;
+                NEWCOORDS3(r,m,1) = NEWCOORDS3(r,m-1,1) + xy*brx + yy*bry + zy*brz;
+                NEWCOORDS3(r,m,2) = NEWCOORDS3(r,m-1,2) + xz*brx + yz*bry + zz*brz;
+            }
+            continue;
+        }
+        m = BEADS1(r);
+        c = cos(THETA2(r,0));
+        s = sin(THETA2(r,0));
+        if (RAND1(r) < .5){
+            n = 1;
+            end = numbeads - 1;
+        }
+        else{
+            n = -1;
+            end = 0;
+        }
+        xAB = COORDS3(r,m,0) - COORDS3(r,m-n,0); yAB = COORDS3(r,m,1) - COORDS3(r,m-n,1); zAB = COORDS3(r,m,2) - COORDS3(r,m-n,2);
+        xBC = COORDS3(r,m+n,0) - COORDS3(r,m,0); yBC = COORDS3(r,m+n,1) - COORDS3(r,m,1); zBC = COORDS3(r,m+n,2) - COORDS3(r,m,2);
+        dotAB = xAB*xAB + yAB*yAB + zAB*zAB;
+        dotABBC = xAB*xBC + yAB*yBC + zAB*zBC;
+        mag = sqrt(dotAB);
+        xx = xAB/mag; xy = yAB/mag; xz = zAB/mag;
+        mag = dotABBC/dotAB;
+        yx = xBC - mag*xAB; yy = yBC - mag*yAB; yz = zBC - mag*zAB;
+        mag = sqrt(yx*yx+yy*yy+yz*yz);
+        yx = yx/mag; yy = yy/mag; yz = yz/mag;
+        zx = xy*yz - xz*yy; zy = xz*yx - xx*yz; zz = xx*yy - xy*yx;
+        if (MOVETYPE1(r) == 0){
+            // angle bend rotates about the normal of the bond angle, frame (AB x y, y, AB)
+            mag = xx; xx = zx; zx = mag;
+            mag = xy; xy = zy; zy = mag;
+            mag = xz; xz = zz; zz = mag;
+            mag = M_PI - acos(dotABBC/sqrt(dotAB*(xBC*xBC+yBC*yBC+zBC*zBC)));
+            JAC1(r) = sin(mag-THETA2(r,0))/sin(mag);
+        }
+        for( int i = m; i != end; i += n){
+            bx = COORDS3(r,i+n,0) - COORDS3(r,i,0); by = COORDS3(r,i+n,1) - COORDS3(r,i,1); bz = COORDS3(r,i+n,2) - COORDS3(r,i,2);
+            btx = xx*bx + xy*by + xz*bz; bty = yx*bx + yy*by + yz*bz; btz = zx*bx + zy*by + zz*bz;
+            brx = btx; bry = c*bty + s*btz; brz = -s*bty + c*btz;
+            NEWCOORDS3(r,i+n,0) = NEWCOORDS3(r,i,0) + xx*brx + yx*bry + zx*brz;
+            NEWCOORDS3(r,i+n,1) = NEWCOORDS3(r,i,1) + xy*brx + yy*bry + zy*brz;
+            NEWCOORDS3(r,i+n,2) = NEWCOORDS3(r,i,2) + xz*brx + yz*bry + zz*brz;
+        }
+    }
+    """
+    info = kernels.inline(code, ['coords', 'newcoords', 'R', 'numbeads', 'movetype', 'beads', 'rand', 'theta', 'jac'], headers=['<math.h>', '<stdlib.h>'])
+    return newcoords, jac
+
+def run(replicas, nummoves, dict):
+    '''
+    Advances every replica by nummoves with batched moves, same as Simulation.run for
+    angle bend, axis torsion and global crankshaft moves, returns the replicas
+    '''
+    numbeads = dict['numbeads']
+    percentmove = dict['percentmove']
+    save = dict['save']
+    param = (dict['natpairs'], dict['nativeparam'], dict['nonnativeparam'], dict['nnepsil'], dict['angleparam'], dict['torsparam'], dict['cutoff'], dict['nsigma2'])
+    R = len(replicas)
+    r = numpy.arange(R)
+    coords = numpy.array([replica.coord for replica in replicas])
+    kT = Simulation.kb*numpy.array([replica.T for replica in replicas])
+    maxtheta = numpy.array([replica.maxtheta for replica in replicas])
+    move = replicas[0].move
+    E0, nc = energyfunc.cframeenergy(coords, *param)
+    u0 = numpy.sum(E0, axis=1)
+    attempted = numpy.zeros((R,3), dtype=int)
+    accepted = numpy.zeros((R,3), dtype=int)
+    for k in xrange(nummoves):
+        randmove = numpy.random.random(R)
+        movetype = numpy.searchsorted(percentmove[0:2], randmove, side='right') # 0 angle bend, 1 axis torsion, 2 global crankshaft
+        randdir = numpy.random.random(R)
+        m = numpy.random.randint(1, numbeads-1, R)
+        theta = numpy.random.normal(0, 1, (R, numbeads-2))*maxtheta[:,2:3]
+        pivot = movetype < 2
+        theta[pivot,0] = maxtheta[r[pivot],movetype[pivot]]*(1 - 2*randdir[pivot])
+        randdir[pivot] = numpy.random.random(numpy.sum(pivot))
+        new, jac = cmove(coords, movetype, m, randdir, theta)
+        E1, newnc = energyfunc.cframeenergy(new, *param)
+        u1 = numpy.sum(E1, axis=1)
+        accept = numpy.random.random(R) < jac*numpy.exp(-(u1-u0)/kT)
+        coords[accept] = new[accept]
+        u0[accept] = u1[accept]
+        E0[accept] = E1[accept]
+        nc[accept] = newnc[accept]
+        attempted[r,movetype] += 1
+        accepted[r[accept],movetype[accept]] += 1
+        move += 1
+        slot = saveslot(move, save, dict['tunemoves']) # None while the step sizes are tuned
+        if move % save == 0 and slot is not None:
+            for i, replica in enumerate(replicas):
+                replica.terms['move'] = move
+                replica.terms['energy'] = u0[i]
+                for t, term in enumerate(energyfunc.energyterms[0:4]):
+                    replica.terms[term] = E0[i,t]
+                replica.terms['Q'] = nc[i] / float(dict['totnc'])
+                replica.log.write('%s/observables%s' %(replica.out, replica.suffix), replica.terms)
+                if dict['writetraj']:
+                    replica.traj.write('%s/trajectory%s' %(replica.out, replica.suffix), slot, move, coords[i])
+    for i, replica in enumerate(replicas):
+        replica.coord = coords[i]
+        replica.setenergy()
+        replica.traj.flush()
+        replica.log.flush()
+        replica.move = move
+        replica.amoves += attempted[i,0]
+        replica.atmoves += attempted[i,1]
+        replica.gcmoves += attempted[i,2]
+        replica.accepteda += accepted[i,0]
+        replica.acceptedat += accepted[i,1]
+        replica.acceptedgc += accepted[i,2]
+        replica.accepted += numpy.sum(accepted[i])
+        replica.rejected += numpy.sum(attempted[i]) - numpy.sum(accepted[i])
+    return replicas
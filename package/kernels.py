@@ -0,0 +1,111 @@
+'''
+Backends of the C kernels of energyfunc, HMCforce, moveset and ensemble.
+
+kernels.inline takes the place of weave.inline: a kernel is named after the function holding
+it and runs on the first available backend of
+    compiled: the _gokernels extension module built ahead of time by buildkernels.py
+    weave:    runtime compilation with scipy.weave
+    numpy:    the NumPy versions of numpykernels
+The environment variable GOKERNELS (or kernels.backend) forces one of them.
+'''
+import os
+import sys
+import hashlib
+import numpy
+import numpykernels
+try:
+    from scipy import weave
+except ImportError:
+    weave = None
+try:
+    import _gokernels
+except ImportError:
+    _gokernels = None
+
+backend = os.environ.get('GOKERNELS')
+catalog = {} # compiled function name: (code, arg_names, headers, example variables), kept by the weave backend for buildkernels.py
+_names = {}
+_compiled = {} # (code, signature): function of _gokernels, None if it was not built
+
+def signature(args, arg_names):
+    """Types of the variables, as weave a kernel is compiled for one type of every variable"""
+    sig = []
+    for arg in arg_names:
+        value = args[arg]
+        if isinstance(value, numpy.ndarray):
+            sig.append((value.dtype.char, value.ndim))
+        else:
+            sig.append(type(value).__name__)
+    return tuple(sig)
+
+def funcname(name, code, sig):
+    """Name of the kernel in _gokernels, the hash keeps edited kernels from running stale builds"""
+    try:
+        return _names[code, sig]
+    except KeyError:
+        _names[code, sig] = '%s_%s' % (name, hashlib.md5(code + repr(sig)).hexdigest()[0:8])
+        return _names[code, sig]
+
+def runcompiled(name, code, arg_names, headers, args, sig):
+    if _gokernels is None:
+        return False
+    try:
+        f = _compiled[code, sig]
+    except KeyError:
+        f = _compiled[code, sig] = getattr(_gokernels, funcname(name, code, sig), None)
+    if f is None:
+        return False
+    try:
+        f(*[args[arg] for arg in arg_names])
+    except TypeError: # argument types differ from the build
+        return False
+    return True
+
+def runweave(name, code, arg_names, headers, args, sig):
+    if weave is None:
+        return False
+    catalog[funcname(name, code, sig)] = (code, arg_names, headers, args)
+    weave.inline(code, arg_names, local_dict=args, headers=headers)
+    return True
+
+def runnumpy(name, code, arg_names, headers, args, sig):
+    try:
+        f = getattr(numpykernels, name)
+    except AttributeError:
+        raise NotImplementedError('kernel %s has no NumPy version, it needs weave or the compiled kernels (buildkernels.py)' % name)
+    f(**args)
+    return True
+
+backends = [('compiled', runcompiled), ('weave', runweave), ('numpy', runnumpy)]
+
+def inline(code, arg_names, headers=[]):
+    """Runs the kernel code on the variables arg_names of the calling function, see weave.inline"""
+    frame = sys._getframe(1)
+    name = frame.f_code.co_name
+    local = frame.f_locals
+    args = {}
+    for arg in arg_names:
+        value = local[arg]
+        if type(value) is not numpy.ndarray and isinstance(value, numpy.generic): # the compiled conversions only take python scalars
+            value = value.item()
+        args[arg] = value
+    sig = signature(args, arg_names)
+    for b, run in backends:
+        if (backend is None or backend == b) and run(name, code, arg_names, headers, args, sig):
+            return
+    raise RuntimeError('kernel backend %s is not available for %s' % (backend, name))
+
+def build(location=None):
+    """Compiles the kernels in catalog into the _gokernels extension module"""
+    from scipy.weave import ext_tools
+    if location is None:
+        location = os.path.dirname(os.path.abspath(__file__))
+    mod = ext_tools.ext_module('_gokernels')
+    for fname in sorted(catalog):
+        code, arg_names, headers, args = catalog[fname]
+        f = ext_tools.ext_function(fname, code, arg_names, local_dict=args)
+        for header in headers:
+            f.customize.add_header(header)
+        mod.add_function(f)
+    mod.compile(location=location)
+    os.remove(os.path.join(location, '_gokernels.cpp'))
@@ -3,7 +3,7 @@ import energyfunc
 import HMCforce
 import pdb
 import writetopdb
-from scipy import weave
+import kernels
 
 def crankshaft(coord, m, theta): 
     coord = coord_old.copy()
@@ -78,7 +78,7 @@ def cglobalcrank(coord_old,theta):
     }
     
     """
-    info = weave.inline(code, ['coord','theta','numbeads'], headers = ['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code, ['coord','theta','numbeads'], headers = ['<math.h>', '<stdlib.h>'])
     return coord
 
 def axistorsion(coord_old,m,rand,theta):
@@ -149,7 +149,7 @@ def caxistorsion(coord_old,m,rand,theta):
             COORD2(i+n,0) = COORD2(i,0) + bxx; COORD2(i+n,1) = COORD2(i,1) + byy; COORD2(i+n,2) = COORD2(i,2) + bzz;
     }
     """
-    info = weave.inline(code,['coord_old','coord','m','rand','theta','numbeads'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code,['coord_old','coord','m','rand','theta','numbeads'], headers=['<math.h>', '<stdlib.h>'])
     return coord
 
 #def axistorsion_n(coord_old,m,rand,theta):
@@ -254,9 +254,18 @@ def canglebend(coord_old, m, rand, theta):
 	angle = M_PI - acos(dotABBC/sqrt(dotAB*(xBC*xBC+yBC*yBC+zBC*zBC)));
 	JAC1(0) = sin(angle-(double)theta)/sin(angle);
     """
-    info = weave.inline(code,['coord_old','coord','m','rand','theta','jac','numbeads'], headers=['<math.h>', '<stdlib.h>'])
+    info = kernels.inline(code,['coord_old','coord','m','rand','theta','jac','numbeads'], headers=['<math.h>', '<stdlib.h>'])
     return coord, jac[0]
 
+def movedbeads(numbeads, m, rand):
+    """Labels the beads rotated as a rigid body by caxistorsion and canglebend about bead m"""
+    change = numpy.zeros(numbeads, dtype=int)
+    if rand < .5:
+        change[m+1:] = 1
+    else:
+        change[:m] = 1
+    return change
+
 def reptation(coord_old):
     coord=coord_old.copy()
     theta=arccos(1-2*numpy.random.random())
@@ -469,6 +478,44 @@ def reptation(coord_old):
 #		coord[m+n*4,:]=dot(untransform,bond)+coord[m+n*3,:]
 #		return coord
 		
+def internalforces(self, coord, bonds, d2, d, dict, energies=False):
+    # forces of coord, if energies its energies are left in self.r2new, self.newljE, self.newuLJ, self.newangE and self.newtorsE
+    if not dict['cutoff']:
+        out = HMCforce.cgetforces(coord, bonds, d2, d, dict['numint'], dict['numbeads'], dict['natpairs'], dict['nativeparam'], dict['nonnativeparam'], dict['nnepsil'], dict['angleparam'], dict['torsparam'], energies)
+    else:
+        # neighbor list is carried along the trajectory in self.newnlist
+        if energyfunc.checkneighborlist(coord, self.newnlistref, dict['skin']):
+            self.newnlist = energyfunc.getneighborlist(coord, dict['numint'], dict['numbeads'], dict['natpairs'], dict['cutoff'] + dict['skin'])
+            self.newnlistref = coord.copy()
+        out = HMCforce.cgetforces_list(coord, bonds, d2, d, self.newnlist, dict['nativeparam'], dict['nonnativeparam'], dict['nnepsil'], dict['angleparam'], dict['torsparam'], dict['cutoff'], energies)
+    if energies:
+        self.r2new, self.newljE, self.newuLJ, self.newangE, self.newtorsE = out[1:]
+    return out[0]
+
+def constraintsolvers(dict):
+    # SHAKE and RATTLE of the --constraints mode
+    if dict['constraints'] == 'direct':
+        return HMCforce.ctridshake, HMCforce.ctridrattle
+    return HMCforce.cshake, HMCforce.crattle
+
+def bondedforces(coord, bonds, d2, d, dict):
+    # angle and dihedral forces, the fast forces of the RESPA substeps
+    return HMCforce.cangleforces(coord, dict['angleparam'], bonds, d, dict['numbeads']) + HMCforce.cdihedforces(dict['torsparam'], bonds, d2, d, dict['numbeads'])
+
+def respaforce(force, coord, bonds, d2, d, dict):
+    # force for the kicks at the ends of an outer step, the slow (nonbonded and surface) forces act
+    # once per outer step, i.e. scaled by the number of bonded substeps dict['tinner']
+    if dict['tinner'] == 1:
+        return force
+    fast = bondedforces(coord, bonds, d2, d, dict)
+    return fast + dict['tinner'] * (force - fast)
+
+def mdcache(self):
+    # velocities and initial force of the next MD move, kept from the last MD move if the
+    # configuration and temperature have not changed since, otherwise None
+    if self.mdstate is not None and self.mdstate[1] == self.T and numpy.array_equal(self.mdstate[0], self.coord):
+        return self.mdstate
+
 def runMD(self,nsteps,h,dict):
     numbeads=dict['numbeads']
     numint=dict['numint']
@@ -480,22 +527,35 @@ def runMD(self,nsteps,h,dict):
     m=dict['mass']
     tol=1e-8
     maxloop=1000
+    shake, rattle = constraintsolvers(dict)
 
 	
+    self.uncloseable=False
     self.newcoord=self.coord.copy()
+    self.newnlist=self.nlist
+    self.newnlistref=self.nlistref
     self.vel=numpy.empty((numbeads,3))
     for i in range(numbeads): 
         self.vel[i,:]=numpy.random.normal(0,(4.184*self.kb*self.T/m[i])**.5,3) #in nm/ps, uses average residue mass
     bonds=self.coord[0:numbeads-1,:]-self.coord[1:numbeads,:]
     d2=numpy.sum(bonds**2,axis=1)
     d=d2**.5
-    force = HMCforce.cangleforces(self.coord, angleparam,bonds,d,numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(self.coord,numint,numbeads,nativeparam,nonnativeparam,nnepsil)
+    inner = dict['tinner']
+    h /= inner # r-RESPA: step of the bonded forces, nonbonded forces every inner steps
+    cached = mdcache(self)
+    if cached is None:
+        force = respaforce(internalforces(self, self.coord, bonds, d2, d, dict), self.coord, bonds, d2, d, dict)
+    else:
+        # generalized HMC: partial refresh of the velocities of the last MD move
+        force = cached[3]
+        self.vel = (1-dict['mdrefresh'])**.5 * cached[2] + dict['mdrefresh']**.5 * self.vel
     a = numpy.transpose(force) / m
-    self.vel, conv = HMCforce.crattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+    self.vel, conv = rattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+    self.mdstate = (self.coord, self.T, -self.vel, force) # for the next MD move if this one is rejected
     self.oldH=self.u0+.5/4.184*numpy.sum(m*numpy.sum(self.vel**2,axis=1)) # in kcal/mol
-    for e in range(nsteps):
+    for e in range(nsteps*inner):
         v_half = self.vel + h / 2 * numpy.transpose(a) # unconstrained v(t+dt/2)
-        v_half, conv = HMCforce.cshake(bonds, v_half, h, m, d2, maxloop, numbeads, tol) # 
+        v_half, conv = shake(bonds, v_half, h, m, d2, maxloop, numbeads, tol) # 
         if not conv:
 			print 'MD not converging, reject'
 			self.uncloseable=True
@@ -503,17 +563,28 @@ def runMD(self,nsteps,h,dict):
 			break
         self.newcoord += h * v_half #constrained r(t+dt)
         bonds = self.newcoord[0:numbeads-1,:]-self.newcoord[1:numbeads,:] #rij(t+dt)
-        force = HMCforce.cangleforces(self.newcoord, angleparam,bonds,d,numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(self.newcoord,numint,numbeads,nativeparam,nonnativeparam,nnepsil)
+        if (e+1) % inner:
+            force = bondedforces(self.newcoord, bonds, d2, d, dict)
+        else:
+            force = respaforce(internalforces(self, self.newcoord, bonds, d2, d, dict, e == nsteps*inner-1), self.newcoord, bonds, d2, d, dict)
         a = numpy.transpose(force)/m
         self.vel = v_half + h/2*numpy.transpose(a) # unconstrained v(t+dt)
-        self.vel, conv = HMCforce.crattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+        self.vel, conv = rattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
         if not conv:
 			print 'MD not converging, reject'
 			self.uncloseable=True
 			self.rejected += 1
 			break
+    else:
+        self.mdenergies = nsteps > 0 # the last step computed the energies of self.newcoord with its forces
+        self.mdaccept = (self.newcoord.copy(), self.T, self.vel, force) # for the next MD move if this one is accepted
     return self
 
+def surfforces(coord, dict):
+    if dict['surfgrid'] is None:
+        return HMCforce.cgetsurfforce(coord, dict['surface'], dict['nspint'], dict['numbeads'], dict['surfparam'], dict['scale'])
+    return HMCforce.cgetsurfforce_grid(coord, dict['numbeads'], dict['surfgrid'], dict['gridparam'], dict['surfparam'][2][:dict['numbeads'],0])
+
 def runMD_surf(self,nsteps,h,dict):
     numbeads=dict['numbeads']
     numint=dict['numint']
@@ -523,56 +594,71 @@ def runMD_surf(self,nsteps,h,dict):
     nonnativeparam=dict['nonnativeparam']
     nnepsil=dict['nnepsil']
     m=dict['mass']
-    surface = dict['surface']
-    surfparam = dict['surfparam']
-    nspint = dict['nspint']
-    scale = dict['scale']
 
     tol=1e-8
     maxloop=1000
+    shake, rattle = constraintsolvers(dict)
 	
+    self.uncloseable=False
     self.newcoord=self.coord.copy()
+    self.newnlist=self.nlist
+    self.newnlistref=self.nlistref
     self.vel=numpy.empty((numbeads,3))
     for i in range(numbeads): 
         self.vel[i,:]=numpy.random.normal(0,(4.184*self.kb*self.T/m[i])**.5,3) #in nm/ps, uses average residue mass
     bonds=self.coord[0:numbeads-1,:]-self.coord[1:numbeads,:]
     d2=numpy.sum(bonds**2,axis=1)
     d=d2**.5
-    force = HMCforce.cangleforces(self.coord, angleparam,bonds,d,numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(self.coord,numint,numbeads,nativeparam,nonnativeparam,nnepsil) + HMCforce.cgetsurfforce(self.coord, surface, nspint, numbeads, surfparam, scale)
+    inner = dict['tinner']
+    h /= inner # r-RESPA: step of the bonded forces, nonbonded and surface forces every inner steps
+    cached = mdcache(self)
+    if cached is None:
+        force = respaforce(internalforces(self, self.coord, bonds, d2, d, dict) + surfforces(self.coord, dict), self.coord, bonds, d2, d, dict)
+    else:
+        # generalized HMC: partial refresh of the velocities of the last MD move
+        force = cached[3]
+        self.vel = (1-dict['mdrefresh'])**.5 * cached[2] + dict['mdrefresh']**.5 * self.vel
     a = numpy.transpose(force) / m
-    self.vel, conv = HMCforce.crattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+    self.vel, conv = rattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+    self.mdstate = (self.coord, self.T, -self.vel, force) # for the next MD move if this one is rejected
     self.oldH=self.u0+.5/4.184*numpy.sum(m*numpy.sum(self.vel**2,axis=1)) # in kcal/mol
-    for e in xrange(nsteps):
+    for e in xrange(nsteps*inner):
 		#finding r(t+dt)
 		#loops = 0
 		#conv = numpy.ones(numbeads-1)
 		v_half = self.vel + h / 2 * numpy.transpose(a) # unconstrained v(t+dt/2)
-		v_half, conv = HMCforce.cshake(bonds, v_half, h, m, d2, maxloop, numbeads, tol) # 
+		v_half, conv = shake(bonds, v_half, h, m, d2, maxloop, numbeads, tol) # 
 		if not conv:
 			self.uncloseable=True
 			self.rejected += 1
 			break
 		self.newcoord += h * v_half #constrained r(t+dt)
 		bonds = self.newcoord[0:numbeads-1,:]-self.newcoord[1:numbeads,:] #rij(t+dt)
-		force = HMCforce.cangleforces(self.newcoord, angleparam,bonds,d,numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(self.newcoord,numint,numbeads,nativeparam,nonnativeparam,nnepsil) + HMCforce.cgetsurfforce(self.newcoord, surface, nspint, numbeads, surfparam, scale)
+		if (e+1) % inner:
+			force = bondedforces(self.newcoord, bonds, d2, d, dict)
+		else:
+			force = respaforce(internalforces(self, self.newcoord, bonds, d2, d, dict, e == nsteps*inner-1) + surfforces(self.newcoord, dict), self.newcoord, bonds, d2, d, dict)
 		a = numpy.transpose(force)/m
 		self.vel = v_half + h/2*numpy.transpose(a) # unconstrained v(t+dt)
-		self.vel, conv = HMCforce.crattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
+		self.vel, conv = rattle(bonds, self.vel, m, d2, maxloop, numbeads, tol)
 		if not conv:
 			self.uncloseable=True
 			self.rejected += 1
 			break
 		#writetopdb.addtopdb(self.newcoord,positiontemplate,self.move*nsteps+e,'%s/trajectory%i.pdb' % (self.out,int(self.T)))
+    else:
+        self.mdenergies = nsteps > 0 # the last step computed the energies of self.newcoord with its forces
+        self.mdaccept = (self.newcoord.copy(), self.T, self.vel, force) # for the next MD move if this one is accepted
     return self
 
-def runMD_noreplica(nsteps, h, coord, numbeads, numint, angleparam, torsparam, nativeparam, nonnativeparam, nnepsil, mass, kb, T, tol, maxloop):
+def runMD_noreplica(nsteps, h, coord, numbeads, numint, angleparam, torsparam, natpairs, nativeparam, nonnativeparam, nnepsil, mass, kb, T, tol, maxloop):
 	newcoord = coord.copy()
 	vel = empty((numbeads,3))
 	for i in range(numbeads): vel[i,:]=numpy.random.normal(0,(4.184*kb*T/mass[i])**.5,3) #in nm/ps, uses average residue mass
         bonds=coord[0:numbeads-1,:]-coord[1:numbeads,:]
 	d2=numpy.sum(bonds**2,axis=1)
 	d=d2**.5
-	force = HMCforce.cangleforces(coord, angleparam, bonds, d, numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(coord, numint, numbeads, nativeparam, nonnativeparam, nnepsil)
+	force = HMCforce.cangleforces(coord, angleparam, bonds, d, numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(coord, numint, numbeads, natpairs, nativeparam, nonnativeparam, nnepsil)
 	a = numpy.transpose(force) / mass
 	vel, conv = HMCforce.crattle(bonds, vel, mass, d2, maxloop, numbeads, tol)
         #self.oldH=self.u0+.5/4.184*numpy.sum(m*numpy.sum(self.vel**2,axis=1)) # in kcal/mol
@@ -585,7 +671,7 @@ def runMD_noreplica(nsteps, h, coord, numbeads, numint, angleparam, torsparam, n
 			return numpy.nan
 		newcoord += h * v_half #constrained r(t+dt)
 		bonds = newcoord[0:numbeads-1,:]-newcoord[1:numbeads,:] #rij(t+dt)
-		force = HMCforce.cangleforces(newcoord, angleparam, bonds, d, numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(newcoord, numint, numbeads, nativeparam, nonnativeparam, nnepsil)
+		force = HMCforce.cangleforces(newcoord, angleparam, bonds, d, numbeads) + HMCforce.cdihedforces(torsparam, bonds, d2, d, numbeads) + HMCforce.cnonbondedforces(newcoord, numint, numbeads, natpairs, nativeparam, nonnativeparam, nnepsil)
 		a = transpose(force)/mass
 		vel = v_half + h/2*transpose(a) # unconstrained v(t+dt)
 		vel, conv = HMCforce.crattle(bonds, vel, mass, d2, maxloop, numbeads, tol)
@@ -759,9 +845,167 @@ def parrot(coord_old, m, rand, theta):
         coord=coord[::-1]
     return coord, jac
 
+def cparrot(coord_old, m, rand, theta):
+    """
+    Compiled parrot, for 1 < m < numbeads-2
+    Returns the new coordinates, the jacobian, the changed torsions and False if the chain can't be closed
+    """
+    numbeads = len(coord_old)
+    if rand > .5:
+        coord_old = coord_old[::-1]
+    coord = coord_old.copy()
+    branch = numpy.random.random() # picks one of the two solutions for phi2
+    jac = numpy.array([0.])
+    closed = numpy.array([1])
+    code = """
+    #define B(i,k) (COORD_OLD2(i+1,k) - COORD_OLD2(i,k))
+    #define MAKET(T,c,s,cp,sp) T[0][0] = -c; T[0][1] = s; T[0][2] = 0; T[1][0] = -cp*s; T[1][1] = -cp*c; T[1][2] = -sp; T[2][0] = -sp*s; T[2][1] = -sp*c; T[2][2] = cp;
+    double c[4], s[4], cdihed[2], dihed[2];
+    double BA[3], BC[3], CD[3], p1[3], p2[3], a, b, mag;
+    double ulab[3], u1[3], u2[3], x[3], y[3], z[3], z1[3], u[3], v[3];
+    double T0[3][3], T1[3][3], T2[3][3], M[3][3], P[3][3];
+    double jac_old, jac_new, Nmn, Nnm, cosphi2, sinphi2, phi2, cp, sp;
+    int i;
+
+    // bond angles at beads m-1 to m+2, 68 degrees past the end of the chain
+    for (int k = 0; k < 4; k++){
+        i = m - 2 + k;
+        if (i + 2 < numbeads){
+            for (int l = 0; l < 3; l++){
+                BA[l] = COORD_OLD2(i,l) - COORD_OLD2(i+1,l);
+                BC[l] = COORD_OLD2(i+2,l) - COORD_OLD2(i+1,l);
+            }
+            a = acos((BA[0]*BC[0]+BA[1]*BC[1]+BA[2]*BC[2]) / sqrt((BA[0]*BA[0]+BA[1]*BA[1]+BA[2]*BA[2])*(BC[0]*BC[0]+BC[1]*BC[1]+BC[2]*BC[2])));
+        }
+        else{
+            a = 68*M_PI/180;
+        }
+        c[k] = cos(a);
+        s[k] = sin(a);
+    }
+
+    // dihedrals of beads m-2 to m+1 and m to m+3 as energyfunc.dihedral
+    cdihed[1] = -1;
+    for (int k = 0; k < 2; k++){
+        i = m - 2 + 2*k;
+        if (i + 3 >= numbeads) break;
+        for (int l = 0; l < 3; l++){
+            BA[l] = COORD_OLD2(i,l) - COORD_OLD2(i+1,l);
+            BC[l] = COORD_OLD2(i+2,l) - COORD_OLD2(i+1,l);
+            CD[l] = COORD_OLD2(i+2,l) - COORD_OLD2(i+3,l);
+        }
+        p1[0] = BA[1]*BC[2]-BA[2]*BC[1]; p1[1] = BA[2]*BC[0]-BA[0]*BC[2]; p1[2] = BA[0]*BC[1]-BA[1]*BC[0];
+        p2[0] = BC[1]*CD[2]-BC[2]*CD[1]; p2[1] = BC[2]*CD[0]-BC[0]*CD[2]; p2[2] = BC[0]*CD[1]-BC[1]*CD[0];
+        a = sqrt(BC[0]*BC[0]+BC[1]*BC[1]+BC[2]*BC[2]) * (BA[0]*p2[0]+BA[1]*p2[1]+BA[2]*p2[2]);
+        b = p1[0]*p2[0] + p1[1]*p2[1] + p1[2]*p2[2];
+        dihed[k] = atan2(a, b);
+        cdihed[k] = b / sqrt(a*a + b*b);
+    }
+    Nmn = (cdihed[1] > .999) ? 1. : 2.;
+    MAKET(T0, c[1], s[1], cos(dihed[0]+theta), sin(dihed[0]+theta))
+
+    // direction of bond m+2, which the move keeps
+    if (m + 2 < numbeads - 1){
+        mag = sqrt(B(m+2,0)*B(m+2,0) + B(m+2,1)*B(m+2,1) + B(m+2,2)*B(m+2,2));
+        for (int l = 0; l < 3; l++) ulab[l] = B(m+2,l) / mag;
+    }
+    else{
+        ulab[0] = 0; ulab[1] = 0; ulab[2] = 1;
+    }
+    #define PARROTJAC(out) \
+        a = sqrt(u1[0]*u1[0]+u1[1]*u1[1]+u1[2]*u1[2]); \
+        b = sqrt(u2[0]*u2[0]+u2[1]*u2[1]+u2[2]*u2[2]); \
+        out = fabs(ulab[0]*(u1[1]*u2[2]-u1[2]*u2[1]) + ulab[1]*(u1[2]*u2[0]-u1[0]*u2[2]) + ulab[2]*(u1[0]*u2[1]-u1[1]*u2[0])) / (a*b);
+    for (int l = 0; l < 3; l++){
+        u1[l] = B(m,l);
+        u2[l] = B(m+1,l);
+    }
+    PARROTJAC(jac_old)
+
+    // frame of bond m-1 in the lab frame, Tlab = [x y z]
+    a = sqrt(B(m-1,0)*B(m-1,0) + B(m-1,1)*B(m-1,1) + B(m-1,2)*B(m-1,2));
+    b = sqrt(B(m-2,0)*B(m-2,0) + B(m-2,1)*B(m-2,1) + B(m-2,2)*B(m-2,2));
+    for (int l = 0; l < 3; l++){
+        x[l] = B(m-1,l) / a;
+        z1[l] = B(m-2,l) / b;
+    }
+    z[0] = (x[1]*z1[2]-x[2]*z1[1])/s[0]; z[1] = (x[2]*z1[0]-x[0]*z1[2])/s[0]; z[2] = (x[0]*z1[1]-x[1]*z1[0])/s[0];
+    y[0] = z[1]*x[2]-z[2]*x[1]; y[1] = z[2]*x[0]-z[0]*x[2]; y[2] = z[0]*x[1]-z[1]*x[0];
+
+    // u = Tlab^T ulab, v = T0^T u, both are rotations
+    u[0] = x[0]*ulab[0] + x[1]*ulab[1] + x[2]*ulab[2];
+    u[1] = y[0]*ulab[0] + y[1]*ulab[1] + y[2]*ulab[2];
+    u[2] = z[0]*ulab[0] + z[1]*ulab[1] + z[2]*ulab[2];
+    for (int l = 0; l < 3; l++) v[l] = T0[0][l]*u[0] + T0[1][l]*u[1] + T0[2][l]*u[2];
+    cosphi2 = (c[2]*c[3] - v[0]) / (s[3]*s[2]);
+    if (fabs(cosphi2) > 1){
+        CLOSED1(0) = 0; // no solutions
+    }
+    else{
+        Nnm = (fabs(cosphi2) > .999) ? 1. : 2.;
+        phi2 = (branch < .5) ? acos(cosphi2) : 2*M_PI - acos(cosphi2);
+        sinphi2 = sin(phi2);
+
+        // phi1 from its cosine and sine (findphi1)
+        a = s[2]*c[3] + cosphi2*c[2]*s[3];
+        b = s[3]*sinphi2;
+        cp = (a*v[1] - b*v[2]) / (1 - v[0]*v[0]);
+        sp = (b*v[1] + a*v[2]) / (1 - v[0]*v[0]);
+        mag = atan2(sp, cp);
+        MAKET(T1, c[2], s[2], cos(mag), sin(mag))
+        MAKET(T2, c[3], s[3], cosphi2, sinphi2)
+
+        // new positions of beads m+1 to m+3 (findpos), the rest of the chain is translated
+        for (int r = 0; r < 3; r++){
+            for (int l = 0; l < 3; l++) M[r][l] = x[r]*T0[0][l] + y[r]*T0[1][l] + z[r]*T0[2][l];
+        }
+        for (int k = 0; k < 3 && m + k + 1 < numbeads; k++){
+            if (k == 1){
+                for (int r = 0; r < 3; r++) for (int l = 0; l < 3; l++) P[r][l] = M[r][0]*T1[0][l] + M[r][1]*T1[1][l] + M[r][2]*T1[2][l];
+                for (int r = 0; r < 3; r++) for (int l = 0; l < 3; l++) M[r][l] = P[r][l];
+            }
+            else if (k == 2){
+                for (int r = 0; r < 3; r++) for (int l = 0; l < 3; l++) P[r][l] = M[r][0]*T2[0][l] + M[r][1]*T2[1][l] + M[r][2]*T2[2][l];
+                for (int r = 0; r < 3; r++) for (int l = 0; l < 3; l++) M[r][l] = P[r][l];
+            }
+            mag = sqrt(B(m+k,0)*B(m+k,0) + B(m+k,1)*B(m+k,1) + B(m+k,2)*B(m+k,2));
+            for (int l = 0; l < 3; l++) COORD2(m+k+1,l) = COORD2(m+k,l) + M[l][0]*mag;
+        }
+        for (i = m + 3; i < numbeads - 1; i++){
+            for (int l = 0; l < 3; l++) COORD2(i+1,l) = COORD2(i,l) + B(i,l);
+        }
+
+        for (int l = 0; l < 3; l++){
+            u1[l] = COORD2(m+1,l) - COORD2(m,l);
+            u2[l] = COORD2(m+2,l) - COORD2(m+1,l);
+        }
+        PARROTJAC(jac_new)
+        JAC1(0) = jac_old/jac_new*Nmn/Nnm;
+    }
+    """
+    info = kernels.inline(code, ['coord_old', 'coord', 'm', 'theta', 'branch', 'numbeads', 'jac', 'closed'], headers=['<math.h>', '<stdlib.h>'])
+    torschange = numpy.arange(m-2, min(m+2, numbeads-3))
+    if rand > .5:
+        coord = coord[::-1].copy()
+        torschange = numbeads - 4 - torschange[::-1]
+    return coord, jac[0], torschange, bool(closed[0])
+
+def parrotbeads(numbeads, m, rand):
+    """Labels the beads moved by parrot; beads m+1 and m+2 move independently, the rest of the chain rigidly"""
+    change = numpy.zeros(numbeads, dtype=int)
+    if rand > .5:
+        m = numbeads - 1 - m
+        change[m-1] = 1
+        change[m-2] = 2
+        change[:m-2] = 3
+    else:
+        change[m+1] = 1
+        change[m+2] = 2
+        change[m+3:] = 3
+    return change
 
 def parrot_jac(u, u1, u2):
-    u1 = u1 / (u1[0]**2+u1[1]**2+u2[2]**2)**.5 # sum(u1**2)**.5
+    u1 = u1 / (u1[0]**2+u1[1]**2+u1[2]**2)**.5 # sum(u1**2)**.5
     u2 = u2 / (u2[0]**2+u2[1]**2+u2[2]**2)**.5 # sum(u2**2)**.5
     jac = numpy.array([u1[1]*u2[2]-u1[2]*u2[1],u1[2]*u2[0]-u1[0]*u2[2],u1[0]*u2[1]-u1[1]*u2[0]])
     jac = abs(u[0]*jac[0]+u[1]*jac[1]+u[2]*jac[2])
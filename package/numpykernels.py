@@ -0,0 +1,673 @@
+'''
+NumPy versions of the compiled kernels of energyfunc, HMCforce, moveset and ensemble, used by
+kernels.inline when neither the prebuilt kernel module nor weave is available.
+
+Every function is named after the function holding the C kernel and takes the variables the
+kernel takes, outputs are written into the given arrays as the C code does. Results agree with
+the C kernels up to the order of the floating point sums.
+'''
+import numpy
+import scipy.linalg
+
+#==========================================
+# HELPERS
+#==========================================
+
+def pairs(numbeads):
+    """Beads i, j of every LJ interaction (j >= i+3), in the order of the numint-long arrays"""
+    return numpy.triu_indices(numbeads, 3)
+
+def nativelabels(natpairs, nnat, numbeads):
+    """Native index of every interaction, -1 for nonnative ones (see energyfunc.nativeindex)"""
+    i = natpairs[:nnat,0]
+    j = natpairs[:nnat,1]
+    nat = -numpy.ones(numbeads*(numbeads-1)/2 - 2*numbeads + 3, dtype=int)
+    nat[i*(numbeads-3) - i*(i-1)/2 + j - i - 3] = numpy.arange(nnat)
+    return nat
+
+def dot(a, b):
+    return numpy.sum(a*b, axis=-1)
+
+def surfvectors(prot_coord, surf_coord, numbeads, i):
+    """Surface point minus bead of the surface interactions i (surface point i/numbeads, bead i % numbeads)"""
+    return surf_coord[i/numbeads] - prot_coord[i % numbeads]
+
+def ljenergy(r2, i, j, nat, natparam, nonnatparam, nnepsil):
+    """Native 12-10-6 and nonnative repulsive energies of energyfunc.cgetLJenergy"""
+    E = numpy.empty(len(r2))
+    n = nat >= 0
+    p = nat[n]
+    nE = natparam[p,1]*natparam[p,1]/r2[n]
+    nE6 = nE*nE*nE
+    E[n] = natparam[p,0]*(13*nE6*nE6 - 18*nE6*nE*nE + 4*nE6)
+    nnE = nonnatparam[i[~n]] + nonnatparam[j[~n]]
+    nnE = nnE*nnE/r2[~n]
+    nnE = nnE*nnE
+    E[~n] = nnepsil*nnE*nnE*nnE
+    return E
+
+def ljforce(forces, mpos, i, j, nat, natparam, nonnatparam, nnepsil):
+    """Adds the LJ forces of the interactions i, j (not yet converted to kJ) to forces"""
+    rvec = mpos[i] - mpos[j]
+    r2 = dot(rvec, rvec)
+    r = numpy.sqrt(r2)
+    ndV = numpy.empty(len(r2))
+    n = nat >= 0
+    p = nat[n]
+    nE = natparam[p,1]*natparam[p,1]/r2[n]
+    nE6 = nE*nE*nE
+    ndV[n] = natparam[p,0]*(-156*nE6*nE6/r[n] + 180*nE6*nE*nE/r[n] - 24*nE6/r[n])
+    nE = nonnatparam[i[~n]] + nonnatparam[j[~n]]
+    nE = nE*nE/r2[~n]
+    nE = nE*nE*nE
+    ndV[~n] = -12*nnepsil*nE*nE/r[~n]
+    pairforces(forces, i, j, (-ndV/r)[:,numpy.newaxis]*rvec)
+    return r2
+
+def pairforces(forces, i, j, F):
+    """Adds F to bead i and -F to bead j of every interaction"""
+    numbeads = len(forces)
+    for k in range(3):
+        forces[:,k] += numpy.bincount(i, F[:,k], minlength=numbeads) - numpy.bincount(j, F[:,k], minlength=numbeads)
+
+def angles(mpos, i):
+    """Bond angles at beads i+1"""
+    BA = mpos[i] - mpos[i+1]
+    BC = mpos[i+2] - mpos[i+1]
+    return numpy.arccos(dot(BA, BC)/numpy.sqrt(dot(BA, BA)*dot(BC, BC)))
+
+def dihedrals(x1, x2, x3):
+    """Dihedral angles in [0, 2 pi) as energyfunc.cdihedral, x1 = r_i - r_i+1, x2 = r_i+2 - r_i+1, x3 = r_i+2 - r_i+3"""
+    m = numpy.cross(x1, x2)
+    n = numpy.cross(x2, x3)
+    dihed = numpy.arctan2(numpy.sqrt(dot(x2, x2))*dot(x1, n), dot(m, n))
+    dihed[dihed < 0] += 2*numpy.pi
+    return dihed
+
+def chaindihedrals(mpos, i):
+    return dihedrals(mpos[i] - mpos[i+1], mpos[i+2] - mpos[i+1], mpos[i+2] - mpos[i+3])
+
+def torsionterms(torsparam, i):
+    """The 4 torsion terms of every torsion i, len(i) x 4 x 3"""
+    return torsparam[4*i[:,numpy.newaxis] + numpy.arange(4)]
+
+def torsionenergies(torsparam, i, dihed):
+    p = torsionterms(torsparam, i)
+    return numpy.sum(p[:,:,0]*(1 + numpy.cos(p[:,:,1]*dihed[:,numpy.newaxis] - p[:,:,2])), axis=1)
+
+def rotatechain(coord, coord_old, m, n, end, frame, c, s):
+    """
+    Rotates the bonds from bead m toward end (step n) by theta about the first axis of frame,
+    as the loops of moveset.caxistorsion and moveset.canglebend
+    """
+    if n == 1:
+        index = numpy.arange(m, end)
+    else:
+        index = numpy.arange(m, end, -1)
+    bonds = coord_old[index+n] - coord_old[index]
+    bt = numpy.dot(bonds, frame.T)
+    br = numpy.column_stack((bt[:,0], c*bt[:,1] + s*bt[:,2], -s*bt[:,1] + c*bt[:,2]))
+    coord[index+n] = coord[m] + numpy.cumsum(numpy.dot(br, frame), axis=0)
+
+def pivotframe(coord, m, n, bend):
+    """Rows x, y, z of the frame of moveset.caxistorsion (x along AB), or of canglebend (z along AB)"""
+    AB = coord[m] - coord[m-n]
+    BC = coord[m+n] - coord[m]
+    dotAB = dot(AB, AB)
+    x = AB/dotAB**.5
+    y = BC - dot(AB, BC)/dotAB*AB
+    y = y/dot(y, y)**.5
+    z = numpy.cross(x, y)
+    if bend:
+        return numpy.array([z, y, x]), numpy.pi - numpy.arccos(dot(AB, BC)/(dotAB*dot(BC, BC))**.5)
+    return numpy.array([x, y, z]), None
+
+def surfgrid(prot_coord, i, grid, gridparam):
+    """
+    Hermite/bilinear interpolation of surfacesimulation.getsurfgrid for the beads i
+    Returns the positions in i of the beads within the grid, u, v, and the values f and
+    z derivatives fz of the 4 corners, f[m][a][b]
+    """
+    nx, ny, nz = grid.shape[0:3]
+    x0, y0, zmin, dx, dy, dz = gridparam[0:6]
+    zmax = zmin + (nz-1)*dz
+    z = prot_coord[i,2]
+    sel = numpy.flatnonzero((z >= zmin) & (z < zmax))
+    i = i[sel]
+    u = (prot_coord[i,0] - x0)/dx
+    u -= nx*numpy.floor(u/nx)
+    ix = u.astype(int)
+    u -= ix
+    ix %= nx
+    v = (prot_coord[i,1] - y0)/dy
+    v -= ny*numpy.floor(v/ny)
+    iy = v.astype(int)
+    v -= iy
+    iy %= ny
+    w = (prot_coord[i,2] - zmin)/dz
+    iz = w.astype(int)
+    t = w - iz
+    h = ((1+2*t)*(1-t)*(1-t), t*(1-t)*(1-t)*dz, t*t*(3-2*t), t*t*(t-1)*dz)
+    g = (6*t*(t-1)/dz, (1-t)*(1-3*t), -6*t*(t-1)/dz, t*(3*t-2))
+    corners = ((ix, (ix+1) % nx), (iy, (iy+1) % ny))
+    def hermite(h, a, b, m):
+        X = corners[0][a]
+        Y = corners[1][b]
+        return h[0]*grid[X,Y,iz,m] + h[1]*grid[X,Y,iz,m+2] + h[2]*grid[X,Y,iz+1,m] + h[3]*grid[X,Y,iz+1,m+2]
+    f = [[[hermite(h, a, b, m) for b in range(2)] for a in range(2)] for m in range(2)]
+    fz = [[[hermite(g, a, b, m) for b in range(2)] for a in range(2)] for m in range(2)]
+    return sel, u, v, f, fz
+
+def bilinear(u, v, f):
+    return (1-u)*(1-v)*f[0][0] + u*(1-v)*f[1][0] + (1-u)*v*f[0][1] + u*v*f[1][1]
+
+#==========================================
+# ENERGYFUNC KERNELS
+#==========================================
+
+def cgetr2surf(prot_coord, surf_coord, numint, numbeads, r2_array):
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, numpy.arange(numint))
+    r2_array[:] = dot(rvec, rvec)
+
+def csurfenergy(prot_coord, surf_coord, numint, numbeads, energy, ep_in, sig_in, scale):
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, numpy.arange(numint))
+    r2 = dot(rvec, rvec)
+    i = numpy.flatnonzero(r2 < 400)
+    e = sig_in*sig_in/r2[i]
+    e6 = e*e*e
+    e12 = e6*e6
+    energy[0] += numpy.sum(ep_in*e12 - scale[i,1])
+    energy[1] += numpy.sum(scale[i,0]*ep_in*(12*e12 - 18*e6*e*e + 4*e6))
+
+def csurfperiodic(points, n, spacing, ep, sig, param):
+    a = spacing
+    b = spacing*3**.5
+    c = sig*sig/400.
+    c6 = c*c*c
+    c12 = c6*c6
+    gc = 12*c12 - 18*c6*c*c + 4*c6
+    nx = int(20/a) + 2
+    ny = int(20/b) + 2
+    i, j, s = numpy.mgrid[-nx:nx+1,-ny:ny+1,0:2].reshape(3,-1)
+    x = (points[:n,0] - a*numpy.floor(points[:n,0]/a))[:,numpy.newaxis] - i*a - s*a/2
+    y = (points[:n,1] - b*numpy.floor(points[:n,1]/b))[:,numpy.newaxis] - j*b - s*b/2
+    z = points[:n,2][:,numpy.newaxis] + 0*x
+    r2 = x*x + y*y + z*z
+    within = r2 < 400
+    x, y, z, r2 = x[within], y[within], z[within], r2[within]
+    p = numpy.nonzero(within)[0]
+    e = sig*sig/r2
+    e6 = e*e*e
+    e12 = e6*e6
+    dA = -12*ep*e12/r2
+    dB = ep*(-144*e12 + 180*e6*e*e - 24*e6)/r2
+    terms = (ep*(e12 - c12), ep*(12*e12 - 18*e6*e*e + 4*e6 - gc), dA*x, dA*y, dA*z, dB*x, dB*y, dB*z)
+    for k, term in enumerate(terms):
+        param[:,k] += numpy.bincount(p, term, minlength=n)
+
+def csurfenergy_beads(prot_coord, surf_coord, nsurf, numbeads, n, beads, energy, ep_in, sig_in, scale):
+    i = beads[:n].astype(int)
+    rvec = surf_coord[numpy.newaxis,:,:] - prot_coord[i][:,numpy.newaxis,:]
+    r2 = dot(rvec, rvec)
+    l, s = numpy.nonzero(r2 < 400)
+    k = s*numbeads + i[l]
+    e = sig_in*sig_in/r2[l,s]
+    e6 = e*e*e
+    e12 = e6*e6
+    energy[:,0] += numpy.bincount(l, ep_in*e12 - scale[k,1], minlength=n)
+    energy[:,1] += numpy.bincount(l, scale[k,0]*ep_in*(12*e12 - 18*e6*e*e + 4*e6), minlength=n)
+
+def csurfenergy_gridbeads(prot_coord, n, beads, grid, gridparam, scale, energy):
+    beads = beads[:n].astype(int)
+    l, u, v, f, fz = surfgrid(prot_coord, beads, grid, gridparam)
+    energy[l,0] = bilinear(u, v, f[0])
+    energy[l,1] = scale[beads[l]]*bilinear(u, v, f[1])
+
+def csurfenergy_old(prot_coord, surf_coord, numint, numbeads, param, energy, scale):
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, numpy.arange(numint))
+    r2 = dot(rvec, rvec)
+    i = numpy.flatnonzero(r2 < 400)
+    e = param[i,1]*param[i,1]/r2[i]
+    e = e*e*e
+    energy[0] += numpy.sum(param[i,0]*e*e - param[i,2])
+    energy[1] += numpy.sum(-param[i,0]*2*scale*e)
+
+def surfbeadenergy(r2, param):
+    """12-6 surface energy of the interactions of csurfenergy_withr2"""
+    e = param[:,1]*param[:,1]/r2
+    e = e*e*e
+    return param[:,0]*(e*e - 2*e)
+
+def csurfenergy_withr2(prot_coord, surf_coord, numint, numbeads, param, energy, r2_array):
+    i = numpy.arange(numint)
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, i)
+    r2_array[:] = dot(rvec, rvec)
+    energy += numpy.bincount(i % numbeads, surfbeadenergy(r2_array, param), minlength=numbeads)
+
+def csurfenergy_updater2(prot_coord, surf_coord, numint, numbeads, param, change, surfEnew, r2new, n):
+    i = change[:n].astype(int)
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, i)
+    r2new[i] = dot(rvec, rvec)
+    surfEnew += numpy.bincount(i % numbeads, surfbeadenergy(r2new[i], param[i]), minlength=numbeads)
+
+def cgetLJr2(mpos, numint, numbeads, r2array):
+    i, j = pairs(numbeads)
+    rvec = mpos[i] - mpos[j]
+    r2array[:] = dot(rvec, rvec)
+
+def cgetforcer(mpos, numint, numbeads, r2array):
+    i, j = pairs(numbeads)
+    r2array[:] = mpos[i] - mpos[j]
+
+def cLJenergy(r2, natparam, numint, energy, nonnatparam, nnepsil):
+    nE = natparam[:,0]*natparam[:,2]*natparam[:,2]/r2
+    nE6 = nE*nE*nE
+    nnE = nonnatparam[:,0]*nonnatparam[:,1]*nonnatparam[:,1]/r2
+    nnE = nnE*nnE
+    energy[0] += numpy.sum(natparam[:,1]*(13*nE6*nE6 - 18*nE6*nE*nE + 4*nE6) + nnepsil*nnE*nnE*nnE)
+
+def cgetLJenergy(mpos, numbeads, nnat, natpairs, natparam, energy, nonnatparam, nnepsil, r2_array, E_array=None):
+    i, j = pairs(numbeads)
+    rvec = mpos[i] - mpos[j]
+    r2_array[:] = dot(rvec, rvec)
+    E = ljenergy(r2_array, i, j, nativelabels(natpairs, nnat, numbeads), natparam, nonnatparam, nnepsil)
+    if E_array is not None:
+        E_array[:] = E
+    energy[0] += numpy.sum(E)
+
+def cgetLJenergy_withE(mpos, numbeads, nnat, natpairs, natparam, energy, nonnatparam, nnepsil, r2_array, E_array):
+    cgetLJenergy(mpos, numbeads, nnat, natpairs, natparam, energy, nonnatparam, nnepsil, r2_array, E_array)
+
+def undolist(undok, undor2, undoE, dnc, k, r2, E):
+    """Keeps the interactions k an incremental update is about to change, their number goes to dnc[1]"""
+    undok[:len(k)] = k
+    undor2[:len(k)] = r2[k]
+    undoE[:len(k)] = E[k]
+    dnc[1] = len(k)
+
+def cgetLJenergy_updater(mpos, numbeads, natlabels, natparam, nonnatparam, nnepsil, nsigma2, r2, E, dE, dnc, change, undok, undor2, undoE):
+    i, j = pairs(numbeads)
+    k = numpy.flatnonzero(change[i] != change[j])
+    undolist(undok, undor2, undoE, dnc, k, r2, E)
+    i, j = i[k], j[k]
+    nat = natlabels[k]
+    rvec = mpos[i] - mpos[j]
+    contacts(dnc, r2[k], dot(rvec, rvec), nat, nsigma2)
+    r2[k] = dot(rvec, rvec)
+    e = ljenergy(r2[k], i, j, nat, natparam, nonnatparam, nnepsil)
+    dE[0] += numpy.sum(e - E[k])
+    E[k] = e
+
+def contacts(dnc, r2old, r2new, nat, nsigma2):
+    """Adds the change in the number of native contacts of the interactions to dnc"""
+    n = nat >= 0
+    dnc[0] += numpy.sum(r2new[n] < nsigma2[nat[n]]) - numpy.sum(r2old[n] < nsigma2[nat[n]])
+
+def listenergy(r2, i, j, nat, natparam, nonnatparam, nnepsil, cutoff):
+    """Energies of energyfunc.cgetLJenergy_list for the interactions within the cutoff"""
+    cut2 = numpy.empty(len(r2))
+    cut2.fill(cutoff*cutoff)
+    return ljenergy(r2, i, j, nat, natparam, nonnatparam, nnepsil) - ljenergy(cut2, i, j, nat, natparam, nonnatparam, nnepsil)
+
+def cgetLJenergy_list(mpos, n, nlist, natparam, energy, nonnatparam, nnepsil, cutoff, r2_array, E_array):
+    i, j, p = nlist[:n].T
+    rvec = mpos[i] - mpos[j]
+    r2_array[:] = dot(rvec, rvec)
+    k = numpy.flatnonzero(r2_array < cutoff*cutoff)
+    E_array[k] = listenergy(r2_array[k], i[k], j[k], p[k], natparam, nonnatparam, nnepsil, cutoff)
+    energy[0] += numpy.sum(E_array[k])
+
+def cgetLJenergy_listupdater(mpos, n, nlist, natparam, nonnatparam, nnepsil, cutoff, nsigma2, r2, E, dE, dnc, change, undok, undor2, undoE):
+    i, j, p = nlist[:n].T
+    k = numpy.flatnonzero(change[i] != change[j])
+    undolist(undok, undor2, undoE, dnc, k, r2, E)
+    i, j, p = i[k], j[k], p[k]
+    rvec = mpos[i] - mpos[j]
+    r2k = dot(rvec, rvec)
+    contacts(dnc, r2[k], r2k, p, nsigma2)
+    r2[k] = r2k
+    e = numpy.zeros(len(k))
+    w = r2k < cutoff*cutoff
+    e[w] = listenergy(r2k[w], i[w], j[w], p[w], natparam, nonnatparam, nnepsil, cutoff)
+    dE[0] += numpy.sum(e - E[k])
+    E[k] = e
+
+def cangleenergy(param, newE, mpos, change, n):
+    i = change[:n].astype(int)
+    angle = angles(mpos, i)
+    newE[i] = param[i,0]*(angle - param[i,1])*(angle - param[i,1])
+
+def ctorsionenergy(param, newE, mpos, change, n):
+    i = change[:n].astype(int)
+    newE[i] = torsionenergies(param, i, chaindihedrals(mpos, i))
+
+def cnativecontact(mpos, nnat, natpairs, nsigma2, nc):
+    rvec = mpos[natpairs[:nnat,0]] - mpos[natpairs[:nnat,1]]
+    nc[0] += numpy.sum(dot(rvec, rvec) < nsigma2[:nnat])
+
+def cdihedral(mpos, n, rnge, newdihed):
+    i = rnge[:n].astype(int)
+    newdihed[i] = chaindihedrals(mpos, i)
+
+def cframeenergy(frames, F, numbeads, nnat, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, nsigma2, energy, nc):
+    i, j = pairs(numbeads)
+    nat = nativelabels(natpairs, nnat, numbeads)
+    native = nat >= 0
+    a = numpy.arange(numbeads-2)
+    t = numpy.arange(numbeads-3)
+    for f in range(F):
+        rvec = frames[f,i] - frames[f,j]
+        r2 = dot(rvec, rvec)
+        nc[f] += numpy.sum(r2[native] < nsigma2[nat[native]])
+        if cutoff:
+            k = numpy.flatnonzero(r2 < cutoff*cutoff)
+            E = listenergy(r2[k], i[k], j[k], nat[k], natparam, nonnatparam, nnepsil, cutoff)
+            n = native[k]
+        else:
+            E = ljenergy(r2, i, j, nat, natparam, nonnatparam, nnepsil)
+            n = native
+        energy[f,0] += numpy.sum(E[n])
+        energy[f,1] += numpy.sum(E[~n])
+        angle = angles(frames[f], a)
+        energy[f,2] += numpy.sum(angleparam[a,0]*(angle - angleparam[a,1])*(angle - angleparam[a,1]))
+        energy[f,3] += numpy.sum(torsionenergies(torsparam, t, chaindihedrals(frames[f], t)))
+
+#==========================================
+# HMCFORCE KERNELS
+#==========================================
+
+def angleforces(forces, angleparam, bonds, d, rki, numbeads):
+    """Kernel of HMCforce.cangleforces, returns the bond angles"""
+    ba = bonds[:numbeads-2]
+    bc = -bonds[1:numbeads-1]
+    dd = d[:numbeads-2]*d[1:numbeads-1]
+    angle = numpy.arccos(dot(ba, bc)/dd)
+    dV = 2*angleparam[:numbeads-2,0]*(angle - angleparam[:numbeads-2,1])/-numpy.sin(angle)
+    fp = (dV/dd)[:,numpy.newaxis]*rki[:numbeads-2]
+    Fi = fp - ba*(dot(ba, fp)/dot(ba, ba))[:,numpy.newaxis]
+    Fk = -fp + bc*(dot(bc, fp)/dot(bc, bc))[:,numpy.newaxis]
+    forces[:-2] += Fi
+    forces[1:-1] += -Fi - Fk
+    forces[2:] += Fk
+
+def dihedforces(forces, torsparam, bonds, dsq, d, numbeads):
+    """Kernel of HMCforce.cdihedforces, returns the dihedral angles"""
+    x1 = bonds[:numbeads-3]
+    x2 = -bonds[1:numbeads-2]
+    x3 = bonds[2:numbeads-1]
+    m = numpy.cross(x1, x2)
+    n = numpy.cross(x2, x3)
+    dihed = dihedrals(x1, x2, x3)
+    p = torsionterms(torsparam, numpy.arange(numbeads-3))
+    dV = -numpy.sum(p[:,:,0]*p[:,:,1]*numpy.sin(p[:,:,1]*dihed[:,numpy.newaxis] - p[:,:,2]), axis=1)
+    Fi = (-dV*d[1:numbeads-2]/dot(m, m))[:,numpy.newaxis]*m
+    Fl = (dV*d[1:numbeads-2]/dot(n, n))[:,numpy.newaxis]*n
+    a = (dot(x1, x2)/dsq[1:numbeads-2])[:,numpy.newaxis]
+    b = (dot(x2, x3)/dsq[1:numbeads-2])[:,numpy.newaxis]
+    forces[:-3] += Fi
+    forces[1:-2] += (a-1)*Fi - b*Fl
+    forces[2:-1] += -a*Fi + (b-1)*Fl
+    forces[3:] += Fl
+    return dihed
+
+def cdihedforces(forces, torsparam, numbeads, bonds, dsq, d):
+    dihedforces(forces, torsparam, bonds, dsq, d, numbeads)
+
+def cangleforces(forces, angleparam, numbeads, bonds, rki, d):
+    angleforces(forces, angleparam, bonds, d, rki, numbeads)
+
+def nonbondedforces(forces, F, numbeads):
+    i, j = pairs(numbeads)
+    pairforces(forces, i, j, F)
+
+def cnonbondedforces(forces, mpos, numbeads, nnat, natpairs, natparam, nonnatparam, nnepsil):
+    i, j = pairs(numbeads)
+    ljforce(forces, mpos, i, j, nativelabels(natpairs, nnat, numbeads), natparam, nonnatparam, nnepsil)
+
+def cnonbondedforces_list(forces, mpos, n, nlist, natparam, nonnatparam, nnepsil, cutoff):
+    i, j, p = nlist[:n].T
+    rvec = mpos[i] - mpos[j]
+    k = dot(rvec, rvec) < cutoff*cutoff
+    ljforce(forces, mpos, i[k], j[k], p[k], natparam, nonnatparam, nnepsil)
+
+def bonded(forces, mpos, bonds, dsq, d, numbeads, angleparam, torsparam, energies, angE, torsE):
+    """bondedcode of HMCforce"""
+    angleforces(forces, angleparam, bonds, d, mpos[:-2] - mpos[2:], numbeads)
+    dihed = dihedforces(forces, torsparam, bonds, dsq, d, numbeads)
+    torsE[:] = 0
+    if energies:
+        ba = bonds[:numbeads-2]
+        bc = -bonds[1:numbeads-1]
+        angle = numpy.arccos(dot(ba, bc)/numpy.sqrt(dot(ba, ba)*dot(bc, bc)))
+        angE[:] = angleparam[:numbeads-2,0]*(angle - angleparam[:numbeads-2,1])*(angle - angleparam[:numbeads-2,1])
+        torsE[:] = torsionenergies(torsparam, numpy.arange(numbeads-3), dihed)
+
+def cgetforces(forces, mpos, bonds, dsq, d, numbeads, nnat, natpairs, natparam, nonnatparam, nnepsil, angleparam, torsparam, energies, r2_array, E_array, energy, angE, torsE):
+    bonded(forces, mpos, bonds, dsq, d, numbeads, angleparam, torsparam, energies, angE, torsE)
+    i, j = pairs(numbeads)
+    nat = nativelabels(natpairs, nnat, numbeads)
+    r2 = ljforce(forces, mpos, i, j, nat, natparam, nonnatparam, nnepsil)
+    if energies:
+        r2_array[:] = r2
+        E_array[:] = ljenergy(r2, i, j, nat, natparam, nonnatparam, nnepsil)
+        energy[0] += numpy.sum(E_array)
+
+def cgetforces_list(forces, mpos, bonds, dsq, d, numbeads, n, nlist, natparam, nonnatparam, nnepsil, angleparam, torsparam, cutoff, energies, r2_array, E_array, energy, angE, torsE):
+    bonded(forces, mpos, bonds, dsq, d, numbeads, angleparam, torsparam, energies, angE, torsE)
+    i, j, p = nlist[:n].T
+    rvec = mpos[i] - mpos[j]
+    r2 = dot(rvec, rvec)
+    k = numpy.flatnonzero(r2 < cutoff*cutoff)
+    ljforce(forces, mpos, i[k], j[k], p[k], natparam, nonnatparam, nnepsil)
+    if energies:
+        r2_array[:] = r2
+        E_array[k] = listenergy(r2[k], i[k], j[k], p[k], natparam, nonnatparam, nnepsil, cutoff)
+        energy[0] += numpy.sum(E_array[k])
+
+def cgetsurfforce(forces, prot_coord, surf_coord, numbeads, numint, ep_in, sig_in, scale):
+    nsurf = numint/numbeads
+    x = surf_coord[:nsurf,0][:,numpy.newaxis] - prot_coord[:,0]
+    y = surf_coord[:nsurf,1][:,numpy.newaxis] - prot_coord[:,1]
+    z = 0 - prot_coord[:,2] + 0*x
+    r2 = x*x + y*y + z*z
+    s, b = numpy.nonzero(r2 < 400)
+    x, y, z, r2 = x[s,b], y[s,b], z[s,b], r2[s,b]
+    sc = scale[s*numbeads + b]
+    r = numpy.sqrt(r2)
+    dV = sig_in*sig_in/r2
+    dV6 = dV*dV*dV
+    dV = sc*ep_in*(-(12/sc + 144)*dV6*dV6/r + 180*dV6*dV*dV/r - 24*dV6/r)
+    F = -dV/r
+    for k, comp in enumerate((x, y, z)):
+        forces[:,k] -= numpy.bincount(b, F*comp, minlength=numbeads)
+
+def cgetsurfforce_old(forces, prot_coord, surf_coord, numbeads, numint, param, scale):
+    i = numpy.arange(numint)
+    rvec = surfvectors(prot_coord, surf_coord, numbeads, i)
+    rvec[:,2] = -prot_coord[i % numbeads, 2]
+    r2 = dot(rvec, rvec)
+    k = numpy.flatnonzero(r2 < 400)
+    r = numpy.sqrt(r2[k])
+    dV = param[k,1]*param[k,1]/r2[k]
+    dV = dV*dV*dV
+    dV = param[k,0]*(-12*dV*dV/r + 12*scale*dV/r)
+    F = -dV/r
+    for c in range(3):
+        forces[:,c] -= numpy.bincount(k % numbeads, F*rvec[k,c], minlength=numbeads)
+
+def cgetsurfforce_grid(forces, prot_coord, numbeads, grid, gridparam, scale):
+    i, u, v, f, fz = surfgrid(prot_coord, numpy.arange(numbeads), grid, gridparam)
+    dx, dy = gridparam[3:5]
+    for l in range(2):
+        s = 1. if l == 0 else scale[i]
+        F = f[l]
+        forces[i,0] -= s*((1-v)*(F[1][0] - F[0][0]) + v*(F[1][1] - F[0][1]))/dx
+        forces[i,1] -= s*((1-u)*(F[0][1] - F[0][0]) + u*(F[1][1] - F[1][0]))/dy
+        forces[i,2] -= s*bilinear(u, v, fz[l])
+
+def cshake(bonds, v_half, h, m, dsq, maxloop, numbeads, tol, loops):
+    # the sweeps of the C kernel are sequential, the same constraints are solved to tol
+    # with the Newton iterations of ctridshake instead
+    n = numbeads - 1
+    ctridshake(bonds, v_half, h, m, dsq, maxloop, n, tol, loops, numpy.empty(n), numpy.empty(n))
+
+def crattle(bonds, vel, m, dsq, maxloop, numbeads, tol, loops):
+    # same for the linear RATTLE constraints, solved exactly by ctridrattle
+    n = numbeads - 1
+    ctridrattle(bonds, vel, m, dsq, n, numpy.empty(n), numpy.empty(n))
+    loops[0] = 1
+
+def tridsolve(sub, diag, sup, rhs, lam, cp):
+    """Solves the tridiagonal equations of HMCforce.tridcode with LAPACK"""
+    ab = numpy.zeros((3,len(rhs)))
+    ab[0,1:] = sup[:-1]
+    ab[1] = diag
+    ab[2,:-1] = sub[1:]
+    lam[:] = scipy.linalg.solve_banded((1,1), ab, rhs)
+
+def constraintcorrection(vel, lam, m, bonds):
+    vel[:-1] -= (lam/m[:-1])[:,numpy.newaxis]*bonds
+    vel[1:] += (lam/m[1:])[:,numpy.newaxis]*bonds
+
+def ctridshake(bonds, v_half, h, m, dsq, maxloop, n, tol, loops, lam, cp):
+    m = m[:n+1]
+    while loops[0] < maxloop:
+        s = bonds + h*(v_half[:-1] - v_half[1:])
+        rhs = dot(s, s) - dsq[:n]
+        if numpy.max(numpy.abs(rhs)) < tol:
+            break
+        sub = numpy.zeros(n)
+        sup = numpy.zeros(n)
+        sub[1:] = -2.0*h*dot(s[1:], bonds[:-1])/m[1:-1]
+        sup[:-1] = -2.0*h*dot(s[:-1], bonds[1:])/m[1:-1]
+        diag = 2.0*h*dot(s, bonds)*(1.0/m[:-1] + 1.0/m[1:])
+        tridsolve(sub, diag, sup, rhs, lam, cp)
+        constraintcorrection(v_half, lam, m, bonds)
+        loops[0] += 1
+
+def ctridrattle(bonds, vel, m, dsq, n, lam, cp):
+    m = m[:n+1]
+    sub = numpy.zeros(n)
+    sup = numpy.zeros(n)
+    sub[1:] = -dot(bonds[1:], bonds[:-1])/m[1:-1]
+    sup[:-1] = -dot(bonds[:-1], bonds[1:])/m[1:-1]
+    diag = dot(bonds, bonds)*(1.0/m[:-1] + 1.0/m[1:])
+    tridsolve(sub, diag, sup, dot(bonds, vel[:-1] - vel[1:]), lam, cp)
+    constraintcorrection(vel, lam, m, bonds)
+
+#==========================================
+# MOVESET KERNELS
+#==========================================
+
+def cglobalcrank(coord, theta, numbeads):
+    # every bead is placed from the already moved previous bead
+    for m in range(1, numbeads-1):
+        AB = coord[m] - coord[m-1]
+        AC = coord[m+1] - coord[m-1]
+        dotAC = dot(AC, AC)
+        x = AC/dotAC**.5
+        y = AB - dot(AB, AC)/dotAC*AC
+        y = y/dot(y, y)**.5
+        frame = numpy.array([x, y, numpy.cross(x, y)])
+        c = numpy.cos(theta[m-1])
+        s = numpy.sin(theta[m-1])
+        bt = numpy.dot(frame, AB)
+        coord[m] = coord[m-1] + numpy.dot(numpy.array([bt[0], c*bt[1] + s*bt[2], -s*bt[1] + c*bt[2]]), frame)
+
+def pivotmove(coord_old, coord, m, rand, theta, numbeads, bend):
+    if rand < .5:
+        n, end = 1, numbeads - 1
+    else:
+        n, end = -1, 0
+    frame, angle = pivotframe(coord, m, n, bend)
+    rotatechain(coord, coord_old, m, n, end, frame, numpy.cos(theta), numpy.sin(theta))
+    return angle
+
+def caxistorsion(coord_old, coord, m, rand, theta, numbeads):
+    pivotmove(coord_old, coord, m, rand, theta, numbeads, False)
+
+def canglebend(coord_old, coord, m, rand, theta, jac, numbeads):
+    angle = pivotmove(coord_old, coord, m, rand, theta, numbeads, True)
+    jac[0] = numpy.sin(angle - theta)/numpy.sin(angle)
+
+def maket(c, s, cp, sp):
+    return numpy.array([[-c, s, 0], [-cp*s, -cp*c, -sp], [-sp*s, -sp*c, cp]])
+
+def parrotjac(ulab, u1, u2):
+    return abs(dot(ulab, numpy.cross(u1, u2)))/(dot(u1, u1)*dot(u2, u2))**.5
+
+def cparrot(coord_old, coord, m, theta, branch, numbeads, jac, closed):
+    B = coord_old[1:] - coord_old[:-1]
+    c = numpy.empty(4)
+    s = numpy.empty(4)
+    for k in range(4):
+        i = m - 2 + k
+        if i + 2 < numbeads:
+            a = angles(coord_old, numpy.array([i]))[0]
+        else:
+            a = 68*numpy.pi/180
+        c[k] = numpy.cos(a)
+        s[k] = numpy.sin(a)
+    dihed = [0., 0.]
+    cdihed = [0., -1.]
+    for k in range(2):
+        i = m - 2 + 2*k
+        if i + 3 >= numbeads:
+            break
+        BA = coord_old[i] - coord_old[i+1]
+        BC = coord_old[i+2] - coord_old[i+1]
+        CD = coord_old[i+2] - coord_old[i+3]
+        p2 = numpy.cross(BC, CD)
+        a = dot(BC, BC)**.5*dot(BA, p2)
+        b = dot(numpy.cross(BA, BC), p2)
+        dihed[k] = numpy.arctan2(a, b)
+        cdihed[k] = b/(a*a + b*b)**.5
+    Nmn = 1. if cdihed[1] > .999 else 2.
+    T0 = maket(c[1], s[1], numpy.cos(dihed[0] + theta), numpy.sin(dihed[0] + theta))
+    if m + 2 < numbeads - 1:
+        ulab = B[m+2]/dot(B[m+2], B[m+2])**.5
+    else:
+        ulab = numpy.array([0., 0., 1.])
+    jac_old = parrotjac(ulab, B[m], B[m+1])
+    x = B[m-1]/dot(B[m-1], B[m-1])**.5
+    z1 = B[m-2]/dot(B[m-2], B[m-2])**.5
+    z = numpy.cross(x, z1)/s[0]
+    y = numpy.cross(z, x)
+    Tlab = numpy.column_stack((x, y, z))
+    v = numpy.dot(T0.T, numpy.dot(Tlab.T, ulab))
+    cosphi2 = (c[2]*c[3] - v[0])/(s[3]*s[2])
+    if abs(cosphi2) > 1:
+        closed[0] = 0 # no solutions
+        return
+    Nnm = 1. if abs(cosphi2) > .999 else 2.
+    phi2 = numpy.arccos(cosphi2) if branch < .5 else 2*numpy.pi - numpy.arccos(cosphi2)
+    sinphi2 = numpy.sin(phi2)
+    a = s[2]*c[3] + cosphi2*c[2]*s[3]
+    b = s[3]*sinphi2
+    phi1 = numpy.arctan2((b*v[1] + a*v[2])/(1 - v[0]*v[0]), (a*v[1] - b*v[2])/(1 - v[0]*v[0]))
+    T = [T0, maket(c[2], s[2], numpy.cos(phi1), numpy.sin(phi1)), maket(c[3], s[3], cosphi2, sinphi2)]
+    M = Tlab
+    for k in range(3):
+        if m + k + 1 >= numbeads:
+            break
+        M = numpy.dot(M, T[k])
+        coord[m+k+1] = coord[m+k] + M[:,0]*dot(B[m+k], B[m+k])**.5
+    if m + 3 < numbeads - 1:
+        coord[m+4:] = coord[m+3] + numpy.cumsum(B[m+3:], axis=0)
+    jac[0] = jac_old/parrotjac(ulab, coord[m+1] - coord[m], coord[m+2] - coord[m+1])*Nmn/Nnm
+
+#==========================================
+# ENSEMBLE KERNELS
+#==========================================
+
+def cmove(coords, newcoords, R, numbeads, movetype, beads, rand, theta, jac):
+    for r in range(R):
+        if movetype[r] == 2:
+            cglobalcrank(newcoords[r], theta[r], numbeads)
+        else:
+            jr = numpy.ones(1)
+            if movetype[r] == 0:
+                canglebend(coords[r], newcoords[r], beads[r], rand[r], theta[r,0], jr, numbeads)
+            else:
+                caxistorsion(coords[r], newcoords[r], beads[r], rand[r], theta[r,0], numbeads)
+            jac[r] = jr[0]
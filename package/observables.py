@@ -0,0 +1,80 @@
+'''
+Observable logs of the replicas
+
+Every replica appends one row per save point to observables<suffix> in its output directory:
+    header: magic, version, header size, then the dtype of the rows as text
+    rows:   move number, energy u0 and the fields of energyfunc.framedtype (terms, Q, z)
+The rows of an exchange interval are kept by a Log and appended in one write at its end, so
+checkpoints write nothing and the memory of a replica does not grow with the length of a run.
+Rows go to the file of the temperature (and Q pin) of the replica when they are saved, so the
+logs of a temperature-label run are per temperature without demultiplexing.
+load() maps a log with numpy.memmap, so a column is only read when it is used.
+'''
+import os
+import ast
+import numpy
+import energyfunc
+
+magic = 'GOOBS001'
+dtype = numpy.dtype([('move', numpy.int64), ('energy', numpy.float64)] + energyfunc.framedtype.descr)
+
+def create(filename):
+    """Writes the header of an empty log"""
+    descr = repr(dtype.descr)
+    size = 64*((len(magic) + 8 + len(descr))/64 + 1)
+    f = open(filename, 'wb')
+    f.write(magic)
+    numpy.array([size], dtype=numpy.int64).tofile(f)
+    f.write(descr + ' '*(size - f.tell() - len(descr)))
+    f.close()
+
+def header(filename):
+    """Returns the header size and the dtype of the rows of a log"""
+    f = open(filename, 'rb')
+    if f.read(len(magic)) != magic:
+        f.close()
+        raise IOError('%s is not an observable log' % filename)
+    size = int(numpy.fromfile(f, dtype=numpy.int64, count=1)[0])
+    descr = ast.literal_eval(f.read(size - len(magic) - 8).strip())
+    f.close()
+    return size, numpy.dtype(descr)
+
+class Log:
+    '''
+    Buffers the rows of a replica until flush(), only the buffer is pickled with the replica
+    '''
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, filename, row):
+        self.buffer.append((filename, row.copy()))
+
+    def flush(self):
+        rows = {}
+        for filename, row in self.buffer:
+            rows.setdefault(filename, []).append(row)
+        for filename, r in rows.items():
+            if not os.path.exists(filename):
+                create(filename)
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND) # a single write per file
+            os.write(fd, numpy.array(r, dtype=dtype).tostring())
+            os.close(fd)
+        self.buffer = []
+
+def load(filename):
+    """Rows of a log as a read-only structured memmap, e.g. load(filename)['energy']"""
+    size, d = header(filename)
+    n = (os.path.getsize(filename) - size)/d.itemsize # a row being written is left out
+    if n == 0:
+        return numpy.zeros(0, dtype=d)
+    return numpy.memmap(filename, dtype=d, mode='r', offset=size, shape=(n,))
+
+def truncate(filename, move):
+    """Drops the rows after move, i.e. those written after the checkpoint a run restarts from"""
+    size, d = header(filename)
+    rows = load(filename)
+    n = numpy.searchsorted(rows['move'], move, side='right')
+    del rows
+    f = open(filename, 'r+b')
+    f.truncate(size + n*d.itemsize)
+    f.close()
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+'''
+Parameter bundles: the parameters of a protein parsed once into a .npz file
+
+    parambundle.py -f GO_xxxx.pdb -p GO_xxxx.param [--surf]
+
+writes GO_xxxx.npz (GO_xxxx.surf.npz with the surface parameters) next to the .param file with
+the coordinates, masses, angle and torsion parameters, the native list and the index of every
+native pair, the nonnative parameters and, for surface runs, the surface well depth and distance
+and the hydropathy index of every bead. The bundle keeps a hash of the contents of the files it
+was parsed from, load() parses them again only if they changed, so every simulateGO.py run of a
+protein, e.g. each job of an umbrella grid, starts from the same bundle without rescanning the files.
+'''
+import os
+import hashlib
+import tempfile
+import argparse
+import numpy
+from scipy.misc import comb
+import energyfunc
+import writetopdb
+
+version = 1
+
+def sources(pdbfile, paramfile, surfpdb=None, spfile=None, hydrofile=None):
+    """Files a bundle is parsed from, the .top file is next to the .param file"""
+    files = [pdbfile, paramfile, '%stop' % paramfile[0:-5]]
+    if surfpdb:
+        files += [surfpdb, spfile, hydrofile or energyfunc.hydropathyfile]
+    return files
+
+def contenthash(files):
+    h = hashlib.sha1('version %i' % version)
+    for filename in files:
+        h.update(filename and os.path.basename(filename) or '')
+        if filename and os.path.exists(filename): # a missing surface force field file has defaults
+            f = open(filename, 'rb')
+            h.update(f.read())
+            f.close()
+        else:
+            h.update('missing')
+    return h.hexdigest()
+
+def bundlename(paramfile, surf=False):
+    return '%s%snpz' % (paramfile[0:-5], 'surf.' if surf else '')
+
+def build(filename, pdbfile, paramfile, surfpdb=None, spfile=None, hydrofile=None):
+    """Parses the parameter files of a protein and writes them to the bundle filename, returns them"""
+    coord, _ = writetopdb.get_coord(pdbfile)
+    numbeads = len(coord)
+    numint = int(numpy.around(comb(numbeads, 2)) - 2*(numbeads-2) - 1) # don't count 12 and 13 neighbors
+    natpairs, nativeparam = energyfunc.getnativelist(paramfile)
+    nonnativeparam, nnepsil = energyfunc.getLJparam(paramfile, numbeads)
+    bundle = {'version': version,
+            'hash': contenthash(sources(pdbfile, paramfile, surfpdb, spfile, hydrofile)),
+            'coord': coord,
+            'numbeads': numbeads,
+            'numint': numint,
+            'mass': energyfunc.getmass('%stop' % paramfile[0:-5], numbeads),
+            'angleparam': energyfunc.getangleparam(paramfile, numbeads),
+            'torsparam': energyfunc.gettorsionparam(paramfile, numbeads),
+            'natpairs': natpairs,
+            'nativeparam': nativeparam,
+            'nativeindex': energyfunc.nativeindex(natpairs, numbeads),
+            'nonnativeparam': nonnativeparam,
+            'nnepsil': nnepsil}
+    if surfpdb:
+        bundle['surfepsig'] = numpy.array(energyfunc.getsurfepsig(spfile))
+        bundle['hydropathy'] = energyfunc.gethydropathy(surfpdb, numbeads, hydrofile)
+    # write a temporary file next to the bundle and rename it into place, so that jobs starting
+    # at the same time never load a half written bundle
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(filename) + '.', dir=os.path.dirname(os.path.abspath(filename)))
+        f = os.fdopen(fd, 'wb')
+        numpy.savez(f, **bundle)
+        f.close()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0666 & ~umask) # mkstemp makes the file private
+        os.rename(tmp, filename)
+    except (IOError, OSError): # e.g. a read-only input directory, the parameters are still returned
+        print 'Could not write the parameter bundle %s' % filename
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+    return bundle
+
+def load(filename, pdbfile, paramfile, surfpdb=None, spfile=None, hydrofile=None):
+    """Parameters of a protein as a dict, from the bundle filename if it is up to date with the files"""
+    if os.path.exists(filename):
+        f = numpy.load(filename)
+        bundle = dict((key, f[key]) for key in f.files)
+        f.close()
+        if bundle['version'].item() == version and bundle['hash'].item() == contenthash(sources(pdbfile, paramfile, surfpdb, spfile, hydrofile)):
+            for key in ('numbeads', 'numint', 'nnepsil'):
+                bundle[key] = bundle[key].item()
+            return bundle
+    return build(filename, pdbfile, paramfile, surfpdb, spfile, hydrofile)
+
+def surfacepdb(paramfile):
+    """Original .pdb file of the protein, with the SEQRES records: xxxx.pdb next to GO_xxxx.param"""
+    return paramfile[0:paramfile.find('GO_')] + paramfile[paramfile.find('GO_')+3:-5] + 'pdb'
+
+def surfparam(bundle, nsurf, lam):
+    """(ep, sig, param) of energyfunc.getsurfparam for the surface scaling lam"""
+    ep, sig = bundle['surfepsig'].tolist()
+    return energyfunc.makesurfparam(ep, sig, bundle['hydropathy'], nsurf, lam)
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse the parameters of a protein into a bundle')
+    parser.add_argument('-f', dest='filename', required=True, help='protein GO_xxxx.pdb file')
+    parser.add_argument('-p', dest='paramfile', required=True, help='protein GO_xxxx.param file')
+    parser.add_argument('--surf', action='store_true', default=False, help='include the surface parameters (default: False)')
+    parser.add_argument('--surfparamfile', default='avgsurfparam.npy', help='surface param file (default: avgsurfparam.npy)')
+    args = parser.parse_args()
+    surfpdb = None
+    if args.surf:
+        surfpdb = surfacepdb(args.paramfile)
+    filename = bundlename(args.paramfile, args.surf)
+    build(filename, args.filename, args.paramfile, surfpdb, args.surfparamfile)
+    print 'wrote %s' % filename
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,161 @@
 import pdb
 import numpy
+import copy
+import itertools
 
 def Q_reweight(replica, k_Qpin, Qpin_new):
         return replica.u0 - k_Qpin*(replica.Q - replica.Qpin)**2 + k_Qpin*(replica.Q - Qpin_new)**2
 
-def tryswap(args, replicas, swapaccepted, swaprejected, start, beta, Q, wiw):
-    ''' helper function in tryrepeatedswaps() '''
-    for i in xrange(start, args.nreplicas-1, 2):
-        if args.Qfile:
-            # I believe form is correct
-            P = numpy.exp((replicas[wiw[i]].u0 - Q_reweight(replicas[wiw[i+1]], args.k_Qpin, Q[i]))*beta[i]
-                        - (Q_reweight(replicas[wiw[i]], args.k_Qpin, Q[i+1]) - replicas[wiw[i+1]].u0)*beta[i+1])
-            # incorrect:
-            #P = numpy.exp((replicas[i].u0 - Q_reweight(replicas[i], args.k_Qpin, Q[i+1]))*beta[i]
-            #            - (Q_reweight(replicas[i+1], args.k_Qpin, Q[i]) - replicas[i+1].u0)*beta[i+1])
-        else:
-            P = numpy.exp((replicas[wiw[i]].u0-replicas[wiw[i+1]].u0)*(beta[i]-beta[i+1]))
-        if numpy.random.random() < P:
-            swapaccepted[i] += 1
-            wiw[i], wiw[i+1] = wiw[i+1], wiw[i]
-        else:
-            swaprejected[i] += 1
+def energymatrix(args, replicas, beta, Q):
+    '''
+    E[i,j] is the energy of the configuration of replica j with the Q pin of replica i,
+    U = beta[i]*E[i,j] its reduced energy at the temperature of replica i
+    '''
+    u0 = numpy.array([replica.u0 for replica in replicas])
+    E = numpy.tile(u0, (args.nreplicas, 1))
+    if args.Qfile:
+        q = numpy.array([replica.Q for replica in replicas])
+        qpin = numpy.array([replica.Qpin for replica in replicas])
+        E += args.k_Qpin*((q - Q[:,numpy.newaxis])**2 - (q - qpin)**2) # Q_reweight
+    return E, beta[:,numpy.newaxis]*E
+
+def tryswap(args, U, swapaccepted, swaprejected, start, wiw):
+    ''' helper function in tryrepeatedswaps(), attempts the neighbor swaps (i, i+1) for i = start, start+2, ... at once '''
+    i = numpy.arange(start, args.nreplicas-1, 2)
+    a, b = wiw[i], wiw[i+1]
+    P = numpy.exp(U[i,a] + U[i+1,b] - U[i,b] - U[i+1,a])
+    accept = numpy.random.random(len(i)) < P
+    swapaccepted[i[accept]] += 1
+    swaprejected[i[~accept]] += 1
+    wiw[i[accept]], wiw[i[accept]+1] = b[accept], a[accept]
     return swapaccepted, swaprejected, wiw
 
-def swap(args, replicas, wiw):
-    ''' helper function in tryrepeatedswaps() '''
+def gibbsswap(args, U, wiw):
+    '''
+    Metropolis sweeps over all pairs of replicas, each sweep attempts the swaps of a random
+    pairing of the replicas at once
+    '''
+    n = args.nreplicas/2
+    for k in range(args.nswap):
+        pairs = numpy.random.permutation(args.nreplicas)
+        i, j = pairs[:n], pairs[n:2*n]
+        a, b = wiw[i], wiw[j]
+        accept = numpy.log(numpy.random.random(n)) < U[i,a] + U[j,b] - U[i,b] - U[j,a]
+        wiw[i[accept]], wiw[j[accept]] = b[accept], a[accept]
+    return wiw
+
+permutations = {}
+
+def infiniteswap(args, U):
+    '''
+    Draws the assignment of configurations to replicas exactly from its Boltzmann distribution,
+    the infinite swapping limit, enumerates all K! permutations so only for a few replicas
+    '''
+    K = args.nreplicas
+    if K not in permutations:
+        permutations[K] = numpy.array(list(itertools.permutations(range(K))))
+    perms = permutations[K]
+    logw = -numpy.sum(U[numpy.arange(K),perms], axis=1)
+    w = numpy.exp(logw - numpy.max(logw))
+    return perms[numpy.searchsorted(numpy.cumsum(w), numpy.random.random()*numpy.sum(w))].copy()
+
+def countswaps(swapaccepted, swaprejected, wiw):
+    ''' a swap between replica i and i+1 is counted when any configuration crossed between them '''
+    crossed = numpy.cumsum(wiw) != numpy.cumsum(numpy.arange(len(wiw)))
+    swapaccepted[crossed[:-1]] += 1
+    swaprejected[~crossed[:-1]] += 1
+    return swapaccepted, swaprejected
+
+def swapfields(args):
+    ''' attributes that follow a configuration when it is exchanged '''
+    fields = ['coord', 'u0', 'r2', 'ljE', 'uLJ', 'nlist', 'nlistref', 'torsE', 'angE', 'ncount', 'whoami'] # whoami keeps track of the individual protein in each Replica
+    if args.surf:
+        fields += ['surfE', 'surfEbead']
+    if args.Qfile:
+        fields += ['Q']
+    return fields
+
+def swap(args, replicas, wiw, fields=None, u0=None):
+    '''
+    helper function in tryrepeatedswaps()
+    u0 are the energies after the swap if they change, i.e. with Q pins
+    '''
+    if fields is None:
+        fields = swapfields(args)
     wiw_start = range(args.nreplicas)
     for i, j in enumerate(wiw):
         if wiw_start[i] != j:
             X = wiw_start.index(j)
             wiw_start[i], wiw_start[X] = wiw_start[X], wiw_start[i]
-            replicas[i].coord, replicas[X].coord = replicas[X].coord, replicas[i].coord
-            replicas[i].u0, replicas[X].u0 = replicas[X].u0, replicas[i].u0
-            replicas[i].r2, replicas[X].r2 = replicas[X].r2, replicas[i].r2
-            replicas[i].torsE, replicas[X].torsE = replicas[X].torsE, replicas[i].torsE
-            replicas[i].angE, replicas[X].angE = replicas[X].angE, replicas[i].angE
-            replicas[i].whoami, replicas[X].whoami = replicas[X].whoami, replicas[i].whoami # whoami keeps track of the individual protein in each Replica 
-            if args.surf:
-                replicas[i].surfE, replicas[X].surfE = replicas[X].surfE, replicas[i].surfE
-            if args.Zumbrella:
-                replicas[i].z_array, replicas[X].z_array = replicas[X].z_array, replicas[i].z_array
-            if args.Qfile:
-                replicas[i].Q, replicas[X].Q = replicas[X].Q, replicas[i].Q
+            for field in fields:
+                a, b = getattr(replicas[i], field), getattr(replicas[X], field)
+                setattr(replicas[i], field, b)
+                setattr(replicas[X], field, a)
     assert numpy.all(wiw_start == wiw)     
+    if u0 is not None:
+        for i in range(args.nreplicas):
+            replicas[i].u0 = u0[i]
 
-def tryrepeatedswaps(args, replicas, swapaccepted, swaprejected, protein_location, beta, Q=''):
+def setlabel(args, replica, T, Qpin=None, steps=None):
+    ''' gives a replica the temperature (and Q pin and step sizes) of another, used for temperature-label exchanges '''
+    if args.Qfile:
+        replica.u0 = Q_reweight(replica, args.k_Qpin, Qpin)
+        replica.Qpin = Qpin
+    replica.settemperature(T)
+    if steps:
+        for field, value in steps.items():
+            setattr(replica, field, copy.copy(value))
+
+def stepsizes(replica):
+    # step sizes of the moves and their tuning counts, which belong to the temperature
+    return dict((field, getattr(replica, field)) for field in ['maxtheta', 'moveparam', 'tsize', 'ntune'] if hasattr(replica, field))
+
+def labels(replicas):
+    return [(replica.T, getattr(replica, 'Qpin', None), stepsizes(replica)) for replica in replicas]
+
+def relabel(args, replicas, wiw):
+    '''
+    helper function in tryrepeatedswaps() for temperature-label exchanges
+    the configuration of replica wiw[i] takes the temperature of replica i instead of moving,
+    replicas is reordered in place so that it stays in order of temperature
+    '''
+    old = labels(replicas)
+    replicas[:] = [replicas[j] for j in wiw]
+    for i, j in enumerate(wiw):
+        if i != j:
+            setlabel(args, replicas[i], *old[i])
+
+def tryrepeatedswaps(args, replicas, swapaccepted, swaprejected, protein_location, beta, Q='', pool=None):
     if args.nreplicas == 1:
 		return swapaccepted, swaprejected, protein_location
-    wiw = range(args.nreplicas)
-    switch = 0
-    for k in range(args.nswap):
-		if switch:
-			swapaccepted, swaprejected, wiw = tryswap(args, replicas, swapaccepted, swaprejected, 0, beta, Q, wiw) #type 1 swap
-		else:	
-			swapaccepted, swaprejected, wiw = tryswap(args, replicas, swapaccepted, swaprejected, 1, beta, Q, wiw) #type 2 swap
-		switch = -(switch-1)
-    swap(args, replicas, wiw)
+    E, U = energymatrix(args, replicas, beta, Q)
+    wiw = numpy.arange(args.nreplicas)
+    if args.exchange == 'gibbs':
+		wiw = gibbsswap(args, U, wiw)
+		swapaccepted, swaprejected = countswaps(swapaccepted, swaprejected, wiw)
+    elif args.exchange == 'infinite':
+		wiw = infiniteswap(args, U)
+		swapaccepted, swaprejected = countswaps(swapaccepted, swaprejected, wiw)
+    else:
+		switch = 0
+		for k in range(args.nswap):
+			if switch:
+				swapaccepted, swaprejected, wiw = tryswap(args, U, swapaccepted, swaprejected, 0, wiw) #type 1 swap
+			else:	
+				swapaccepted, swaprejected, wiw = tryswap(args, U, swapaccepted, swaprejected, 1, wiw) #type 2 swap
+			switch = -(switch-1)
+    wiw = list(wiw)
+    u0 = None
+    if args.Qfile:
+		u0 = E[numpy.arange(args.nreplicas),wiw] # energies with the new Q pins
+    if args.swaplabels and pool:
+		replicas[:] = pool.relabel(args, wiw)
+    elif args.swaplabels:
+		relabel(args, replicas, wiw)
+    elif pool:
+		pool.swap(args, wiw, u0) # replicas are the proxies of the pool
+    else:
+		swap(args, replicas, wiw, u0=u0)
     for i in range(args.nreplicas):
 		protein_location[replicas[i].whoami].append(i) #extracts which protein went where
     return swapaccepted, swaprejected, protein_location
@@ -0,0 +1,164 @@
+import multiprocessing
+import traceback
+import numpy
+import replicaexchange
+
+class ReplicaProxy:
+    '''Energies and bookkeeping of a replica held by a worker, used for the exchange attempts'''
+    fields = ['u0', 'whoami', 'move', 'T', 'Q', 'Qpin', 'maxtheta', 'moveparam', 'tsize', 'ntune']
+
+    def __init__(self, summary):
+        self.update(summary)
+
+    def update(self, summary):
+        for field, value in summary.items():
+            setattr(self, field, value)
+
+def summarize(replica):
+    return dict((field, getattr(replica, field)) for field in ReplicaProxy.fields if hasattr(replica, field))
+
+def worker(conn, replicas, dict, seed):
+    '''
+    Keeps its replicas in memory and runs them on request
+    The parameter dictionary is passed once, when the process is started
+    '''
+    numpy.random.seed(seed)
+    while 1:
+        command, arg = conn.recv()
+        if command == 'stop':
+            conn.close()
+            break
+        try:
+            if command == 'run':
+                for i in replicas:
+                    replicas[i] = replicas[i].run(arg, dict)
+                conn.send([(i, summarize(replicas[i])) for i in replicas])
+            elif command == 'get':
+                # arg: (replica indices, fields)
+                conn.send([(i, [getattr(replicas[i], field) for field in arg[1]]) for i in arg[0]])
+            elif command == 'set':
+                # arg: (fields, [(replica index, values)])
+                for i, values in arg[1]:
+                    for field, value in zip(arg[0], values):
+                        setattr(replicas[i], field, value)
+                conn.send(True)
+            elif command == 'relabel':
+                # arg: (args, [(replica index, T, Qpin, steps)])
+                for label in arg[1]:
+                    replicaexchange.setlabel(arg[0], replicas[label[0]], *label[1:])
+                conn.send([(label[0], summarize(replicas[label[0]])) for label in arg[1]])
+            elif command == 'fetch':
+                conn.send(replicas)
+        except Exception: # sent back to the master, which raises it and stops the pool
+            conn.send(('error', traceback.format_exc()))
+
+class ReplicaPool:
+    '''
+    Replica exchange driver with long-lived worker processes
+
+    Replica i lives in worker i % nworkers for the whole simulation. Only the energies
+    of the replicas come back after each run, and only the configurations of accepted
+    exchanges travel between workers. With temperature-label exchanges only the new
+    temperatures are sent, and self.order keeps track of which replica is at which temperature.
+    '''
+    def __init__(self, replicas, dict, nworkers):
+        self.nreplicas = len(replicas)
+        self.nworkers = min(nworkers, self.nreplicas)
+        self.proxies = [ReplicaProxy(summarize(replica)) for replica in replicas]
+        self.order = range(self.nreplicas) # self.order[i] is the replica at temperature i
+        self.conns = []
+        self.workers = []
+        seeds = numpy.random.randint(0, 2**31 - 1, self.nworkers)
+        for w in range(self.nworkers):
+            held = dict_of(replicas, range(w, self.nreplicas, self.nworkers))
+            parent, child = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=worker, args=(child, held, dict, seeds[w]))
+            p.daemon = True
+            p.start()
+            self.conns.append(parent)
+            self.workers.append(p)
+
+    def collect(self, conn):
+        '''Reply of a worker, an error in the worker stops the pool and is raised here'''
+        try:
+            reply = conn.recv()
+        except EOFError:
+            self.terminate()
+            raise RuntimeError('a replica worker exited unexpectedly')
+        if isinstance(reply, tuple) and reply[0] == 'error':
+            self.terminate()
+            raise RuntimeError('a replica worker failed:\n%s' % reply[1])
+        return reply
+
+    def holder(self, i):
+        return self.conns[i % self.nworkers]
+
+    def run(self, moves):
+        for conn in self.conns:
+            conn.send(('run', moves))
+        for conn in self.conns:
+            for i, summary in self.collect(conn):
+                self.proxies[i].update(summary)
+        return [self.proxies[j] for j in self.order]
+
+    def swap(self, args, wiw, u0=None):
+        '''
+        Applies the permutation of replicaexchange.tryrepeatedswaps, replica i gets the configuration of replica wiw[i]
+        u0 are the energies after the swap if they change, i.e. with Q pins
+        '''
+        assert self.order == range(self.nreplicas)
+        fields = replicaexchange.swapfields(args)
+        moved = [i for i in range(self.nreplicas) if wiw[i] != i]
+        if not moved:
+            return
+        for conn in self.conns:
+            conn.send(('get', ([i for i in moved if self.holder(i) is conn], fields)))
+        state = {}
+        for conn in self.conns:
+            state.update(self.collect(conn))
+        if u0 is not None:
+            for i in moved:
+                state[wiw[i]][fields.index('u0')] = u0[i]
+        for conn in self.conns:
+            conn.send(('set', (fields, [(i, state[wiw[i]]) for i in moved if self.holder(i) is conn])))
+        for conn in self.conns:
+            self.collect(conn)
+        replicaexchange.swap(args, self.proxies, wiw, [field for field in fields if field in ReplicaProxy.fields], u0)
+
+    def relabel(self, args, wiw):
+        '''Temperature-label version of swap, the replica at temperature wiw[i] moves to temperature i'''
+        old = replicaexchange.labels([self.proxies[j] for j in self.order])
+        order = [self.order[j] for j in wiw]
+        moved = [(order[i],) + old[i] for i in range(self.nreplicas) if wiw[i] != i]
+        for conn in self.conns:
+            conn.send(('relabel', (args, [label for label in moved if self.holder(label[0]) is conn])))
+        for conn in self.conns:
+            for i, summary in self.collect(conn):
+                self.proxies[i].update(summary)
+        self.order = order
+        return [self.proxies[j] for j in self.order]
+
+    def fetch(self):
+        '''Returns copies of the full replicas, e.g. for checkpoints and output'''
+        replicas = [None] * self.nreplicas
+        for conn in self.conns:
+            conn.send(('fetch', None))
+        for conn in self.conns:
+            for i, replica in self.collect(conn).items():
+                replicas[i] = replica
+        return [replicas[j] for j in self.order]
+
+    def terminate(self):
+        for p in self.workers:
+            p.terminate()
+        for p in self.workers:
+            p.join()
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(('stop', None))
+        for p in self.workers:
+            p.join()
+
+def dict_of(replicas, index):
+    return dict((i, replicas[i]) for i in index)
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+'''
+Run store: the output of one or more runs in a single file
+
+simulateGO.py writes <direc>/runstore at the end of a run:
+    header:  magic, offset and length of the table (64 bytes)
+    arrays:  every column of the observable logs as states x save points (energy, Q, z, terms...),
+             coord (states x numbeads x 3), protein_location (states x exchange intervals) and
+             Qtraj_singleprot, each contiguous and aligned to 64 bytes
+    table:   json with the metadata of the run (temperature, Q pin and z pin of every state,
+             save and exchange intervals, spring constants...) and the dtype, shape and offset
+             of every array
+load() maps the file once, an array is a view that is read when it is used, so the 24 x 16
+states of an umbrella/temperature grid merged into one store are read with a single open:
+
+    runstore.py -o umbrella0/runstore umbrella0/*/runstore
+'''
+import os
+import json
+import argparse
+import numpy
+import observables
+
+magic = 'GORUN001'
+headersize = 64
+
+def write(filename, meta, arrays):
+    """Writes the arrays [(name, array)] one after the other, arrays may be a generator"""
+    f = open(filename, 'wb')
+    f.write('\0'*headersize)
+    table = {}
+    for name, a in arrays:
+        a = numpy.ascontiguousarray(a)
+        f.write('\0'*(-f.tell() % 64))
+        table[name] = {'dtype': a.dtype.str, 'shape': a.shape, 'offset': f.tell()}
+        a.tofile(f)
+    text = json.dumps({'meta': meta, 'arrays': table})
+    offset = f.tell()
+    f.write(text)
+    f.seek(0)
+    f.write(magic)
+    numpy.array([offset, len(text)], dtype=numpy.int64).tofile(f)
+    f.close()
+
+class Store:
+    '''
+    A run store mapped read-only, store.meta is the metadata and store['energy'] an array
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        if self.data[0:len(magic)].tostring() != magic:
+            raise IOError('%s is not a run store' % filename)
+        offset, length = self.data[8:24].view(numpy.int64)
+        table = json.loads(self.data[offset:offset+length].tostring())
+        self.meta = table['meta']
+        self.table = table['arrays']
+
+    def keys(self):
+        return sorted(self.table)
+
+    def __contains__(self, name):
+        return name in self.table
+
+    def __getitem__(self, name):
+        a = self.table[name]
+        return numpy.ndarray(tuple(a['shape']), dtype=numpy.dtype(str(a['dtype'])), buffer=self.data, offset=a['offset'])
+
+    def index(self, T=None, Qpin=None, zpin=None):
+        """States at the temperature, Q pin and z pin given, compared as in the file names (int(T), %2.2f Q pin, int(z pin))"""
+        states = range(self.meta['nstates'])
+        for key, value, name in (('T', T, '%i'), ('Qpin', Qpin, '%2.2f'), ('zpin', zpin, '%i')):
+            if value is not None:
+                states = [k for k in states if self.meta[key][k] is not None and name % self.meta[key][k] == name % value]
+        return numpy.array(states, dtype=int)
+
+def load(filename):
+    return Store(filename)
+
+def fromrun(filename, meta, replicas, protein_location):
+    """Writes the run store of the replicas from their observable logs, one column at a time"""
+    logs = [replica.observables() for replica in replicas]
+    meta = dict(meta)
+    meta.update({'nstates': len(replicas),
+                'T': [float(replica.T) for replica in replicas],
+                'Qpin': [float(replica.Qpin) if hasattr(replica, 'Qpin') else None for replica in replicas],
+                'zpin': [float(replica.z_pin) if hasattr(replica, 'z_pin') else None for replica in replicas],
+                'suffix': [replica.suffix for replica in replicas],
+                'runs': [os.path.dirname(os.path.abspath(filename))]*len(replicas)})
+    def arrays():
+        for field in observables.dtype.names:
+            yield field, numpy.array([log[field] for log in logs])
+        yield 'coord', numpy.array([replica.coord for replica in replicas])
+        location = numpy.array(protein_location, dtype=numpy.int64)
+        yield 'protein_location', location
+        if meta['swap'] != meta['totmoves']:
+            k = meta['swap']/meta['save']
+            Q = numpy.zeros((len(replicas), meta['totmoves']/meta['save'] + 1))
+            for i in xrange(location.shape[1]):
+                for j in range(len(replicas)):
+                    Q[j,k*i+1:k*(i+1)+1] = logs[location[j,i]]['Q'][k*i+1:k*(i+1)+1]
+            yield 'Qtraj_singleprot', Q
+    write(filename, meta, arrays())
+
+def merge(filename, filenames):
+    """Concatenates the states of run stores with the same save points, e.g. the z pins of an umbrella grid"""
+    stores = [load(f) for f in filenames]
+    meta = dict(stores[0].meta)
+    for store in stores[1:]:
+        for key in ('save', 'totmoves', 'numbeads'):
+            if store.meta[key] != meta[key]:
+                raise ValueError('%s of %s differs from %s' % (key, store.filename, stores[0].filename))
+    for key in ('T', 'Qpin', 'zpin', 'suffix', 'runs'):
+        meta[key] = sum([store.meta[key] for store in stores], [])
+    meta['nstates'] = len(meta['T'])
+    names = [name for name in stores[0].keys() if all(name in store for store in stores)]
+    write(filename, meta, ((name, numpy.concatenate([store[name] for store in stores])) for name in names))
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge run stores into one, e.g. the runs of an umbrella grid')
+    parser.add_argument('-o', dest='output', required=True, help='merged run store')
+    parser.add_argument('stores', nargs='+', help='run stores to merge')
+    args = parser.parse_args()
+    merge(args.output, args.stores)
+    print 'merged %i states into %s' % (load(args.output).meta['nstates'], args.output)
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,6 @@ import argparse
 from sys import stdout, exit
 import profile
 import scipy.linalg
-from scipy.misc import comb
 import os
 import pp
 import pdb
@@ -18,10 +17,16 @@ numpy.random.seed(10)
 import writetopdb
 import moveset
 import energyfunc
+import ensemble
 import replicaexchange
+import replicapool
 import simulationobject
 import surfacesimulation
 import umbrellasimulation
+import trajectory
+import observables
+import runstore
+import parambundle
 
 from simulationobject import Simulation
 from surfacesimulation import SurfaceSimulation
@@ -44,16 +49,25 @@ def parse_args():
     group_in.add_argument('-n', '--nmoves', dest='totmoves', type=int, default='10000', help='total number of moves (default: 10000)')
     group_in.add_argument('-s', '--save', type=int, default='1000', help='save interval in number of moves (default: 1000)')
     group_in.add_argument('-k', '--swap', type=int, default='1000', help='replica exchange interval in number of moves (default: 1000)')
+    group_in.add_argument('--swaplabels', action='store_true', default=False, help='exchange temperatures instead of configurations, output is still per temperature (default: False)')
     group_in.add_argument('--nswap', type=int,default=500, help='number of attempted exchanges at each (default: 500)')
+    group_in.add_argument('--exchange', default='neighbor', choices=['neighbor', 'gibbs', 'infinite'], help='neighbor swaps, --nswap sweeps of all-pair swaps, or exact infinite swapping for up to 8 replicas (default: neighbor)')
     group_in.add_argument('-w', '--writetraj', dest='writetraj', action='store_true', default=False, help='flag to write out trajectory (default: False)')
+    group_in.add_argument('--trajprecision', type=float, default=0., help='write the trajectory rounded to this precision (A) and compressed, e.g. 0.01 (default: 0, float32 frames)')
     group_in.add_argument('--id', nargs=1, dest='id', type=int, default=0, help='the simlog id number or umbrella id number (default: 0)')
     group_in.add_argument('--freq', nargs=7, dest='freq', metavar='x', type=float, default=[0,0,1,3,3,3,10], help='ratio of move frequencies (tr:ro:an:di:gc:pr:md) (default: 0:0:1:3:3:3:10)')
-    group_in.add_argument('--md', nargs=2, default=[45,50], type=float, dest='md', help='step size (fs) and number of steps for MD move (default: 45 fs, 50 steps)')
+    group_in.add_argument('--md', nargs='+', default=[45,50], type=float, dest='md', help='step size (fs) and number of steps for MD move, and optionally the number of r-RESPA substeps for the bonded forces in each step (default: 45 fs, 50 steps, 1)')
+    group_in.add_argument('--tune', type=int, default=0, metavar='MOVES', help='number of moves at the start in which each replica adapts its MC step sizes and MD time step toward 40%% (MC) and 70%% (MD) acceptance, they are fixed after that and the samples of these moves are not saved (default: 0)')
+    group_in.add_argument('--mdrefresh', type=float, default=1., help='fraction of the velocities redrawn at each MD move, below 1 the rest is kept from the last MD move and flipped on rejection (generalized HMC) (default: 1)')
+    group_in.add_argument('--constraints', default='iterative', choices=['iterative', 'direct'], help='SHAKE/RATTLE bond constraint solver for MD, iterative sweeps or direct tridiagonal solves (default: iterative)')
+    group_in.add_argument('--cutoff', type=float, default=0., help='nonbonded cutoff (A) using a neighbor list, should exceed the largest native sigma (default: 0, no cutoff)')
+    group_in.add_argument('--skin', type=float, default=3., help='neighbor list skin (A) (default: 3)')
     group_in.add_argument('-o', '--odir', default='.', help='output directory (default: ./)')
  
     group_surf = parser.add_argument_group('Surface simulation input files and parameters')
     group_surf.add_argument('--surf', action='store_true', default=False, help='surface simulation flag (default: False)')
     group_surf.add_argument('--surfparamfile', dest='surfparamfile', default='avgsurfparam.npy', help='surface param file (default: avgsurfparam.npy)')
+    group_surf.add_argument('--surfgrid', action='store_true', default=False, help='tabulate the surface potential on a grid periodic in x and y (default: False)')
     group_surf.add_argument('--scale', type=float, default=1, help='scaling of surface attraction strength (default: 1)')
 
     group_umb = parser.add_argument_group('Umbrella simulation input files and parameters')
@@ -64,6 +78,8 @@ def parse_args():
 
     group_misc = parser.add_argument_group('Other specifications')
     group_misc.add_argument('--cluster', action='store_true', default=False, help='flag for running on cluster')
+    group_misc.add_argument('--ensemble', action='store_true', default=False, help='run all replicas in this process with batched moves, only angle bend, torsion and crankshaft moves (default: False)')
+    group_misc.add_argument('--workers', type=int, default=0, help='number of persistent local worker processes holding the replicas (default: 0, use pp)')
     group_misc.add_argument('--restart', action='store_true', default=False, help='restart from checkpoint files')
     group_misc.add_argument('--extend', nargs=1, metavar='ID', dest='extend', type=int, default=0, help='id number of existing simulation to extend')
 
@@ -143,23 +159,24 @@ def savestate(args, direc, replicas, protein_location):
     output = open('%s/cptstate.pkl' % direc, 'wb')
     cPickle.dump(replicas[0].move, output)
     cPickle.dump(protein_location, output)
+    cPickle.dump([replicaexchange.stepsizes(replica) for replica in replicas], output)
     output.close()
-    for i in range(args.nreplicas):
-        replicas[i].saveenergy()
-        replicas[i].savenc()
+    for i in range(args.nreplicas): # the observables are already in their logs
         replicas[i].savecoord()
-        if args.surf:
-            replicas[i].savesurfenergy()
-        if args.Zumbrella:
-            replicas[i].save_z()
 
 def loadstate(direc, replicas, protein_location):
     input = open('%s/cptstate.pkl' % direc, 'rb')
     move = cPickle.load(input)
     protein_location = cPickle.load(input)
+    try:
+        steps = cPickle.load(input)
+    except EOFError: # checkpoint without step sizes
+        steps = [{}] * len(replicas)
     input.close()
     for i in range(len(replicas)):
        	replicas[i].loadstate()
+        for field, value in steps[i].items():
+            setattr(replicas[i], field, value)
         replicas[i].move = move
         replicas[protein_location[i][-1]].whoami = i 
     return move, replicas, protein_location
@@ -171,15 +188,27 @@ def main():
     # --- process inputs --- #
     # to do: add some checks to input, e.g. files exist, nmoves > save
     args = parse_args()
-    coord,_ = writetopdb.get_coord(args.filename)
-    numbeads=len(coord)
-    mass = energyfunc.getmass('%stop' % (args.paramfile[0:-5]), numbeads)
+    # parameters parsed from the .pdb, .param and .top files once, see parambundle.py
+    sfile = parambundle.surfacepdb(args.paramfile) if args.surf else None
+    param = parambundle.load(parambundle.bundlename(args.paramfile, args.surf), args.filename, args.paramfile, sfile, args.surfparamfile)
+    coord = param['coord']
+    numbeads = param['numbeads']
+    mass = param['mass']
     T = get_temperature(args)
+    if args.ensemble and (args.surf or args.Qfile or args.freq[5] or args.freq[6]):
+        exit('The batched ensemble only runs angle bend, torsion and crankshaft moves of non-surface, non-Q simulations')
+    if args.exchange == 'infinite' and args.nreplicas > 8:
+        exit('Infinite swapping enumerates all permutations of the replicas, use --exchange gibbs for more than 8 replicas')
+    if len(args.md) not in (2, 3) or min(args.md[1:]) < 1:
+        exit('--md takes the step size, the number of steps and optionally the number of r-RESPA substeps')
+    if not 0 < args.mdrefresh <= 1:
+        exit('--mdrefresh is a fraction in (0, 1]')
     beta = 1/(kb*T)
     percentmove = get_movefreq(args)
-    tsize, tsteps = args.md
+    tsize, tsteps = args.md[:2]
     tsize /= 100. # input is in fs
     tsteps = int(tsteps)
+    tinner = int(args.md[2]) if len(args.md) == 3 else 1
     direc = set_up_dir(args)
     if args.Qfile:
         Q = numpy.loadtxt(args.Qfile)
@@ -194,7 +223,7 @@ def main():
     if args.Qfile:
         print '    Running Q umbrella sampling with restraints at:', Q
     if args.Zumbrella:
-        print '    Running surface umbrella sampling simulation with pinning at %f A' % args.umbrella
+        print '    Running surface umbrella sampling simulation with pinning at %f A' % args.Zumbrella
         assert(args.surf == True)
     if args.surf:
         print '    Running surface simulation'
@@ -206,34 +235,46 @@ def main():
     print 'Save interval:', args.save
     print 'Replica exchange interval:', args.swap
     print 'Swaps at each exchange point:', args.nswap
+    print 'Exchange scheme:', args.exchange
+    if args.swaplabels:
+        print 'Exchanging temperatures instead of configurations'
     print 'Ratio of moves frequencies (tr:rot:ang:dih:crank:parrot:MD):', args.freq
     print 'MD time step:', args.md[0],' fs'
     print 'MD steps per move:', args.md[1]
+    if tinner > 1:
+        print 'r-RESPA bonded substeps per MD step:', tinner
+    print 'MD bond constraint solver:', args.constraints
+    if args.tune:
+        print 'Step sizes tuned in the first %i moves' % args.tune
+    if args.mdrefresh < 1:
+        print 'Generalized HMC, fraction of velocities refreshed per MD move:', args.mdrefresh
+    if args.cutoff:
+        print 'Nonbonded cutoff: %f A with %f A neighbor list skin' % (args.cutoff, args.skin)
     print ''
 
     # --- get parameters from .param file --- #
-    angleparam = energyfunc.getangleparam(args.paramfile, numbeads)
-    torsparam = energyfunc.gettorsionparam(args.paramfile, numbeads)
+    angleparam = param['angleparam']
+    torsparam = param['torsparam']
     
     # --- pregenerate list of interactions --- #
-    numint = numpy.around(comb(numbeads, 2)) # number of interactions
-    numint = numint - 2 * (numbeads - 2) - 1 # don't count 12 and 13 neighbors
+    numint = param['numint'] # number of interactions, not counting 12 and 13 neighbors
     
     # --- get native LJ parameter --- #
-    nativeparam = energyfunc.getnativefix_n(args.paramfile, numint, numbeads) # [ones and zeros, native epsilon, native sigma]
-    totnc = numpy.sum(nativeparam[:,0]) #total native contacts
+    natpairs, nativeparam = param['natpairs'], param['nativeparam'] # [bead i, bead j], [native epsilon, native sigma]
+    totnc = float(len(natpairs)) #total native contacts, a float so Q = nc/totnc is not truncated
     nativecutoff2 = 1.2**2
-    nsigma2 = nativecutoff2 * nativeparam[:,2] * nativeparam[:,2]
+    nsigma2 = nativecutoff2 * nativeparam[:,1] * nativeparam[:,1]
+    natlabels = energyfunc.nativelabels(natpairs, numint, numbeads) # native index of every interaction, -1 for nonnative
     
     # --- get nonnative LJ parameter --- #
-    (nonnativesig, nnepsil) = energyfunc.getLJparam_n(args.paramfile, numbeads, numint) #[nonnative sigmas for every interaction, epsilon (one value)]
-    nonnatindex = -1 * (nativeparam[:,0] - 1) # array of ones and zeros
-    nonnativeparam = numpy.column_stack((nonnatindex, nonnativesig)) #[ones and zeros, nonnative sigma]
+    nonnativeparam, nnepsil = param['nonnativeparam'], param['nnepsil'] #[nonnative sigma of every bead, epsilon (one value)]
     
     # --- set Simulation class variables --- #
     Simulation.angleparam = angleparam
     Simulation.torsparam = torsparam
     Simulation.totnc = totnc
+    Simulation.natpairs = natpairs
+    Simulation.natlabels = natlabels
     Simulation.nativeparam = nativeparam
     Simulation.nsigma2 = nsigma2
     Simulation.nonnativeparam = nonnativeparam
@@ -245,11 +286,17 @@ def main():
     Simulation.mass = mass
     Simulation.percentmove = percentmove
     Simulation.tsize = tsize
+    Simulation.tunemoves = args.tune
     Simulation.tsteps = tsteps
+    Simulation.cutoff = args.cutoff
+    Simulation.skin = args.skin
     
     # --- put class variables in a dictionary for pprun --- #
     dict = {'tsize':tsize,
             'tsteps':tsteps,
+            'tinner':tinner,
+            'mdrefresh':args.mdrefresh,
+            'tunemoves':args.tune,
             'percentmove':percentmove,
             'numbeads':numbeads,
             'save':args.save, 
@@ -257,13 +304,18 @@ def main():
             'numint':numint, 
             'angleparam':angleparam, 
             'torsparam':torsparam, 
+            'natpairs':natpairs, 
+            'natlabels':natlabels,
             'nativeparam':nativeparam, 
             'nonnativeparam':nonnativeparam, 
             'nnepsil':nnepsil, 
             'nsigma2':nsigma2, 
             'writetraj':args.writetraj, 
             'mass':mass,
-            'totnc':totnc}
+            'totnc':totnc,
+            'cutoff':args.cutoff,
+            'skin':args.skin,
+            'constraints':args.constraints}
 
     # --- set up surface --- #
     if args.surf:
@@ -276,16 +328,23 @@ def main():
         surfacesimulation.writesurf('surface.pdb',surface)
         nsurf = len(surface)
         nspint = nsurf*numbeads # surface-protein interactions
-        sfile = args.paramfile[0:args.paramfile.find('GO_')]+args.paramfile[args.paramfile.find('GO_')+3:-5] + 'pdb'
-        surfparam = energyfunc.getsurfparam(sfile, args.surfparamfile, numbeads, nsurf, nspint, args.scale)
+        surfparam = parambundle.surfparam(param, nsurf, args.scale)
         SurfaceSimulation.scale = args.scale
         SurfaceSimulation.surface = surface
         SurfaceSimulation.nsurf = nsurf
         SurfaceSimulation.nspint = nspint
         SurfaceSimulation.surfparam = surfparam
+        if args.surfgrid:
+            surfgrid, gridparam = surfacesimulation.getsurfgrid(surface, spacing, surfparam[0], surfparam[1])
+        else:
+            surfgrid, gridparam = None, None
+        SurfaceSimulation.surfgrid = surfgrid
+        SurfaceSimulation.gridparam = gridparam
         dict.update({'nspint':nspint, 
                     'nsurf':nsurf, 
                     'surfparam':surfparam, 
+                    'surfgrid':surfgrid, 
+                    'gridparam':gridparam, 
                     'surface':surface, 
                     'xlength':xlength, 
                     'ylength':ylength, 
@@ -295,6 +354,8 @@ def main():
         print '-----Surface Details-----'
         print 'Surface is %i by %i array of leucine residues with spacing %i A' % (xlength, ylength, spacing)
         print 'Surface energy parameters scaled by %f' % args.scale
+        if args.surfgrid:
+            print 'Surface potential tabulated on a %i by %i by %i grid' % surfgrid.shape[0:3]
         print ''
 
     if args.Qfile:
@@ -318,10 +379,6 @@ def main():
             else:
                 replicas.append(Simulation(name, os.path.abspath(direc), coord, T[i]))
         replicas[i].whoami = i
-        if args.writetraj:
-            f = open('%s/trajectory%i' %(replicas[i].out, int(replicas[i].T)), 'wb')
-            numpy.save(f,replicas[i].coord)
-            f.close()
 
     # --- begin simulation --- #
     if args.Zumbrella:
@@ -354,7 +411,9 @@ def main():
     	print 'Running pp on: '
     	print ppservers
     	print 'Starting pp with', job_server.get_ncpus(), 'workers'
-    else:
+    elif args.ensemble:
+    	print 'Running all replicas as one batched ensemble'
+    elif not args.workers:
     	# running on one machine
     	job_server = pp.Server(ppservers=())
     	print 'Starting pp with', job_server.get_ncpus(), 'workers'
@@ -381,13 +440,41 @@ def main():
     	print '    Restarting from last checkpoint...'
     	move, replicas, protein_location = loadstate(direc, replicas, protein_location)
 
+    # --- output files, with the observables and the frame at move 0 --- #
+    for i in range(args.nreplicas):
+        if args.restart:
+            observables.truncate('%s/observables%s' % (replicas[i].out, replicas[i].suffix), move) # rows after the checkpoint
+            if args.writetraj and os.path.exists('%s/trajectory%s' % (replicas[i].out, replicas[i].suffix)):
+                trajectory.grow('%s/trajectory%s' % (replicas[i].out, replicas[i].suffix), args.totmoves/args.save + 1) # -n may be larger than before
+            elif args.writetraj:
+                trajectory.create('%s/trajectory%s' % (replicas[i].out, replicas[i].suffix), numbeads, args.totmoves/args.save + 1, args.save, args.trajprecision)
+            continue
+        observables.create('%s/observables%s' % (replicas[i].out, replicas[i].suffix))
+        if args.writetraj:
+            trajectory.create('%s/trajectory%s' % (replicas[i].out, replicas[i].suffix), numbeads, args.totmoves/args.save + 1, args.save, args.trajprecision)
+        replicas[i].save_state(dict)
+        replicas[i].traj.flush()
+        replicas[i].log.flush()
+    trajectory.close() # the workers open their own files
+
+    # --- start persistent workers --- #
+    pool = None
+    if args.workers and not args.cluster and not args.ensemble:
+        pool = replicapool.ReplicaPool(replicas, dict, args.workers)
+        print 'Started %i persistent workers' % pool.nworkers
+
     ti = datetime.datetime.now()
     tcheck = ti
     for i in xrange(move/args.swap, args.totmoves/args.swap):
-        replicas = pprun(job_server, replicas, args.swap, dict)
-        job_server.wait()
+        if pool:
+            replicas = pool.run(args.swap)
+        elif args.ensemble and not args.cluster:
+            replicas = ensemble.run(replicas, args.swap, dict)
+        else:
+            replicas = pprun(job_server, replicas, args.swap, dict)
+            job_server.wait()
         if args.swap != args.totmoves:
-        	swapaccepted, swaprejected, protein_location = replicaexchange.tryrepeatedswaps(args, replicas, swapaccepted, swaprejected, protein_location, beta, Q)
+        	swapaccepted, swaprejected, protein_location = replicaexchange.tryrepeatedswaps(args, replicas, swapaccepted, swaprejected, protein_location, beta, Q, pool)
         tnow = datetime.datetime.now()
         t_remain = (tnow - ti)/(i+1)*(args.totmoves/args.swap - i - 1)
         if not args.cluster:
@@ -395,6 +482,8 @@ def main():
     	    stdout.flush()
         # checkpoint
         if tnow-tcheck > datetime.timedelta(seconds=900): #every 15 minutes
+            if pool:
+                replicas = pool.fetch()
             savestate(args, direc, replicas, protein_location)
             f = open('%s/status.txt' % direc, 'w')
             f.write('Completed %i moves out of %i moves\n' %(replicas[0].move, args.totmoves))
@@ -403,7 +492,11 @@ def main():
             tcheck=tnow
 
     # --- output --- #
-    job_server.print_stats()
+    if pool:
+        replicas = pool.fetch()
+        pool.stop()
+    elif not args.ensemble or args.cluster:
+        job_server.print_stats()
     output = open('%s/protein_location.pkl' % direc, 'wb')
     cPickle.dump(protein_location, output)
     output.close()
@@ -411,22 +504,32 @@ def main():
         replicas[i].output()
         replicas[i].saveenergy()
         replicas[i].savenc()
-        print 'The average Q is %f' %(numpy.average(replicas[i].nc))
+        replicas[i].saveterms()
+        print 'The average Q is %f' %(numpy.average(replicas[i].observables()['Q']))
         replicas[i].savecoord()
         if args.surf:
                 replicas[i].savesurfenergy()
         if args.Zumbrella:
     	    replicas[i].save_z()
-    
+
+    # --- run store, the metadata and all output arrays in one file --- #
+    meta = {'filename':args.filename,
+            'paramfile':args.paramfile,
+            'numbeads':numbeads,
+            'nreplicas':args.nreplicas,
+            'totmoves':args.totmoves,
+            'save':args.save,
+            'swap':args.swap,
+            'swaplabels':args.swaplabels,
+            'exchange':args.exchange,
+            'surf':args.surf,
+            'scale':args.scale,
+            'cutoff':args.cutoff,
+            'k_Qpin':args.k_Qpin if args.Qfile else None,
+            'k_Zpin':args.k_Zpin if args.Zumbrella else None}
+    runstore.fromrun('%s/runstore' % direc, meta, replicas, protein_location)
     if args.swap!=args.totmoves:
-        Q_trajec_singleprot = numpy.zeros((args.nreplicas, args.totmoves/args.save+1))
-        k=args.swap/args.save
-        for i in xrange(len(protein_location[0])):
-                for j in range(args.nreplicas):
-                    rep = protein_location[j][i]
-                    Q_trajec_singleprot[j,k*i+1:k*(i+1)+1] = replicas[rep].nc[k*i+1:k*(i+1)+1]
-        #Q_trajec_singleprot[:,0] = totnc
-        numpy.save('%s/Qtraj_singleprot.npy' % direc, Q_trajec_singleprot)
+        numpy.save('%s/Qtraj_singleprot.npy' % direc, runstore.load('%s/runstore' % direc)['Qtraj_singleprot'])
     for i in range(args.nreplicas-1):
         print 'swaps accepted between replica%i and replica%i: %3.2f percent' % (i, i+1, (swapaccepted[i] / float(swapaccepted[i] + swaprejected[i]) * 100))
     print 'Total swaps accepted: %i' % numpy.sum(swapaccepted)
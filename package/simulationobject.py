@@ -3,32 +3,47 @@ import numpy
 import writetopdb
 import moveset
 import energyfunc
+import trajectory
+import observables
 import pdb
 from sys import stdout
 import cPickle
 
 numpy.random.seed(10)
 
+def saveslot(move, save, tunemoves):
+    # trajectory slot of the save point at move, None for the first tunemoves moves, whose
+    # samples are not saved as the step sizes still adapt; slots count the save points after them
+    if not tunemoves:
+        return move/save
+    if move <= tunemoves:
+        return None
+    return move/save - tunemoves/save - 1
+
 class Simulation:
     kb = 0.0019872041 #kcal/mol/K
+    cutoff = 0. # nonbonded cutoff, 0 for no cutoff
+    skin = 3. # neighbor list skin
+    tunemoves = 0 # moves at the start in which the step sizes adapt, see tune()
+    mctarget = .4 # target acceptance of the MC moves while tuning
+    mdtarget = .7 # target acceptance of the MD moves while tuning
+    stepattr = 'maxtheta' # step sizes of the MC moves
+    stepindex = {'a':0, 'at':1, 'gc':2, 'p':3}
 
     def __init__(self, name, outputdirectory, coord, temp):
         self.name = name
         self.out = outputdirectory
-        self.suffix = str(int(temp)) # affixed at end of file names
         self.coord = coord
-        self.energyarray = numpy.empty(Simulation.totmoves/Simulation.save + 1)
-        self.nc = numpy.empty(Simulation.totmoves/Simulation.save + 1) #native contacts
+        self.terms = numpy.zeros((), dtype=observables.dtype) # observables of the last save point, see setterms
         self.move = 0
-        self.T = temp
-        self.maxtheta = numpy.array([5., # bend
-                        10., # torsion
-                        1./self.T * 500, # global crankshaft
-                        5.]) # ParRot move
-        self.maxtheta = self.maxtheta * numpy.pi / 180 * self.T**1.5 / 5250. * 50 / Simulation.numbeads
+        self.mdenergies = False
+        self.mdstate = None # (coord, T, velocities, force) of the next MD move, see moveset.mdcache
+        self.tsize = Simulation.tsize # MD time step, tuned per replica
+        self.ntune = {} # tuning updates per move type
+        self.traj = trajectory.Writer()
+        self.log = observables.Log()
+        self.settemperature(temp)
         self.setenergy()
-        self.energyarray[0] = self.u0
-        self.nc[0] = energyfunc.nativecontact(self.r2, Simulation.nativeparam, Simulation.nsigma2) / Simulation.totnc
 
         # Instantiate constants for move stats
         self.amoves = 0
@@ -47,13 +62,61 @@ class Simulation:
         self.movetype = ''
         #self.whoami = ''
     
+    def settemperature(self, temp):
+        # sets the temperature and the temperature dependent step sizes
+        # called again when temperatures are exchanged instead of configurations
+        self.T = temp
+        self.suffix = str(int(temp)) # affixed at end of file names
+        self.maxtheta = numpy.array([5., # bend
+                        10., # torsion
+                        1./self.T * 500, # global crankshaft
+                        5.]) # ParRot move
+        self.maxtheta = self.maxtheta * numpy.pi / 180 * self.T**1.5 / 5250. * 50 / Simulation.numbeads
+
+    def tune(self, movetype, boltz):
+        # adapts the step size of movetype toward the target acceptance with a decreasing gain,
+        # only during the first Simulation.tunemoves moves, the steps stay fixed after that
+        if self.move > Simulation.tunemoves:
+            return
+        n = self.ntune[movetype] = self.ntune.get(movetype, 0) + 1
+        if movetype == 'md':
+            self.tsize *= numpy.exp((min(1., boltz) - Simulation.mdtarget) / n**.5)
+        else:
+            getattr(self, self.stepattr)[self.stepindex[movetype]] *= numpy.exp((min(1., boltz) - Simulation.mctarget) / n**.5)
+
     def setenergy(self):
 	# sets the u0, r2, torsE, angE from the current configuration
 	# called when restarting from a checkpoint
-        self.r2, self.u0 = energyfunc.cgetLJenergy(self.coord, Simulation.numint, Simulation.numbeads, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
+        if Simulation.cutoff:
+            self.nlist = energyfunc.getneighborlist(self.coord, Simulation.numint, Simulation.numbeads, Simulation.natpairs, Simulation.cutoff + Simulation.skin)
+            self.nlistref = self.coord.copy()
+            self.r2, self.ljE, self.uLJ = energyfunc.cgetLJenergy_list(self.coord, self.nlist, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil, Simulation.cutoff)
+        else:
+            self.nlist = None
+            self.nlistref = None
+            self.r2, self.ljE, self.uLJ = energyfunc.cgetLJenergy_withE(self.coord, Simulation.numint, Simulation.numbeads, Simulation.natpairs, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
+        self.newnlist = self.nlist
+        self.newnlistref = self.nlistref
         self.torsE = energyfunc.ctorsionenergy(self.coord, numpy.zeros(Simulation.numbeads - 3), Simulation.torsparam, numpy.arange(Simulation.numbeads - 3))
         self.angE = energyfunc.cangleenergy(self.coord, numpy.zeros(Simulation.numbeads - 2), Simulation.angleparam, numpy.arange(Simulation.numbeads - 2))
-        self.u0 += numpy.sum(self.angE) + numpy.sum(self.torsE)
+        self.u0 = self.uLJ + numpy.sum(self.angE) + numpy.sum(self.torsE)
+        self.ncount = self.nativecontact(self.coord) # native contacts, updated with the energies
+        self.undo = None # interactions the last incremental LJ update changed in place
+
+    def setterms(self):
+        # energy u0, its terms and Q of the current configuration, logged at every save point
+        # the terms are kept so that analyses can reweight to other spring constants or surface scales
+        if self.nlist is None:
+            native = numpy.sum(self.ljE[energyfunc.nativeindex(Simulation.natpairs, Simulation.numbeads)])
+        else:
+            native = numpy.sum(self.ljE[self.nlist[:,2] >= 0])
+        self.terms['move'] = self.move
+        self.terms['energy'] = self.u0
+        self.terms['nativeLJ'] = native
+        self.terms['nonnativeLJ'] = self.uLJ - native
+        self.terms['angle'] = numpy.sum(self.angE)
+        self.terms['torsion'] = numpy.sum(self.torsE)
+        self.terms['Q'] = self.ncount / float(Simulation.totnc)
 
     def output(self):
         print '-------- %s Simulation Results --------' % (self.name)
@@ -71,28 +134,38 @@ class Simulation:
             print '                   %i ParRot moves rejected due to chain closure' %(self.pclosure)
         if self.mdmoves:
             print 'MD:                %d percent acceptance (%i/%i)' %(float(self.acceptedmd)/float(self.mdmoves)*100, self.acceptedmd, self.mdmoves)
+        if Simulation.tunemoves:
+            print 'tuned step sizes:  ', getattr(self, self.stepattr), 'MD %f fs' % (self.tsize*100)
 
     def loadstate(self):
         self.coord = numpy.load('%s/coord%s.npy' %(self.out, self.suffix))
         self.setenergy()
-        self.energyarray = numpy.load('%s/energy%s.npy' %(self.out, self.suffix))
-        self.nc = numpy.load('%s/fractionnative%s.npy' %(self.out, self.suffix))
 
     def loadextend(self, extenddirec):
         self.coord = numpy.load('%s/coord%s.npy' %(extenddirec, self.suffix))
         self.setenergy()
-        self.energyarray[0]=self.u0
-        self.nc[0] = energyfunc.nativecontact(self.r2, Simulation.nativeparam, Simulation.nsigma2) / Simulation.totnc
 
     def savecoord(self):
         filename = '%s/coord%s' % (self.out, self.suffix)
         numpy.save(filename, self.coord)
 
+    def observables(self):
+        return observables.load('%s/observables%s' % (self.out, self.suffix))
+
     def saveenergy(self):
+        # the .npy files are written once from the observable log at the end of a run
         filename = '%s/energy%s' % (self.out, self.suffix)
-        numpy.save(filename, self.energyarray)
+        numpy.save(filename, self.observables()['energy'])
         #print 'wrote every %d conformation energies to %s' %(Simulation.step,filename)
 
+    def saveterms(self):
+        filename = '%s/terms%s' % (self.out, self.suffix)
+        obs = self.observables()
+        terms = numpy.zeros(len(obs), dtype=energyfunc.framedtype)
+        for field in energyfunc.framedtype.names:
+            terms[field] = obs[field]
+        numpy.save(filename, terms)
+
     def savermsd(self):
         filename='%s/rmsd%s' % (self.out, self.suffix)
         numpy.save(filename, self.rmsd_array)
@@ -100,41 +173,125 @@ class Simulation:
 
     def savenc(self):
         filename = '%s/fractionnative%s' % (self.out, self.suffix)
-        numpy.save(filename, self.nc)
+        numpy.save(filename, self.observables()['Q'])
         #print 'wrote every %d fractional nativeness values to %s' %(Simulation.step,fractionfile)
 
-    def update_energy(self, torschange, angchange, dict):
+    def update_energy(self, torschange, angchange, dict, beadchange=None):
+        # beadchange labels the rigid groups of beads a move displaced, so only
+        # interactions between different groups are recomputed; None recomputes all,
+        # a single label (rigid body move) recomputes none
         Simulation.numbeads = dict['numbeads']
         Simulation.numint = dict['numint']
         Simulation.angleparam = dict['angleparam']
         Simulation.torsparam = dict['torsparam']
+        Simulation.natpairs = dict['natpairs']
+        Simulation.natlabels = dict['natlabels']
         Simulation.nativeparam = dict['nativeparam']
         Simulation.nonnativeparam = dict['nonnativeparam']
         Simulation.nnepsil = dict['nnepsil']
+        Simulation.nsigma2 = dict['nsigma2']
+        Simulation.cutoff = dict['cutoff']
+        Simulation.skin = dict['skin']
+        self.undo = None
+        if self.mdenergies:
+            # the last MD step already computed the energies of newcoord with its forces
+            self.mdenergies = False
+            self.u1 = self.newuLJ + sum(self.newtorsE)+sum(self.newangE)
+            self.newncount = self.nativecontact(self.newcoord)
+            return
+        if beadchange is not None and numpy.all(beadchange == beadchange[0]):
+            self.update_rigid()
+            return
         self.newtorsE = energyfunc.ctorsionenergy(self.newcoord, self.torsE, Simulation.torsparam, torschange)
         self.newangE = energyfunc.cangleenergy(self.newcoord, self.angE, Simulation.angleparam, angchange)
-        self.r2new, self.u1 = energyfunc.cgetLJenergy(self.newcoord, Simulation.numint, Simulation.numbeads, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
-        self.u1 += sum(self.newtorsE)+sum(self.newangE)
+        if Simulation.cutoff:
+            self.update_LJ_list(beadchange)
+        elif beadchange is None:
+            self.r2new, self.newljE, self.newuLJ = energyfunc.cgetLJenergy_withE(self.newcoord, Simulation.numint, Simulation.numbeads, Simulation.natpairs, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil)
+            self.newncount = self.nativecontact(self.newcoord)
+        else:
+            # r2 and ljE are updated in place, reject_state undoes the update
+            dLJ, dnc, self.undo = energyfunc.cgetLJenergy_updater(self.newcoord, Simulation.numbeads, Simulation.natlabels, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil, Simulation.nsigma2, self.r2, self.ljE, beadchange)
+            self.r2new = self.r2
+            self.newljE = self.ljE
+            self.newuLJ = self.uLJ + dLJ
+            self.newncount = self.ncount + dnc
+        self.u1 = self.newuLJ + sum(self.newtorsE)+sum(self.newangE)
+
+    def update_rigid(self):
+        # a rigid body move leaves every internal energy unchanged
+        self.newtorsE = self.torsE
+        self.newangE = self.angE
+        self.r2new = self.r2
+        self.newljE = self.ljE
+        self.newuLJ = self.uLJ
+        self.newncount = self.ncount
+        self.u1 = self.newuLJ + sum(self.newtorsE)+sum(self.newangE)
+        if self.nlist is not None:
+            # move the neighbor list reference with the body, newcoord = [coord 1] T
+            T = numpy.linalg.lstsq(numpy.column_stack((self.coord, numpy.ones(Simulation.numbeads))), self.newcoord, rcond=-1)[0]
+            self.newnlist = self.nlist
+            self.newnlistref = numpy.dot(numpy.column_stack((self.nlistref, numpy.ones(Simulation.numbeads))), T)
+
+    def update_LJ_list(self, beadchange):
+        # incremental updates need the neighbor list of the current configuration,
+        # full updates can reuse the latest list (e.g. the one left by an MD move)
+        if beadchange is not None:
+            self.newnlist = self.nlist
+            self.newnlistref = self.nlistref
+        if energyfunc.checkneighborlist(self.newcoord, self.newnlistref, Simulation.skin):
+            self.newnlist = energyfunc.getneighborlist(self.newcoord, Simulation.numint, Simulation.numbeads, Simulation.natpairs, Simulation.cutoff + Simulation.skin)
+            self.newnlistref = self.newcoord.copy()
+            beadchange = None
+        if beadchange is None:
+            self.r2new, self.newljE, self.newuLJ = energyfunc.cgetLJenergy_list(self.newcoord, self.newnlist, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil, Simulation.cutoff)
+            self.newncount = self.nativecontact(self.newcoord)
+        else:
+            dLJ, dnc, self.undo = energyfunc.cgetLJenergy_listupdater(self.newcoord, self.newnlist, Simulation.nativeparam, Simulation.nonnativeparam, Simulation.nnepsil, Simulation.cutoff, Simulation.nsigma2, self.r2, self.ljE, beadchange)
+            self.r2new = self.r2
+            self.newljE = self.ljE
+            self.newuLJ = self.uLJ + dLJ
+            if Simulation.cutoff*Simulation.cutoff > numpy.max(Simulation.nsigma2):
+                self.newncount = self.ncount + dnc
+            else: # contacts beyond the cutoff may be missing from the neighbor list
+                self.newncount = self.nativecontact(self.newcoord)
+
+    def nativecontact(self, coord):
+        return energyfunc.cnativecontact(coord, Simulation.natpairs, Simulation.nsigma2)
 
     def save_state(self, dict):
         Simulation.save = dict['save']
+        Simulation.natpairs = dict['natpairs']
         Simulation.nativeparam = dict['nativeparam']
         Simulation.nsigma2 = dict['nsigma2']
         Simulation.writetraj = dict['writetraj']
         Simulation.totnc = dict['totnc']
-        self.energyarray[self.move/Simulation.save] = self.u0
-        self.nc[self.move/Simulation.save] = energyfunc.nativecontact(self.r2, Simulation.nativeparam, Simulation.nsigma2) / Simulation.totnc
+        Simulation.tunemoves = dict['tunemoves']
+        slot = saveslot(self.move, Simulation.save, Simulation.tunemoves)
+        if slot is None:
+            return
+        self.setterms()
+        self.log.write('%s/observables%s' %(self.out, self.suffix), self.terms)
         if (Simulation.writetraj):
-            f = open('%s/trajectory%s' %(self.out, self.suffix), 'ab')
-            numpy.save(f,self.coord)
-            f.close()
+            self.traj.write('%s/trajectory%s' %(self.out, self.suffix), slot, self.move, self.coord)
 
     def accept_state(self):
         self.r2 = self.r2new
+        self.ljE = self.newljE
+        self.uLJ = self.newuLJ
+        self.nlist = self.newnlist
+        self.nlistref = self.newnlistref
         self.coord = self.newcoord
         self.torsE = self.newtorsE
         self.angE = self.newangE
+        self.ncount = self.newncount
         self.u0 = self.u1
+        self.undo = None
+
+    def reject_state(self):
+        if self.undo is not None:
+            energyfunc.undoLJ(self.r2, self.ljE, self.undo)
+            self.undo = None
 
     def run(self, nummoves, dict):
         Simulation.percentmove = dict['percentmove']   
@@ -145,6 +302,7 @@ class Simulation:
         mass = dict['mass']
         Simulation.tsteps = dict['tsteps']
         Simulation.tsize = dict['tsize']
+        Simulation.tunemoves = dict['tunemoves']
     
         for i in xrange(nummoves):
             randmove = numpy.random.random()
@@ -160,6 +318,7 @@ class Simulation:
                 movetype = 'a'
                 torschange = numpy.array([])
                 angchange = numpy.array([m-1])
+                beadchange = moveset.movedbeads(Simulation.numbeads, m, randdir)
     
             # axis torsion
             elif randmove < Simulation.percentmove[1]:
@@ -169,6 +328,7 @@ class Simulation:
                 movetype = 'at'
                 self.atmoves += 1
                 angchange = numpy.array([])
+                beadchange = moveset.movedbeads(Simulation.numbeads, m, randdir)
                 if randdir < .5:
                         torschange = numpy.array([m-2])
                         if m < 2:
@@ -187,6 +347,7 @@ class Simulation:
                 movetype = 'gc'
                 torschange = numpy.arange(Simulation.numbeads-3)
                 angchange = numpy.arange(Simulation.numbeads-2)
+                beadchange = None
     	
     	    # parrot move
             elif randmove < Simulation.percentmove[3]:
@@ -197,52 +358,57 @@ class Simulation:
                 if m == 1:
                     self.newcoord = moveset.caxistorsion(self.coord, m, 1, theta)
                     torschange = numpy.array([0])
+                    beadchange = moveset.movedbeads(Simulation.numbeads, m, 1)
                     jac = 1
                 elif m == Simulation.numbeads - 2:
                     self.newcoord = moveset.caxistorsion(self.coord, m, 0, theta)
                     torschange = numpy.array([m-2])
+                    beadchange = moveset.movedbeads(Simulation.numbeads, m, 0)
                     jac = 1
                 else:
-                    self.newcoord, jac = moveset.parrot(self.coord, m, randdir, theta)
-                    if numpy.any(numpy.isnan(self.newcoord)):
+                    self.newcoord, jac, torschange, closed = moveset.cparrot(self.coord, m, randdir, theta)
+                    beadchange = moveset.parrotbeads(Simulation.numbeads, m, randdir)
+                    if not closed:
                         uncloseable = True
                         self.rejected += 1
                         self.pclosure += 1
                         self.move += 1
                         del self.newcoord
                         del jac
-                    elif randdir < .5:
-                        torschange = numpy.arange(m-2,m+2)
-                        torschange = torschange[torschange<(Simulation.numbeads-3)]
-                    else:
-                        torschange = numpy.arange(Simulation.numbeads-m-5,Simulation.numbeads-m-1)
-                        torschange = torschange[torschange>-1]
-                        torschange = torschange[torschange<(Simulation.numbeads-3)]
     
             # run molecular dynamics
             else:
-                self=moveset.runMD(self, Simulation.tsteps, Simulation.tsize, dict)
+                self=moveset.runMD(self, Simulation.tsteps, self.tsize, dict)
+                if self.uncloseable:
+                    uncloseable = True
+                    self.move += 1
+                    self.tune('md', 0.)
                 movetype = 'md'
                 self.mdmoves += 1
                 torschange = numpy.arange(Simulation.numbeads - 3)
                 angchange = numpy.arange(Simulation.numbeads - 2)
+                beadchange = None
     
             # accept or reject
             if not uncloseable and movetype=='md':
-                self.update_energy(torschange, angchange, dict)
+                self.update_energy(torschange, angchange, dict, beadchange)
                 self.newH=self.u1+.5/4.184*numpy.sum(mass*numpy.sum(self.vel**2,axis=1)) # in kcal/mol
                 self.move += 1
                 boltz = numpy.exp(-(self.newH-self.oldH)/(Simulation.kb*self.T))
+                self.tune(movetype, boltz)
                 if numpy.random.random() < boltz:
                     self.accept_state()
                     self.accepted += 1
                     self.acceptedmd += 1
+                    self.mdstate = self.mdaccept
                 else:
+                    self.reject_state()
                     self.rejected += 1
             elif not uncloseable:
-                self.update_energy(torschange, angchange, dict)
+                self.update_energy(torschange, angchange, dict, beadchange)
                 self.move += 1
                 boltz = jac*numpy.exp(-(self.u1-self.u0)/(Simulation.kb*self.T))
+                self.tune(movetype, boltz)
                 if numpy.random.random() < boltz:
                     self.accept_state()
                     self.accepted += 1
@@ -255,9 +421,12 @@ class Simulation:
                     else:
                         self.acceptedp += 1
                 else:
+                    self.reject_state()
                     self.rejected += 1
             if self.move % Simulation.save == 0:
                 self.save_state(dict)
+        self.traj.flush()
+        self.log.flush()
         return self
 
 def run_no_ff(self, nummoves, dict):
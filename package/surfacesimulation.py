@@ -26,6 +26,29 @@ def getsurf(xsize, ysize, spacing):
     surfcoord -= com # centers surface at (0,0,0)
     return surfcoord
 
+def getsurfgrid(surf_coord, spacing, ep, sig, dxy=.25, dz=.2):
+    """
+    Tabulates the surface potential over one unit cell of the lattice of getsurf, periodic in x and y
+    The surface is treated as infinite, the grid runs from z = .6*sig to the 20 A cutoff
+
+    Returns:
+        grid, nx x ny x nz x 4 array: [A, B, dA/dz, dB/dz] (see energyfunc.csurfperiodic)
+        gridparam: [x0, y0, zmin, dx, dy, dz, spacing, ep, sig], (x0, y0) is the lattice origin
+    """
+    a = float(spacing)
+    b = spacing * 3.**.5
+    nx = int(numpy.ceil(a / dxy))
+    ny = int(numpy.ceil(b / dxy))
+    zmin = .6 * sig
+    nz = int(numpy.ceil((20. - zmin) / dz)) + 1
+    dz = (20. - zmin) / (nz - 1)
+    index = numpy.mgrid[0:nx,0:ny,0:nz].reshape(3,-1)
+    points = numpy.column_stack((index[0]*a/nx, index[1]*b/ny, zmin + index[2]*dz))
+    param = energyfunc.csurfperiodic(points, spacing, ep, sig)
+    grid = param[:,[0,1,4,7]].reshape((nx,ny,nz,4)).copy()
+    gridparam = numpy.array([surf_coord[0,0], surf_coord[0,1], zmin, a/nx, b/ny, dz, spacing, ep, sig])
+    return grid, gridparam
+
 def writesurf(filename, surf_coord):
     fout = open(filename, 'w')
     fout.write('HEADER   This pdb file contains the coordinates for a Go model of surface\r\n')
@@ -37,13 +60,21 @@ def writesurf(filename, surf_coord):
 
 class SurfaceSimulation(Simulation):
     kb = 0.0019872041 #kcal/mol/K
+    surfgrid = None # tabulated surface potential, None for direct summation
+    stepattr = 'moveparam'
+    stepindex = {'tr':0, 'rot':1, 'a':2, 'at':3, 'gc':4, 'p':5}
 
     def __init__(self, name, outputdirectory, coord, temp, surf_coord):
         self.coord = coord
         self.addsurface(surf_coord) # translates self.coord
         Simulation.__init__(self, name, outputdirectory, self.coord, temp) # self.coord != coord anymore
-        self.surfE_array = numpy.empty((Simulation.totmoves/Simulation.save + 1,2))
-        self.surfE_array[0,:] = self.surfE
+        self.trmoves = 0
+        self.rmoves = 0
+        self.acceptedtr = 0
+        self.acceptedr = 0
+
+    def settemperature(self, temp):
+        Simulation.settemperature(self, temp)
         self.moveparam = numpy.array([2., # translation
                         2., # rotation
                         10., # bend
@@ -51,17 +82,24 @@ class SurfaceSimulation(Simulation):
                         1., # global crankshaft
                         5.]) # ParRot move
         self.moveparam = self.moveparam * numpy.pi / 180 * self.T / 300 * 50 / Simulation.numbeads
-        self.energyarray[0] = self.u0
-        self.trmoves = 0
-        self.rmoves = 0
-        self.acceptedtr = 0
-        self.acceptedr = 0
 
     def setenergy(self):
         Simulation.setenergy(self)
-        self.surfE = energyfunc.csurfenergy(self.coord, SurfaceSimulation.surface, Simulation.numbeads, SurfaceSimulation.nspint, SurfaceSimulation.surfparam, SurfaceSimulation.scale)
+        self.surfEbead = self.surfenergy(self.coord, numpy.arange(Simulation.numbeads))
+        self.surfE = numpy.sum(self.surfEbead, axis=0)
         self.u0 += sum(self.surfE)
 
+    def setterms(self):
+        Simulation.setterms(self)
+        self.terms['surfrep'] = self.surfE[0]
+        self.terms['surfatt'] = self.surfE[1]
+
+    def surfenergy(self, coord, beads):
+        # surface energy of the given beads, len(beads) x 2
+        if SurfaceSimulation.surfgrid is None:
+            return energyfunc.csurfenergy_beads(coord, SurfaceSimulation.surface, Simulation.numbeads, SurfaceSimulation.surfparam, beads)
+        return energyfunc.csurfenergy_gridbeads(coord, beads, SurfaceSimulation.surfgrid, SurfaceSimulation.gridparam, SurfaceSimulation.surfparam[2][:Simulation.numbeads,0])
+
     def addsurface(self, surf_coord):
         self.surface = surf_coord
         ## randomly orient protein
@@ -75,37 +113,31 @@ class SurfaceSimulation(Simulation):
         if self.rmoves:
             print 'rotation:          %d percent acceptance (%i/%i)' %(float(self.acceptedr)/float(self.rmoves)*100, self.acceptedr, self.rmoves)
       
-    def loadstate(self):
-        Simulation.loadstate(self)
-        self.surfE_array = numpy.load('%s/surfenergy%s.npy' %(self.out, self.suffix))
-
-    def loadextend(self, extenddirec):
-        Simulation.loadextend(self, extenddirec) # u0 is reset
-        self.energyarray[0] = self.u0
-        self.surfE_array[0,:] = self.surfE
-
     def savesurfenergy(self):
         filename='%s/surfenergy%s' % (self.out, self.suffix)
-        numpy.save(filename, self.surfE_array)
+        obs = self.observables()
+        numpy.save(filename, numpy.column_stack((obs['surfrep'], obs['surfatt'])))
 
-    def update_energy(self, torschange, angchange, dict):
+    def update_energy(self, torschange, angchange, dict, beadchange=None):
         Simulation.numbeads = dict['numbeads']
         SurfaceSimulation.surface = dict['surface']
         SurfaceSimulation.nspint = dict['nspint']
         SurfaceSimulation.surfparam = dict['surfparam']
         SurfaceSimulation.scale = dict['scale']
-        Simulation.update_energy(self, torschange, angchange, dict)
-        self.newsurfE = energyfunc.csurfenergy(self.newcoord, SurfaceSimulation.surface, Simulation.numbeads, SurfaceSimulation.nspint, SurfaceSimulation.surfparam,SurfaceSimulation.scale)
+        SurfaceSimulation.surfgrid = dict['surfgrid']
+        SurfaceSimulation.gridparam = dict['gridparam']
+        Simulation.update_energy(self, torschange, angchange, dict, beadchange)
+        # only beads that moved (including boundary shifts) are recomputed
+        moved = numpy.flatnonzero(numpy.any(self.newcoord != self.coord, axis=1))
+        self.newsurfEbead = self.surfEbead.copy()
+        self.newsurfEbead[moved] = self.surfenergy(self.newcoord, moved)
+        self.newsurfE = numpy.sum(self.newsurfEbead, axis=0)
         self.u1 += numpy.sum(self.newsurfE)
 
-    def save_state(self, dict):
-        Simulation.save = dict['save']
-        Simulation.save_state(self, dict)
-        self.surfE_array[self.move/Simulation.save,:] = self.surfE
-
     def accept_state(self):
         Simulation.accept_state(self) 
         self.surfE = self.newsurfE
+        self.surfEbead = self.newsurfEbead
 
     def run(self, nummoves, dict):
         Simulation.numbeads = dict['numbeads']
@@ -115,6 +147,7 @@ class SurfaceSimulation(Simulation):
         Simulation.numint = dict['numint']
         Simulation.angleparam = dict['angleparam']
         Simulation.torsparam = dict['torsparam']
+        Simulation.natpairs = dict['natpairs']
         Simulation.nativeparam = dict['nativeparam']
         Simulation.nonnativeparam = dict['nonnativeparam']
         Simulation.nnepsil = dict['nnepsil']
@@ -125,6 +158,8 @@ class SurfaceSimulation(Simulation):
         SurfaceSimulation.nsurf = dict['nsurf']
         SurfaceSimulation.surfparam = dict['surfparam']
         SurfaceSimulation.scale = dict['scale']
+        SurfaceSimulation.surfgrid = dict['surfgrid']
+        SurfaceSimulation.gridparam = dict['gridparam']
         xlength = dict['xlength']
         ylength = dict['ylength']
         spacing = dict['spacing']
@@ -132,6 +167,7 @@ class SurfaceSimulation(Simulation):
         mass = dict['mass']
         Simulation.tsteps = dict['tsteps']
         Simulation.tsize = dict['tsize']
+        Simulation.tunemoves = dict['tunemoves']
      
         for i in xrange(nummoves):
             randmove = numpy.random.random()
@@ -148,6 +184,7 @@ class SurfaceSimulation(Simulation):
                 movetype = 'tr'
                 torschange = numpy.array([])
                 angchange = numpy.array([])
+                beadchange = numpy.zeros(Simulation.numbeads, dtype=int) # rigid body move
             
             # rotation
             elif randmove < Simulation.percentmove[1]:
@@ -160,6 +197,7 @@ class SurfaceSimulation(Simulation):
                 movetype = 'rot'
                 torschange = numpy.array([])
                 angchange = numpy.array([])
+                beadchange = numpy.zeros(Simulation.numbeads, dtype=int) # rigid body move
                 
             # angle bend
             elif randmove < Simulation.percentmove[2]:
@@ -169,6 +207,7 @@ class SurfaceSimulation(Simulation):
                 movetype = 'a'
                 torschange = numpy.array([])
                 angchange = numpy.array([m-1])
+                beadchange = moveset.movedbeads(Simulation.numbeads, m, randdir)
     
             # axis torsion
             elif randmove < Simulation.percentmove[3]:
@@ -178,6 +217,7 @@ class SurfaceSimulation(Simulation):
                 movetype = 'at'
                 self.atmoves += 1
                 angchange = numpy.array([])
+                beadchange = moveset.movedbeads(Simulation.numbeads, m, randdir)
                 if randdir < .5:
                     torschange = numpy.array([m-2])
                     if m < 2:
@@ -196,6 +236,7 @@ class SurfaceSimulation(Simulation):
                 movetype = 'gc'
                 torschange = numpy.arange(Simulation.numbeads-3)
                 angchange = numpy.arange(Simulation.numbeads-2)
+                beadchange = None
     
         	# parrot move
             elif randmove < Simulation.percentmove[5]:
@@ -206,35 +247,36 @@ class SurfaceSimulation(Simulation):
                 if m == 1:
                     self.newcoord = moveset.caxistorsion(self.coord, m, 1, theta)
                     torschange = numpy.array([0])
+                    beadchange = moveset.movedbeads(Simulation.numbeads, m, 1)
                     jac = 1
                 elif m == Simulation.numbeads - 2:
                     self.newcoord = moveset.caxistorsion(self.coord, m, 0, theta)
                     torschange = numpy.array([m-2])
+                    beadchange = moveset.movedbeads(Simulation.numbeads, m, 0)
                     jac = 1
                 else:
-                    self.newcoord, jac = moveset.parrot(self.coord, m, randdir, theta)
-                    if numpy.any(numpy.isnan(self.newcoord)):
+                    self.newcoord, jac, torschange, closed = moveset.cparrot(self.coord, m, randdir, theta)
+                    beadchange = moveset.parrotbeads(Simulation.numbeads, m, randdir)
+                    if not closed:
                         uncloseable = True
                         self.rejected += 1
                         self.pclosure += 1
                         self.move += 1
                         del self.newcoord
                         del jac
-                    elif randdir < .5:
-                        torschange = numpy.arange(m-2,m+2)
-                        torschange = torschange[torschange<(Simulation.numbeads-3)]
-                    else:
-                        torschange = numpy.arange(Simulation.numbeads-m-5,Simulation.numbeads-m-1)
-                        torschange = torschange[torschange>-1]
-                        torschange = torschange[torschange<(Simulation.numbeads-3)]
     
             # run molecular dynamics
             else:
-                self=moveset.runMD_surf(self, Simulation.tsteps, Simulation.tsize, dict)
+                self=moveset.runMD_surf(self, Simulation.tsteps, self.tsize, dict)
+                if self.uncloseable:
+                    uncloseable = True
+                    self.move += 1
+                    self.tune('md', 0.)
                 movetype = 'md'
                 self.mdmoves += 1
                 torschange = numpy.arange(Simulation.numbeads-3)
                 angchange = numpy.arange(Simulation.numbeads-2)
+                beadchange = None
                 jac = 1
             
             # check boundary conditions
@@ -256,20 +298,24 @@ class SurfaceSimulation(Simulation):
     
             # accept or reject
             if not uncloseable and movetype=='md':
-                self.update_energy(torschange, angchange, dict)
+                self.update_energy(torschange, angchange, dict, beadchange)
                 self.newH=self.u1+.5/4.184*numpy.sum(mass*numpy.sum(self.vel**2,axis=1)) # in kcal/mol
                 self.move += 1
                 boltz = numpy.exp(-(self.newH-self.oldH)/(Simulation.kb*self.T))
+                self.tune(movetype, boltz)
                 if numpy.random.random() < boltz:
                     self.accept_state()
                     self.accepted += 1
                     self.acceptedmd += 1
+                    self.mdstate = self.mdaccept
                 else:
+                    self.reject_state()
                     self.rejected += 1
             elif not uncloseable:
-                self.update_energy(torschange, angchange, dict)
+                self.update_energy(torschange, angchange, dict, beadchange)
                 self.move += 1
                 boltz = jac*numpy.exp(-(self.u1-self.u0)/(Simulation.kb*self.T))
+                self.tune(movetype, boltz)
                 if numpy.random.random() < boltz:
                     self.accept_state()
                     self.accepted += 1
@@ -286,9 +332,12 @@ class SurfaceSimulation(Simulation):
                     else:
                         self.acceptedp += 1
                 else:
+                    self.reject_state()
                     self.rejected += 1
             if self.move % Simulation.save == 0:
                 self.save_state(dict)
+        self.traj.flush()
+        self.log.flush()
         return self 
     
 
@@ -0,0 +1,250 @@
+'''
+Trajectory files of simulateGO.py -w
+
+A trajectory is preallocated with one slot per save point when the run starts:
+    header: magic, version, numbeads, number of slots, save interval (64 bytes)
+    index:  int64 move number of every slot, -1 for slots not written yet
+    frames: float32 slots x numbeads x 3 in one contiguous block
+so load() maps it with numpy.memmap and reads any range of frames without parsing.
+Every frame goes to the slot of its save point, so the replicas of a temperature-label
+run can write the same file from different processes.
+Files of the old format (one numpy.save per frame) are still read by load().
+
+With a precision, create() makes a compressed trajectory instead, in the spirit of XTC:
+    header:  magic, version, numbeads, number of slots, save interval, precision (64 bytes)
+    records: int64 number of frames, compressed size, integer width, then the slots and move
+             numbers of the frames and their zlib compressed coordinates
+The coordinates are rounded to multiples of the precision and stored as the first bead and
+the differences along the chain, 16 bit integers unless they do not fit, with the low and
+high bytes of all values in separate blocks before zlib. A Writer appends one record per
+batch in a single write, a later record of the same slot replaces an earlier one (restarts).
+grow() makes room for more slots when a run is restarted with more moves.
+'''
+import os
+import zlib
+import numpy
+
+magic = 'GOTRAJ01'
+zmagic = 'GOTRAJZ1'
+headersize = 64
+batch = 100 # frames a Writer buffers before writing them
+
+handles = {} # filename: (open file, numbeads, slots), kept across runs in each process
+
+def create(filename, numbeads, slots, save, precision=0.):
+    """Preallocates an empty trajectory with the given number of slots, compressed to the precision (A) if given"""
+    f = open(filename, 'wb')
+    if precision > 0:
+        f.write(zmagic)
+        numpy.array([numbeads, slots, save], dtype=numpy.int64).tofile(f)
+        numpy.array([precision], dtype=numpy.float64).tofile(f)
+        f.write('\0'*(headersize - f.tell()))
+        f.close()
+        return
+    f.write(magic)
+    numpy.array([numbeads, slots, save], dtype=numpy.int64).tofile(f)
+    f.write('\0'*(headersize - f.tell()))
+    index = numpy.empty(slots, dtype=numpy.int64)
+    index.fill(-1)
+    index.tofile(f)
+    f.seek(headersize + 8*slots + 12*numbeads*slots - 1)
+    f.write('\0')
+    f.close()
+
+def header(filename):
+    """Returns numbeads, slots, the save interval and the precision (0 for float32 frames) of a trajectory, None for the old format"""
+    f = open(filename, 'rb')
+    m = f.read(len(magic))
+    if m not in (magic, zmagic):
+        f.close()
+        return None
+    numbeads, slots, save = numpy.fromfile(f, dtype=numpy.int64, count=3)
+    precision = 0.
+    if m == zmagic:
+        precision = float(numpy.fromfile(f, dtype=numpy.float64, count=1)[0])
+    f.close()
+    return int(numbeads), int(slots), int(save), precision
+
+def gethandle(filename):
+    if filename not in handles:
+        info = header(filename)
+        if info is None or info[3] > 0:
+            raise IOError('%s is not a preallocated trajectory' % filename)
+        handles[filename] = (open(filename, 'r+b'), info[0], info[1])
+    return handles[filename]
+
+def checkslot(filename, slot, slots):
+    if slot >= slots:
+        raise ValueError('frame %i is past the %i slots of %s, trajectory.grow makes room for a longer run' % (slot, slots, filename))
+
+def grow(filename, slots):
+    """Makes room for the given number of slots, e.g. for a run restarted with more moves"""
+    info = header(filename)
+    if info is None:
+        raise IOError('%s is an old format trajectory' % filename)
+    numbeads, old, save, precision = info
+    if slots <= old:
+        return
+    if filename in handles:
+        handles.pop(filename)[0].close()
+    if precision > 0: # records carry their slots, only the header changes
+        f = open(filename, 'r+b')
+        f.seek(len(zmagic) + 8)
+        numpy.array([slots], dtype=numpy.int64).tofile(f)
+        f.close()
+        return
+    # the index is in front of the frames, so both are copied to a larger file
+    moves = numpy.fromfile(filename, dtype=numpy.int64, count=headersize/8 + old)[headersize/8:]
+    frames = numpy.memmap(filename, dtype=numpy.float32, mode='r', offset=headersize + 8*old, shape=(old, numbeads, 3))
+    tmp = filename + '.grow'
+    create(tmp, numbeads, slots, save)
+    f = open(tmp, 'r+b')
+    f.seek(headersize)
+    moves.tofile(f)
+    f.seek(headersize + 8*slots)
+    for k in range(0, old, 1000):
+        numpy.array(frames[k:k+1000]).tofile(f)
+    f.close()
+    del frames
+    os.rename(tmp, filename)
+
+def close():
+    """Closes the files this process writes, e.g. before forking workers"""
+    for f, numbeads, slots in handles.values():
+        f.close()
+    handles.clear()
+
+class Writer:
+    '''
+    Buffers the frames of a replica and writes them in batches of trajectory.batch
+    Only the buffer is pickled with the replica, the files stay open in the process
+    '''
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, filename, slot, move, coord):
+        self.buffer.append((filename, slot, move, numpy.array(coord, dtype=numpy.float32)))
+        if len(self.buffer) >= batch:
+            self.flush()
+
+    def flush(self):
+        written = set()
+        compressed = {}
+        for filename, slot, move, coord in self.buffer:
+            if filename not in handles and filename not in compressed:
+                info = header(filename)
+                if info is None:
+                    raise IOError('%s is an old format trajectory, frames are only written to files made by trajectory.create' % filename)
+                if info[3] > 0:
+                    compressed[filename] = []
+            if filename in compressed:
+                compressed[filename].append((slot, move, coord))
+                continue
+            f, numbeads, slots = gethandle(filename)
+            checkslot(filename, slot, slots)
+            f.seek(headersize + 8*slots + 12*numbeads*slot)
+            coord.tofile(f)
+            f.seek(headersize + 8*slot) # the index last, readers only see complete frames
+            numpy.array([move], dtype=numpy.int64).tofile(f)
+            written.add(f)
+        for f in written:
+            f.flush()
+        for filename, frames in compressed.items():
+            append(filename, frames)
+        self.buffer = []
+
+def encode(coord, precision):
+    """Compressed record of the frames F x numbeads x 3, returns the integer width and the zlib string"""
+    q = numpy.around(coord/precision).astype(numpy.int64)
+    q[:,1:,:] -= q[:,:-1,:].copy()
+    width = 2 if numpy.max(numpy.abs(q)) < 2**15 else 4
+    q = q.astype('<i%i' % width)
+    return width, zlib.compress(q.view(numpy.uint8).reshape(-1, width).T.tostring())
+
+def decode(data, width, nframes, numbeads, precision):
+    q = numpy.fromstring(zlib.decompress(data), dtype=numpy.uint8).reshape(width, -1).T.copy()
+    q = q.view('<i%i' % width).reshape(nframes, numbeads, 3)
+    return numpy.cumsum(q, axis=1)*precision
+
+def append(filename, frames):
+    """Appends the frames [(slot, move, coord)] to a compressed trajectory as one record"""
+    numbeads, slots, save, precision = header(filename)
+    for slot, move, coord in frames:
+        checkslot(filename, slot, slots)
+    width, data = encode(numpy.array([coord for slot, move, coord in frames]), precision)
+    n = len(frames)
+    record = numpy.array([n, len(data), width] + [slot for slot, move, coord in frames] + [move for slot, move, coord in frames], dtype=numpy.int64).tostring() + data
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND) # a single write, records of other processes do not interleave
+    os.write(fd, record)
+    os.close(fd)
+
+def records(filename):
+    """Latest record of every slot of a compressed trajectory, {slot: (offset, size, width, frames, position, move)}"""
+    f = open(filename, 'rb')
+    f.seek(0, 2)
+    size = f.tell()
+    pos = headersize
+    found = {}
+    while pos + 24 <= size:
+        f.seek(pos)
+        n, nbytes, width = numpy.fromfile(f, dtype=numpy.int64, count=3)
+        info = numpy.fromfile(f, dtype=numpy.int64, count=2*n)
+        data = pos + 24 + 16*n
+        if data + nbytes > size: # being written
+            break
+        for k in range(n):
+            found[int(info[k])] = (data, int(nbytes), int(width), int(n), k, int(info[n+k]))
+        pos = data + nbytes
+    f.close()
+    return found
+
+def index(filename):
+    """Move numbers of the frames written so far"""
+    info = header(filename)
+    if info is None:
+        return None
+    if info[3] > 0:
+        found = records(filename)
+        moves = numpy.array([found[slot][5] if slot in found else -1 for slot in range(info[1])], dtype=numpy.int64)
+    else:
+        moves = numpy.fromfile(filename, dtype=numpy.int64, count=headersize/8 + info[1])[headersize/8:]
+    empty = numpy.flatnonzero(moves < 0)
+    if len(empty):
+        return moves[0:empty[0]]
+    return moves
+
+def load(filename, start=None, stop=None, step=None):
+    """
+    Frames start:stop:step of a trajectory as an F x numbeads x 3 array, a read-only
+    float32 memmap for the preallocated format and a float array for the compressed
+    and the old format, only the records holding these frames are decompressed
+    """
+    info = header(filename)
+    if info is None:
+        f = open(filename, 'rb')
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(0)
+        frames = []
+        while f.tell() < size:
+            frames.append(numpy.load(f))
+        f.close()
+        return numpy.array(frames[start:stop:step])
+    numbeads, slots, save, precision = info
+    n = len(index(filename))
+    if precision > 0:
+        found = records(filename)
+        wanted = range(n)[start:stop:step]
+        frames = numpy.empty((len(wanted), numbeads, 3))
+        f = open(filename, 'rb')
+        decoded = {}
+        for i, slot in enumerate(wanted):
+            offset, nbytes, width, nframes, k, move = found[slot]
+            if offset not in decoded:
+                f.seek(offset)
+                decoded[offset] = decode(f.read(nbytes), width, nframes, numbeads, precision)
+            frames[i] = decoded[offset][k]
+        f.close()
+        return frames
+    frames = numpy.memmap(filename, dtype=numpy.float32, mode='r', offset=headersize + 8*slots, shape=(slots, numbeads, 3))
+    return frames[0:n][start:stop:step]
@@ -4,6 +4,7 @@ import numpy
 import writetopdb_docking as pdb
 import optparse
 import energyfunc
+import trajectory
 from pdb import *
 
 def parse_args():
@@ -17,17 +18,10 @@ def parse_args():
 
 def convert_pdb(args):
     _,pdb_text = pdb.get_coord(args.pdbfile)
-    f = open(args.trajfile,'r')
     print 'reading trajectory from %s' % args.trajfile
     print 'saving trajectory to %s.pdb' % args.trajfile
-    i = 0
-    while 1:
-        try:
-            coord = numpy.load(f)
-            pdb.write_coord(args.trajfile+'pdb',i,coord,pdb_text)
-            i += 1
-        except:
-            break
+    for i, coord in enumerate(trajectory.load(args.trajfile)):
+        pdb.write_coord(args.trajfile+'pdb',i,coord,pdb_text)
     print 'trajectory converted'
     print 'done'
 
@@ -38,11 +32,9 @@ def main():
     scale = 1
     param = energyfunc.getsurfparam_old(args.pdbfile, numbeads, len(surf), numbeads*len(surf), scale)
     energy = numpy.zeros((args.n,2))
-    f = open(args.trajfile,'r')
+    traj = trajectory.load(args.trajfile, 0, args.n)
     for i in range(args.n):
-        coord = numpy.load(f)
-        energy[i,:] = energyfunc.csurfenergy_old(coord, surf, numbeads, numbeads*len(surf), param, scale)
-    f.close()
+        energy[i,:] = energyfunc.csurfenergy_old(numpy.array(traj[i], dtype=float), surf, numbeads, numbeads*len(surf), param, scale)
     print energy
     file = '%s/surfenergy%i_126.npy' % (args.trajfile[0:args.trajfile.rfind('/')], int(args.trajfile[-7:-4]))
     numpy.save(file,energy)
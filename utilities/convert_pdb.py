@@ -5,6 +5,7 @@ import writetopdb_docking as pdb
 import optparse
 from pdb import *
 import energyfunc
+import trajectory
 
 def parse_args():
     parser = optparse.OptionParser(description='converts a npy trajectory into a pdb trajectory for VMD')
@@ -59,17 +60,10 @@ def convert_pdb(args):
             count += 1
 
     # convert npy trajectory to pdb trajectory
-    f = open(args.trajfile,'r')
     print 'reading trajectory from %s' % args.trajfile
     print 'saving trajectory to %s.pdb' % args.trajfile
-    i = 0
-    while 1:
-        try:
-            coord = numpy.load(f)
-            pdb.write_coord(args.trajfile+'.pdb',i,coord,pdb_text)
-            i += 1
-        except:
-            break
+    for i, coord in enumerate(trajectory.load(args.trajfile)):
+        pdb.write_coord(args.trajfile+'.pdb',i,coord,pdb_text)
     print 'trajectory converted'
     print 'done'
 